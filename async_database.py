@@ -0,0 +1,121 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Dict, Optional
+
+from database import db
+from db_cache import TTLCache
+from interaction_buffer import InteractionBuffer
+
+
+class AsyncDatabase:
+    """Асинхронный доступ к базе для обработчиков бота.
+
+    Блокирующие вызовы базы выполняются в отдельном пуле потоков размером с пул
+    подключений, поэтому медленный запрос не останавливает обработку других апдейтов.
+    Записи пользователей и общая статистика читаются через кэш, который сбрасывается
+    при каждой записи через этот слой. Взаимодействия пишутся отложенно пачками.
+    """
+
+    def __init__(self, database, max_workers: int = None, cache: TTLCache = None):
+        self._db = database
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or database.concurrency,
+                                            thread_name_prefix='db')
+        self.cache = cache or TTLCache()
+        self.interactions = InteractionBuffer(self._write_interactions)
+
+    async def start(self):
+        """Запустить периодический сброс буфера взаимодействий"""
+        self.interactions.start()
+
+    async def close(self):
+        """Записать накопленные взаимодействия; вызывать при остановке бота"""
+        await self.interactions.close()
+
+    async def run(self, func, *args, **kwargs):
+        """Выполнить синхронный метод базы в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def _invalidate_user(self, user_id: int):
+        self.cache.invalidate(('user', user_id))
+        self.cache.invalidate(('active', user_id))
+        self.cache.invalidate('user_stats')
+
+    async def add_user(self, user_id: int, username: str = None, first_name: str = None,
+                       last_name: str = None, user_data: dict = None) -> bool:
+        try:
+            return await self.run(self._db.add_user, user_id, username, first_name, last_name, user_data)
+        finally:
+            self._invalidate_user(user_id)
+
+    async def subscribe_user(self, user_id: int, username: str = None, first_name: str = None,
+                             last_name: str = None) -> Optional[str]:
+        result = await self.run(self._db.subscribe_user, user_id, username, first_name, last_name)
+        if result == 'already_subscribed':
+            # Статус не изменился - достаточно освежить время активности в кэше
+            self.cache.update(('user', user_id), username=username or "-", first_name=first_name or "-",
+                              last_name=last_name or "-", last_interaction=datetime.now())
+        else:
+            self._invalidate_user(user_id)
+        if result is not None:
+            # Запоминаем записанные поля профиля: при их изменении быстрый путь не сработает
+            self.cache.set(('active', user_id), (username, first_name, last_name))
+        return result
+
+    async def remove_user(self, user_id: int):
+        try:
+            return await self.run(self._db.remove_user, user_id)
+        finally:
+            self._invalidate_user(user_id)
+
+    async def get_user_info(self, user_id: int) -> Optional[Dict]:
+        key = ('user', user_id)
+        user_info = self.cache.get(key)
+        if user_info is None:
+            user_info = await self.run(self._db.get_user_info, user_id)
+            if user_info is None:
+                return None
+            self.cache.set(key, user_info)
+        return dict(user_info)
+
+    async def update_user_interaction(self, user_id: int):
+        """Учесть взаимодействие; в базу оно попадёт со следующим сбросом буфера"""
+        now = datetime.now()
+        await self.interactions.touch(user_id, now)
+        self.cache.update(('user', user_id), last_interaction=now)
+
+    async def _write_interactions(self, interactions) -> bool:
+        return await self.run(self._db.record_interactions, interactions)
+
+    def is_known_active(self, user_id: int, username: str = None, first_name: str = None,
+                        last_name: str = None) -> bool:
+        """Пользователь недавно подтверждён активным подписчиком с теми же именем и username
+        (по кэшу, без запроса в базу)"""
+        return self.cache.get(('active', user_id)) == (username, first_name, last_name)
+
+    async def get_user_stats(self) -> Dict:
+        stats = self.cache.get('user_stats')
+        if stats is None:
+            stats = await self.run(self._db.get_user_stats)
+            # При ошибке запроса метод возвращает нули - такое не кэшируем
+            if stats['total_users']:
+                self.cache.set('user_stats', stats)
+        return stats
+
+    async def add_channel_recommendation(self, user_id: int, recommendation: str):
+        return await self.run(self._db.add_channel_recommendation, user_id, recommendation)
+
+    async def get_channel_recommendations(self) -> List[Dict]:
+        return await self.run(self._db.get_channel_recommendations)
+
+    def cache_stats(self) -> Dict:
+        return self.cache.stats()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+# Глобальный асинхронный доступ к базе данных
+adb = AsyncDatabase(db)
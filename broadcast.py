@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Union
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Глобальный лимит Bot API - около 30 сообщений в секунду, оставляем запас
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', '25'))
+# Одновременных запросов send_message
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '30'))
+# Не чаще одного сообщения в секунду в один чат
+PER_CHAT_INTERVAL = 1.0
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+MAX_SEND_ATTEMPTS = 5
+# Как часто сбрасываем итоги доставки в базу
+DELIVERY_FLUSH_INTERVAL = 5.0
+DELIVERY_FLUSH_SIZE = 500
+# Сколько получателей читаем из базы за один запрос
+RECIPIENT_BATCH_SIZE = int(os.environ.get('RECIPIENT_BATCH_SIZE', '1000'))
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate отправок в секунду с допустимым всплеском capacity"""
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Остановить все отправки на время, указанное Telegram в RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Разбить текст на части не длиннее limit, по возможности по абзацам"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+def is_chat_unavailable(error_msg: str) -> bool:
+    """Постоянные ошибки, после которых пользователя нужно деактивировать: чат не найден
+    и любой Forbidden (бот заблокирован или исключён, аккаунт удалён или деактивирован)"""
+    return "Chat not found" in error_msg or "Forbidden:" in error_msg
+
+
+class Broadcaster:
+    """Параллельная рассылка одного текста под глобальным и початовым лимитами"""
+
+    def __init__(self, bot, rate: float = BROADCAST_RATE, concurrency: int = BROADCAST_CONCURRENCY):
+        self.bot = bot
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.stats = {'sent': 0, 'failed': 0, 'blocked': 0, 'skipped': 0, 'errors': 0, 'messages': 0,
+                      'retry_after': 0, 'retry_after_seconds': 0.0, 'elapsed': 0.0}
+
+    async def _send_part(self, chat_id: int, text: str, **kwargs):
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            await self.bucket.acquire()
+            try:
+                result = await self.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.stats['messages'] += 1
+                return result
+            except RetryAfter as e:
+                seconds = _retry_after_seconds(e)
+                self.stats['retry_after'] += 1
+                self.stats['retry_after_seconds'] += seconds
+                logger.warning(f"[WARN] RetryAfter {seconds} c (чат {chat_id}), рассылка приостановлена")
+                self.bucket.pause(seconds)
+        raise RuntimeError(f"превышено число повторов после RetryAfter для чата {chat_id}")
+
+    async def _deliver(self, chat_id: int, parts: List[str], on_result: Optional[Callable],
+                       before_send: Optional[Callable], **kwargs):
+        if before_send and not await before_send(chat_id):
+            # Получатель уже занят или получил рассылку (например, параллельным запуском)
+            self.stats['skipped'] += 1
+            return
+        try:
+            for i, part in enumerate(parts):
+                if i:
+                    await asyncio.sleep(PER_CHAT_INTERVAL)
+                await self._send_part(chat_id, part, **kwargs)
+            self.stats['sent'] += 1
+            status, error_msg = 'sent', None
+        except Exception as e:
+            error_msg = str(e)
+            status = 'blocked' if is_chat_unavailable(error_msg) else 'failed'
+            self.stats[status] += 1
+            logger.error(f"[FAILED] Не удалось отправить сообщение пользователю {chat_id}: {error_msg}")
+        if on_result:
+            await on_result(chat_id, status, error_msg)
+
+    async def run(self, recipients: Union[Iterable[int], AsyncIterator[int]], text: str,
+                  on_result: Callable = None, before_send: Callable = None, **kwargs) -> Dict:
+        """Разослать текст всем получателям; on_result(chat_id, status, error) вызывается по каждому.
+
+        before_send(chat_id) вызывается перед отправкой: False - пропустить получателя,
+        исключение - считать ошибкой обработки, ничего не отправляя.
+        """
+        parts = split_message(text)
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        began = time.monotonic()
+
+        async def worker():
+            while True:
+                chat_id = await queue.get()
+                try:
+                    if chat_id is None:
+                        return
+                    await self._deliver(chat_id, parts, on_result, before_send, **kwargs)
+                except Exception as e:
+                    # Ошибка обработки одного получателя (например, в on_result) не должна останавливать воркер
+                    self.stats['errors'] += 1
+                    logger.error(f"[ERROR] Ошибка обработки получателя {chat_id}: {e}")
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+
+        async def put(chat_id):
+            """Поставить в очередь, следя за воркерами: без них полная очередь ждала бы вечно"""
+            if not queue.full():
+                queue.put_nowait(chat_id)
+                return
+            put_task = asyncio.ensure_future(queue.put(chat_id))
+            try:
+                while not put_task.done():
+                    crashed = [w for w in workers if w.done() and not w.cancelled() and w.exception()]
+                    if crashed:
+                        raise crashed[0].exception()
+                    alive = [w for w in workers if not w.done()]
+                    if not alive:
+                        raise RuntimeError("все обработчики рассылки завершились")
+                    await asyncio.wait([put_task, *alive], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                put_task.cancel()
+
+        try:
+            if hasattr(recipients, '__aiter__'):
+                async for chat_id in recipients:
+                    await put(chat_id)
+            else:
+                for chat_id in recipients:
+                    await put(chat_id)
+            for _ in workers:
+                await put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+
+        self.stats['elapsed'] = time.monotonic() - began
+        self.log_stats()
+        return self.stats
+
+    def log_stats(self):
+        elapsed = self.stats['elapsed'] or 1e-9
+        logger.info(
+            f"[INFO] Рассылка: успешно={self.stats['sent']}, неудачно={self.stats['failed']}, "
+            f"заблокировали={self.stats['blocked']}, пропущено={self.stats['skipped']}, "
+            f"ошибок обработки={self.stats['errors']}, "
+            f"сообщений={self.stats['messages']} "
+            f"за {self.stats['elapsed']:.1f} c ({self.stats['messages'] / elapsed:.1f} msg/s), "
+            f"RetryAfter: {self.stats['retry_after']} ({self.stats['retry_after_seconds']:.0f} c)"
+        )
+
+
+async def stream_recipients(db, digest_id: Optional[int] = None,
+                            batch_size: int = RECIPIENT_BATCH_SIZE) -> AsyncIterator[int]:
+    """Получатели рассылки пачками по user_id; следующая пачка читается, пока идёт отправка текущей"""
+    next_batch = asyncio.create_task(asyncio.to_thread(db.get_recipient_batch, 0, batch_size, digest_id))
+    while next_batch is not None:
+        batch = await next_batch
+        next_batch = None
+        if len(batch) == batch_size:
+            next_batch = asyncio.create_task(
+                asyncio.to_thread(db.get_recipient_batch, batch[-1], batch_size, digest_id)
+            )
+        for user_id in batch:
+            yield user_id
+
+
+class DeliveryRecorder:
+    """Копит итоги доставки в памяти и пачками записывает их в базу.
+
+    Перед отправкой получатель занимается в newsletter_sends (claim): запросы на занятие,
+    пришедшие, пока пишется предыдущая пачка, записываются следующей одним запросом.
+    Итоги, потерянные при падении процесса, не приводят к повторной отправке - занятых
+    получателей продолжение рассылки пропускает.
+    """
+
+    def __init__(self, db, digest_id: Optional[int], flush_interval: float = DELIVERY_FLUSH_INTERVAL,
+                 flush_size: int = DELIVERY_FLUSH_SIZE):
+        self.db = db
+        self.digest_id = digest_id
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = []
+        self._claims = []
+        self._claim_task = None
+        self.failed_flushes = 0
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    async def claim(self, user_id: int) -> bool:
+        """Занять получателя до отправки; True - занятие записано в базу и можно отправлять"""
+        if not self.digest_id:
+            return True
+        future = asyncio.get_running_loop().create_future()
+        self._claims.append((user_id, future))
+        if self._claim_task is None or self._claim_task.done():
+            self._claim_task = asyncio.create_task(self._write_claims())
+        return await future
+
+    async def _write_claims(self):
+        while self._claims:
+            batch, self._claims = self._claims, []
+            try:
+                claimed = set(await asyncio.to_thread(
+                    self.db.claim_deliveries, self.digest_id, [user_id for user_id, _ in batch]
+                ))
+            except Exception as e:
+                logger.error(f"[ERROR] Не удалось занять получателей ({len(batch)} шт.): {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for user_id, future in batch:
+                if not future.done():
+                    future.set_result(user_id in claimed)
+
+    async def record(self, user_id: int, status: str, error_msg: Optional[str]):
+        self._pending.append((user_id, status, error_msg))
+        if status == 'blocked':
+            logger.info(f"[INFO] Пользователь {user_id} будет деактивирован из-за недоступности чата")
+        if len(self._pending) >= self.flush_size:
+            try:
+                await self.flush()
+            except Exception:
+                # Пачка осталась в очереди, её запишет следующий сброс
+                pass
+
+    async def flush(self):
+        """Записать накопленные итоги; при ошибке они возвращаются в очередь, а ошибка пробрасывается"""
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if not batch:
+                return
+            try:
+                await asyncio.to_thread(self.db.record_deliveries, self.digest_id, batch)
+            except Exception as e:
+                # Пока шла запись, могли добавиться новые итоги - сохраняем порядок
+                self._pending = batch + self._pending
+                self.failed_flushes += 1
+                logger.error(f"[ERROR] Не удалось записать итоги доставки ({len(batch)} шт.), "
+                             f"повторю при следующем сбросе: {e}")
+                raise
+
+    async def _periodic_flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._periodic_flush())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._task.cancel()
+        # Последний сброс пробрасывает ошибку: незаписанные итоги не дают закрыть рассылку
+        await self.flush()
@@ -0,0 +1,178 @@
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+CHANNELS_FILE = "channels.json"
+# Не чаще чем раз в столько секунд сверяем mtime файла (stat, без чтения)
+REGISTRY_CHECK_INTERVAL = float(os.environ.get('CHANNEL_REGISTRY_CHECK_INTERVAL', '5'))
+# Сколько каналов показываем в ответах на /start и сообщения
+PREVIEW_LIMIT = 10
+
+# Компактный формат: вместо полного дампа сущности Telethon - только используемые поля,
+# по строке-массиву на канал: {"format": ..., "version": 1, "fields": [...], "channels": [[...], ...]}.
+# Состав колонок берётся из заголовка файла; отметки чтения каналов хранятся в news_channels, не здесь
+COMPACT_FORMAT = 'channel-registry'
+COMPACT_VERSION = 1
+COMPACT_FIELDS = ('id', 'access_hash', 'username', 'title', 'weight')
+
+
+def parse_channels(data: Dict) -> List[Dict]:
+    """Каналы из документа в компактном или старом формате (дамп Telethon) - только нужные поля"""
+    if data.get('format') == COMPACT_FORMAT:
+        if data.get('version', COMPACT_VERSION) > COMPACT_VERSION:
+            raise ValueError(f"неизвестная версия формата каналов: {data['version']}")
+        fields = data['fields']
+        rows = (zip(fields, row) for row in data.get('channels', []))
+    else:
+        rows = (((field, channel.get(field)) for field in COMPACT_FIELDS) for channel in data.get('channels', []))
+    # Пустые поля не храним: потребители подставляют свои значения по умолчанию (weight = 1.0)
+    return [{field: value for field, value in row if value is not None} for row in rows]
+
+
+def load_channels(path: str) -> List[Dict]:
+    """Прочитать файл каналов в любом из форматов"""
+    with open(path, "r", encoding="utf-8") as f:
+        return parse_channels(json.load(f))
+
+
+def save_channels(path: str, channels: List[Dict]):
+    """Записать каналы в компактном формате; файл подменяется целиком, читатели не видят половину"""
+    header = json.dumps({'format': COMPACT_FORMAT, 'version': COMPACT_VERSION, 'fields': COMPACT_FIELDS},
+                        ensure_ascii=False)
+    rows = [json.dumps([channel.get(field) for field in COMPACT_FIELDS], ensure_ascii=False) for channel in channels]
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(header[:-1] + ', "channels": [\n' + ",\n".join(rows) + "\n]}\n")
+    os.replace(tmp_path, path)
+
+
+def channel_name(channel: Dict) -> str:
+    """@username канала, а без него - название"""
+    if channel.get('username'):
+        return f"@{channel['username']}"
+    return channel.get('title') or '-'
+
+
+class ChannelRegistry:
+    """Список каналов в памяти: файл перечитывается только после изменения его mtime.
+
+    Тексты ответов бота собираются при загрузке, обработчики берут готовые строки.
+    """
+
+    def __init__(self, path: str = CHANNELS_FILE, check_interval: float = REGISTRY_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._checked_at = float('-inf')
+        self.channels: List[Dict] = []
+        self.metrics = {'loads': 0, 'errors': 0}
+        self._render(error="файл ещё не загружен")
+
+    def _render(self, error: str = None):
+        if error:
+            self._preview = "📭 Ошибка загрузки списка каналов"
+            self._full = f"Не удалось получить список каналов: {error}"
+            return
+        names = [channel_name(c) for c in self.channels if c.get('username') or c.get('title')]
+        if not names:
+            self._preview = "📭 Список каналов временно пуст"
+        else:
+            self._preview = "\n".join(f"• {name}" for name in names[:PREVIEW_LIMIT]) + \
+                (f"\n• и ещё {len(names) - PREVIEW_LIMIT} каналов..." if len(names) > PREVIEW_LIMIT else "")
+        if not self.channels:
+            self._full = "Список каналов пуст."
+        else:
+            self._full = "Список каналов для агрегации:\n" + "\n".join(channel_name(c) for c in self.channels)
+
+    def refresh(self, force: bool = False):
+        """Перечитать файл, если он изменился (проверка не чаще check_interval)"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        with self._lock:
+            if not force and now - self._checked_at < self.check_interval:
+                return
+            self._checked_at = now
+            mtime = None
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime and not force:
+                    return
+                channels = load_channels(self.path)
+            except Exception as e:
+                # Битый или отсутствующий файл: оставляем последний удачно загруженный список,
+                # битый файл перечитываем только после следующего изменения
+                self._mtime = mtime
+                self.metrics['errors'] += 1
+                logger.error(f"Ошибка загрузки каналов из {self.path}: {e}")
+                if not self.metrics['loads']:
+                    self._render(error=str(e))
+                return
+            self.channels = channels
+            self._mtime = mtime
+            self.metrics['loads'] += 1
+            self._render()
+
+    def invalidate(self):
+        """Перечитать файл при следующем обращении, не дожидаясь интервала проверки"""
+        self._checked_at = float('-inf')
+        self._mtime = None
+
+    @property
+    def preview(self) -> str:
+        """Первые каналы списком для /start и ответов на сообщения"""
+        self.refresh()
+        return self._preview
+
+    @property
+    def full_list(self) -> str:
+        """Полный список для /channels"""
+        self.refresh()
+        return self._full
+
+
+registry = ChannelRegistry()
+
+
+def convert(path: str) -> Dict:
+    """Перевести файл каналов в компактный формат, старый сохраняется рядом с суффиксом .bak"""
+    size_before = os.path.getsize(path)
+    began = time.perf_counter()
+    channels = load_channels(path)
+    load_before = time.perf_counter() - began
+    os.replace(path, f"{path}.bak")
+    save_channels(path, channels)
+    began = time.perf_counter()
+    load_channels(path)
+    return {
+        'channels': len(channels),
+        'size_before': size_before, 'size_after': os.path.getsize(path),
+        'load_before': load_before, 'load_after': time.perf_counter() - began,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перевод файлов каналов (дампов Telethon) в компактный формат")
+    parser.add_argument('paths', nargs='*', default=[CHANNELS_FILE, 'sport_channels.json'])
+    args = parser.parse_args()
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            print(f"❌ Файл не найден: {path}")
+            continue
+        report = convert(path)
+        print(f"✅ {path}: {report['channels']} каналов, "
+              f"{report['size_before'] / 1024:.1f} КБ → {report['size_after'] / 1024:.1f} КБ, "
+              f"загрузка {report['load_before'] * 1000:.2f} → {report['load_after'] * 1000:.2f} мс "
+              f"(старый файл: {path}.bak)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,178 +1,103 @@
-
-import psycopg2
-from psycopg2.extras import RealDictCursor
+try:
+    import psycopg2
+    from psycopg2 import sql
+    from psycopg2.extras import RealDictCursor, execute_values
+    from db_pool import ConnectionPool, DB_POOL_MAX
+except ImportError:
+    # Без psycopg2 доступно только встроенное хранилище SQLite (DB_BACKEND=sqlite)
+    psycopg2 = None
 import json
 import os
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, date, timezone
 from typing import List, Dict, Optional
-import sqlite3
 
-class PostgresDatabase:
+from db_metrics import instrumented, note_acquire, note_error
+from schema import ensure_schema
+from storage import (DB_BACKEND, LLM_CACHE_RETENTION_DAYS, MAX_DELIVERY_ATTEMPTS, NEWS_POSTS_RETENTION_MONTHS,
+                     StorageBackend, month_start, utc_naive)
+
+# Сколько строк отправляем в одном многострочном INSERT
+BULK_PAGE_SIZE = 500
+# Секции news_posts по месяцам: news_posts_2024_01, news_posts_2024_02, ...
+POSTS_PARTITION_PREFIX = 'news_posts_'
+
+@instrumented
+class PostgresDatabase(StorageBackend):
     def __init__(self):
+        if psycopg2 is None:
+            raise ImportError("❌ psycopg2 не установлен: pip install psycopg2-binary или DB_BACKEND=sqlite")
         self.database_url = os.environ.get('DATABASE_URL')
         if not self.database_url:
             raise ValueError("❌ DATABASE_URL не найден в переменных окружения")
         
         # Модификация URL для connection pooling
         self.pool_url = self.database_url.replace('.us-east-2', '-pooler.us-east-2')
-        self.init_database()
+        # Подключаемся и проверяем схему при первом запросе, а не при импорте модуля
+        self.pool = None
+        self._connect_lock = threading.Lock()
+        self.concurrency = DB_POOL_MAX
+        # Месяцы, для которых секция news_posts точно существует
+        self._post_partitions = set()
     
-    def _get_connection(self):
-        """Получить подключение к PostgreSQL"""
+    def _create_pool(self) -> 'ConnectionPool':
+        """Создать пул подключений (при ошибке - к основному URL)"""
         try:
-            conn = psycopg2.connect(self.pool_url)
-            return conn
+            return ConnectionPool(self.pool_url)
         except Exception as e:
             print(f"❌ Ошибка подключения к PostgreSQL: {e}")
             # Fallback на обычный URL
-            return psycopg2.connect(self.database_url)
+            return ConnectionPool(self.database_url)
     
-    def init_database(self):
-        """Инициализация PostgreSQL базы данных и создание таблиц"""
-        conn = self._get_connection()
-        cursor = conn.cursor()
-        
+    def _connect(self):
+        """Создать пул и применить недостающие миграции схемы"""
+        with self._connect_lock:
+            if self.pool is not None:
+                return
+            pool = self._create_pool()
+            conn = pool.getconn()
+            try:
+                ensure_schema(conn)
+            except Exception:
+                conn.close()
+                pool.closeall()
+                raise
+            conn.close()
+            self.pool = pool
+    
+    def _get_connection(self):
+        """Получить подключение к PostgreSQL из пула (close() возвращает его в пул)"""
+        began = time.perf_counter()
         try:
-            # Таблица пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username VARCHAR(255),
-                    first_name VARCHAR(255),
-                    last_name VARCHAR(255),
-                    full_name VARCHAR(511),
-                    language_code VARCHAR(10),
-                    is_bot BOOLEAN DEFAULT false,
-                    is_premium BOOLEAN DEFAULT false,
-                    added_via_link BOOLEAN DEFAULT false,
-                    can_join_groups BOOLEAN,
-                    can_read_all_group_messages BOOLEAN,
-                    supports_inline_queries BOOLEAN,
-                    is_verified BOOLEAN DEFAULT false,
-                    is_restricted BOOLEAN DEFAULT false,
-                    is_scam BOOLEAN DEFAULT false,
-                    is_fake BOOLEAN DEFAULT false,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    is_active BOOLEAN DEFAULT true,
-                    last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    user_data JSONB
-                )
-            ''')
-            
-            # Таблица для статистики пользователей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS user_stats (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT REFERENCES users(user_id),
-                    messages_received INTEGER DEFAULT 0,
-                    last_message_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    commands_used JSONB DEFAULT '{}',
-                    UNIQUE(user_id)
-                )
-            ''')
-            
-            # Таблица для рекомендаций каналов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS channel_recommendations (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT REFERENCES users(user_id),
-                    recommendation TEXT NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    status VARCHAR(50) DEFAULT 'pending',
-                    admin_notes TEXT
-                )
-            ''')
-            
-            # Таблица для каналов (источников новостей)
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS news_channels (
-                    id SERIAL PRIMARY KEY,
-                    channel_id BIGINT UNIQUE,
-                    username VARCHAR(255),
-                    title VARCHAR(500),
-                    description TEXT,
-                    participants_count INTEGER,
-                    is_active BOOLEAN DEFAULT true,
-                    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_checked TIMESTAMP,
-                    channel_data JSONB
-                )
-            ''')
-            
-            # Таблица для новостей
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS news_posts (
-                    id SERIAL PRIMARY KEY,
-                    channel_id BIGINT REFERENCES news_channels(channel_id),
-                    message_id BIGINT,
-                    content TEXT,
-                    post_date TIMESTAMP,
-                    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    included_in_digest BOOLEAN DEFAULT false,
-                    digest_date DATE,
-                    UNIQUE(channel_id, message_id)
-                )
-            ''')
-            
-            # Таблица для дайджестов
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS news_digests (
-                    id SERIAL PRIMARY KEY,
-                    digest_date DATE UNIQUE,
-                    content TEXT,
-                    summary TEXT,
-                    posts_count INTEGER DEFAULT 0,
-                    subscribers_sent INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    sent_at TIMESTAMP
-                )
-            ''')
-            
-            # Таблица для рассылок
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS newsletter_sends (
-                    id SERIAL PRIMARY KEY,
-                    digest_id INTEGER REFERENCES news_digests(id),
-                    user_id BIGINT REFERENCES users(user_id),
-                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    delivery_status VARCHAR(50) DEFAULT 'sent',
-                    error_message TEXT
-                )
-            ''')
-            
-            # Индексы для оптимизации
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_last_interaction ON users(last_interaction)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_channel_recommendations_created ON channel_recommendations(created_at)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_news_posts_date ON news_posts(post_date)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_news_posts_digest ON news_posts(digest_date)')
-            
-            conn.commit()
-            print("✅ PostgreSQL база данных инициализирована")
-            
-        except Exception as e:
-            print(f"❌ Ошибка инициализации базы данных: {e}")
-            conn.rollback()
+            if self.pool is None:
+                self._connect()
+            return self.pool.getconn()
+        except Exception:
+            note_error()
+            raise
         finally:
-            cursor.close()
-            conn.close()
+            note_acquire(time.perf_counter() - began)
+    
+    def init_database(self):
+        """Подключиться и привести схему к последней версии"""
+        self._get_connection().close()
+    
+    def get_pool_stats(self) -> Dict:
+        """Метрики пула подключений"""
+        return self.pool.stats() if self.pool is not None else {}
     
     def add_user(self, user_id: int, username: str = None, first_name: str = None, last_name: str = None, user_data: dict = None) -> bool:
         """Добавить пользователя в базу с расширенной информацией"""
-        print(f"[DEBUG] add_user: начало для пользователя {user_id}")
-        
         try:
             conn = self._get_connection()
-            print(f"[DEBUG] add_user: подключение к БД успешно")
         except Exception as e:
-            print(f"[ERROR] add_user: ошибка подключения к БД: {e}")
+            print(f"❌ Ошибка подключения к БД при добавлении пользователя {user_id}: {e}")
             return False
             
         cursor = conn.cursor()
         
         try:
-            print(f"[DEBUG] add_user: получены параметры - user_id={user_id}, username={username}, user_data={bool(user_data)}")
-            
             # Извлекаем данные из user_data если переданы
             if user_data:
                 language_code = user_data.get('language_code')
@@ -202,9 +127,6 @@ class PostgresDatabase:
             # Формируем полное имя
             full_name = f"{first_name or ''} {last_name or ''}".strip()
             
-            print(f"[DEBUG] add_user: подготовленные данные - full_name='{full_name}', is_active=True")
-            print(f"[DEBUG] add_user: выполняем SQL запрос INSERT/UPDATE...")
-            
             cursor.execute('''
                 INSERT INTO users (
                     user_id, username, first_name, last_name, 
@@ -230,18 +152,73 @@ class PostgresDatabase:
             ''', (user_id, datetime.now()))
             
             conn.commit()
-            print(f"[DEBUG] add_user: пользователь {user_id} успешно добавлен/обновлен")
             return True
         except Exception as e:
             print(f"❌ Ошибка добавления пользователя {user_id}: {e}")
-            print(f"[DEBUG] Тип ошибки: {type(e).__name__}")
-            print(f"[DEBUG] Детали ошибки: {str(e)}")
             conn.rollback()
             return False
         finally:
             cursor.close()
             conn.close()
     
+    def subscribe_user(self, user_id: int, username: str = None, first_name: str = None,
+                       last_name: str = None) -> Optional[str]:
+        """Подписать пользователя одним запросом.
+
+        Возвращает 'new' (новый), 'reactivated' (был отписан) или 'already_subscribed'
+        (уже активен: обновляются данные и статистика взаимодействия); None при ошибке.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            now = datetime.now()
+            cursor.execute('''
+                WITH prev AS (
+                    SELECT COALESCE(is_active, false) AS is_active FROM users WHERE user_id = %(user_id)s
+                ), upserted AS (
+                    INSERT INTO users (
+                        user_id, username, first_name, last_name,
+                        added_at, is_active, last_interaction
+                    )
+                    VALUES (%(user_id)s, %(username)s, %(first_name)s, %(last_name)s, %(now)s, true, %(now)s)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = EXCLUDED.username,
+                        first_name = EXCLUDED.first_name,
+                        last_name = EXCLUDED.last_name,
+                        is_active = TRUE,
+                        last_interaction = EXCLUDED.last_interaction
+                    RETURNING user_id
+                ), stats AS (
+                    INSERT INTO user_stats (user_id, messages_received, last_message_date)
+                    SELECT user_id, 0, %(now)s FROM upserted
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        messages_received = user_stats.messages_received
+                            + CASE WHEN (SELECT is_active FROM prev) THEN 1 ELSE 0 END,
+                        last_message_date = CASE WHEN (SELECT is_active FROM prev)
+                            THEN EXCLUDED.last_message_date ELSE user_stats.last_message_date END
+                )
+                SELECT CASE
+                    WHEN NOT EXISTS (SELECT 1 FROM prev) THEN 'new'
+                    WHEN (SELECT is_active FROM prev) THEN 'already_subscribed'
+                    ELSE 'reactivated'
+                END
+            ''', {
+                'user_id': user_id, 'username': username or "-", 'first_name': first_name or "-",
+                'last_name': last_name or "-", 'now': now,
+            })
+            
+            result = cursor.fetchone()[0]
+            conn.commit()
+            return result
+        except Exception as e:
+            print(f"❌ Ошибка подписки пользователя {user_id}: {e}")
+            conn.rollback()
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+    
     def remove_user(self, user_id: int):
         """Удалить пользователя (деактивировать)"""
         conn = self._get_connection()
@@ -319,6 +296,38 @@ class PostgresDatabase:
             cursor.close()
             conn.close()
     
+    def record_interactions(self, interactions: List[tuple]) -> bool:
+        """Записать накопленные взаимодействия [(user_id, число, время последнего)] одним запросом"""
+        if not interactions:
+            return True
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            execute_values(cursor, '''
+                WITH touches (user_id, touches, last_at) AS (VALUES %s),
+                touched AS (
+                    UPDATE users SET last_interaction = GREATEST(users.last_interaction, touches.last_at)
+                    FROM touches WHERE users.user_id = touches.user_id
+                    RETURNING users.user_id, touches.touches, touches.last_at
+                )
+                INSERT INTO user_stats (user_id, messages_received, last_message_date)
+                SELECT user_id, touches, last_at FROM touched
+                ON CONFLICT (user_id) DO UPDATE SET
+                    messages_received = user_stats.messages_received + EXCLUDED.messages_received,
+                    last_message_date = GREATEST(user_stats.last_message_date, EXCLUDED.last_message_date)
+            ''', interactions, template='(%s::bigint, %s::integer, %s::timestamp)', page_size=BULK_PAGE_SIZE)
+            
+            conn.commit()
+            return True
+        except Exception as e:
+            print(f"❌ Ошибка записи взаимодействий ({len(interactions)} пользователей): {e}")
+            conn.rollback()
+            return False
+        finally:
+            cursor.close()
+            conn.close()
+    
     def add_channel_recommendation(self, user_id: int, recommendation: str):
         """Добавить рекомендацию канала"""
         conn = self._get_connection()
@@ -394,18 +403,540 @@ class PostgresDatabase:
             cursor.close()
             conn.close()
     
+    def sync_news_channels(self, channels: List[Dict]):
+        """Зарегистрировать каналы из папки одним запросом (без сброса отметок чтения)"""
+        rows = [
+            (ch.get('id'), ch.get('username'), ch.get('title'), json.dumps(ch))
+            for ch in channels if ch.get('id')
+        ]
+        if not rows:
+            return
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            execute_values(cursor, '''
+                INSERT INTO news_channels (channel_id, username, title, channel_data)
+                VALUES %s
+                ON CONFLICT (channel_id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    title = EXCLUDED.title,
+                    channel_data = EXCLUDED.channel_data
+            ''', rows)
+            conn.commit()
+        except Exception as e:
+            print(f"❌ Ошибка синхронизации каналов: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def get_channel_watermarks(self) -> Dict[int, int]:
+        """Получить последний обработанный message_id для каждого канала"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                SELECT channel_id, last_message_id FROM news_channels
+                WHERE last_message_id IS NOT NULL
+            ''')
+            return {row[0]: row[1] for row in cursor.fetchall()}
+        except Exception as e:
+            print(f"❌ Ошибка получения отметок чтения каналов: {e}")
+            return {}
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def update_channel_watermarks(self, watermarks: Dict[int, Optional[int]]):
+        """Сохранить последний обработанный message_id каналов (отметка только растёт)"""
+        if not watermarks:
+            return
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            execute_values(cursor, '''
+                UPDATE news_channels AS nc SET
+                    last_message_id = GREATEST(nc.last_message_id, v.last_message_id),
+                    last_checked = (now() AT TIME ZONE 'utc')
+                FROM (VALUES %s) AS v(channel_id, last_message_id)
+                WHERE nc.channel_id = v.channel_id
+            ''', list(watermarks.items()), template='(%s::BIGINT, %s::BIGINT)')
+            conn.commit()
+        except Exception as e:
+            print(f"❌ Ошибка сохранения отметок чтения каналов: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def get_channels_checked_since(self, since: datetime) -> List[int]:
+        """Каналы, которые уже были полностью прочитаны после указанного момента"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                SELECT channel_id FROM news_channels WHERE last_checked >= %s
+            ''', (utc_naive(since),))
+            return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"❌ Ошибка получения прочитанных каналов: {e}")
+            return []
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def save_news_posts(self, posts: List[Dict]) -> Optional[int]:
+        """Сохранить посты пачками многострочных INSERT (повторное сохранение обновляет текст)"""
+        # Посты старше срока хранения уже свёрнуты в сводки - секцию под них не воссоздаём
+        cutoff = month_start(datetime.now(timezone.utc).date(), -NEWS_POSTS_RETENTION_MONTHS)
+        rows = [
+            (p['channel_id'], p['message_id'], p['text'], utc_naive(p['date']),
+             p.get('views'), p.get('forwards'))
+            for p in posts if p.get('channel_id') and utc_naive(p['date']).date() >= cutoff
+        ]
+        if not rows:
+            return 0
+        months = {month_start(row[3]) for row in rows} - self._post_partitions
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            if months:
+                cursor.execute('SELECT create_news_posts_partition(m) FROM unnest(%s::date[]) m',
+                               (sorted(months),))
+            execute_values(cursor, '''
+                INSERT INTO news_posts (channel_id, message_id, content, post_date, views, forwards)
+                VALUES %s
+                ON CONFLICT (channel_id, message_id, post_date) DO UPDATE SET
+                    content = EXCLUDED.content,
+                    views = EXCLUDED.views,
+                    forwards = EXCLUDED.forwards
+            ''', rows, page_size=BULK_PAGE_SIZE)
+            conn.commit()
+            self._post_partitions |= months
+            return len(rows)
+        except Exception as e:
+            print(f"❌ Ошибка сохранения постов: {e}")
+            conn.rollback()
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def get_news_posts(self, channel_ids: List[int], start: datetime, end: datetime,
+                       digest_date: date) -> List[Dict]:
+        """Получить посты каналов за интервал, ещё не вошедшие в другой дайджест"""
+        conn = self._get_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        try:
+            cursor.execute('''
+                SELECT p.id, p.channel_id, c.username, p.message_id, p.content, p.post_date,
+                       p.views, p.forwards
+                FROM news_posts p
+                JOIN news_channels c ON c.channel_id = p.channel_id
+                WHERE p.channel_id = ANY(%s)
+                  AND p.post_date >= %s AND p.post_date < %s
+                  AND (p.digest_date IS NULL OR p.digest_date = %s)
+                ORDER BY p.post_date
+            ''', (list(channel_ids), utc_naive(start), utc_naive(end), digest_date))
+            
+            return [dict(row) for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"❌ Ошибка получения постов: {e}")
+            return []
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def mark_posts_in_digest(self, post_ids: List[int], digest_date: date):
+        """Отметить посты как вошедшие в дайджест"""
+        if not post_ids:
+            return
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                UPDATE news_posts SET included_in_digest = true, digest_date = %s
+                WHERE id = ANY(%s)
+            ''', (digest_date, list(post_ids)))
+            conn.commit()
+        except Exception as e:
+            print(f"❌ Ошибка отметки постов дайджеста: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def maintain_news_archive(self, retention_months: int = NEWS_POSTS_RETENTION_MONTHS) -> Dict:
+        """Создать секции на текущий и следующий месяц, свернуть и удалить секции старше срока хранения"""
+        today = datetime.now(timezone.utc).date()
+        cutoff = month_start(today, -retention_months)
+        result = {'compacted': [], 'posts': 0}
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            upcoming = [month_start(today), month_start(today, 1)]
+            cursor.execute('SELECT create_news_posts_partition(m) FROM unnest(%s::date[]) m', (upcoming,))
+            cursor.execute('''
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'news_posts'::regclass
+            ''')
+            partitions = sorted(row[0] for row in cursor.fetchall() if row[0].startswith(POSTS_PARTITION_PREFIX))
+            conn.commit()
+            self._post_partitions.update(upcoming)
+
+            # Каждая секция сворачивается отдельной транзакцией: сводка и удаление вместе или никак
+            for partition in partitions:
+                month = datetime.strptime(partition[len(POSTS_PARTITION_PREFIX):], '%Y_%m').date()
+                if month >= cutoff:
+                    continue
+                cursor.execute(sql.SQL('''
+                    INSERT INTO news_posts_monthly (month, channel_id, posts, digest_posts, views, forwards)
+                    SELECT %s, channel_id, COUNT(*), COUNT(*) FILTER (WHERE included_in_digest),
+                           COALESCE(SUM(views), 0), COALESCE(SUM(forwards), 0)
+                    FROM {} WHERE channel_id IS NOT NULL
+                    GROUP BY channel_id
+                    ON CONFLICT (month, channel_id) DO UPDATE SET
+                        posts = news_posts_monthly.posts + EXCLUDED.posts,
+                        digest_posts = news_posts_monthly.digest_posts + EXCLUDED.digest_posts,
+                        views = news_posts_monthly.views + EXCLUDED.views,
+                        forwards = news_posts_monthly.forwards + EXCLUDED.forwards,
+                        compacted_at = CURRENT_TIMESTAMP
+                ''').format(sql.Identifier(partition)), (month,))
+                cursor.execute(sql.SQL('SELECT COUNT(*) FROM {}').format(sql.Identifier(partition)))
+                posts = cursor.fetchone()[0]
+                cursor.execute(sql.SQL('DROP TABLE {}').format(sql.Identifier(partition)))
+                conn.commit()
+                self._post_partitions.discard(month)
+                result['compacted'].append(month)
+                result['posts'] += posts
+            return result
+        except Exception as e:
+            print(f"❌ Ошибка обслуживания архива постов: {e}")
+            conn.rollback()
+            return result
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def get_cached_summary(self, cache_key: str) -> Optional[Dict]:
+        """Найти готовую сводку по ключу кэша"""
+        conn = self._get_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        try:
+            cursor.execute('''
+                SELECT id, summary, digest_type, digest_date, posts_count
+                FROM news_digests WHERE cache_key = %s
+            ''', (cache_key,))
+            
+            row = cursor.fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"❌ Ошибка чтения кэша сводок: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def get_cached_completion(self, cache_key: str) -> Optional[str]:
+        """Найти ответ модели на отдельный вызов (промежуточную сводку)"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('SELECT response FROM llm_cache WHERE cache_key = %s', (cache_key,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            print(f"❌ Ошибка чтения кэша ответов модели: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def save_cached_completion(self, cache_key: str, response: str, model: str = None):
+        """Сохранить ответ модели на отдельный вызов"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT INTO llm_cache (cache_key, response, model)
+                VALUES (%s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    response = EXCLUDED.response,
+                    created_at = CURRENT_TIMESTAMP
+            ''', (cache_key, response, model))
+            conn.commit()
+        except Exception as e:
+            print(f"❌ Ошибка сохранения ответа модели в кэш: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def prune_completion_cache(self, retention_days: int = LLM_CACHE_RETENTION_DAYS) -> int:
+        """Удалить ответы модели старше срока хранения"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                DELETE FROM llm_cache WHERE created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'
+            ''', (retention_days,))
+            deleted = cursor.rowcount
+            conn.commit()
+            return deleted
+        except Exception as e:
+            print(f"❌ Ошибка очистки кэша ответов модели: {e}")
+            conn.rollback()
+            return 0
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def save_digest(self, cache_key: str, summary: str, digest_type: str, digest_date: date = None,
+                    posts_count: int = 0, model: str = None) -> Optional[int]:
+        """Сохранить сводку в news_digests, вернуть id записи"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT INTO news_digests (cache_key, summary, digest_type, digest_date, posts_count, model)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    summary = EXCLUDED.summary
+                RETURNING id
+            ''', (cache_key, summary, digest_type, digest_date, posts_count, model))
+            
+            digest_id = cursor.fetchone()[0]
+            conn.commit()
+            return digest_id
+        except Exception as e:
+            print(f"❌ Ошибка сохранения сводки: {e}")
+            conn.rollback()
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def claim_deliveries(self, digest_id: int, user_ids: List[int]) -> List[int]:
+        """Занять получателей дайджеста перед отправкой: записать им статус 'sending' и засчитать попытку.
+
+        Возвращает user_id, которых можно отправлять: без доставки и с оставшимися попытками.
+        Занятые, но так и не получившие итог (процесс упал во время отправки), при продолжении
+        рассылки пропускаются - лучше не доставить, чем отправить дважды. Ошибка записи пробрасывается.
+        """
+        if not user_ids:
+            return []
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT INTO newsletter_sends (digest_id, user_id, delivery_status, sent_at)
+                SELECT %s, user_id, 'sending', %s FROM unnest(%s::bigint[]) AS user_id
+                ON CONFLICT (digest_id, user_id) DO UPDATE SET
+                    delivery_status = 'sending',
+                    error_message = NULL,
+                    sent_at = EXCLUDED.sent_at,
+                    attempts = newsletter_sends.attempts + 1
+                WHERE newsletter_sends.delivery_status NOT IN ('sent', 'sending')
+                  AND newsletter_sends.attempts < %s
+                RETURNING user_id
+            ''', (digest_id, datetime.now(), list(user_ids), MAX_DELIVERY_ATTEMPTS))
+            claimed = [row[0] for row in cursor.fetchall()]
+            conn.commit()
+            return claimed
+        except Exception as e:
+            print(f"❌ Ошибка резервирования получателей дайджеста {digest_id}: {e}")
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def record_deliveries(self, digest_id: Optional[int], deliveries: List[tuple]):
+        """Записать итоги пачки отправок: (user_id, status, error_message).
+
+        Три set-based запроса в одной транзакции: взаимодействия и статистика доставленных,
+        деактивация недоступных, журнал newsletter_sends. Ошибка записи пробрасывается.
+        """
+        if not deliveries:
+            return
+
+        sent = [user_id for user_id, status, _ in deliveries if status == 'sent']
+        blocked = [user_id for user_id, status, _ in deliveries if status == 'blocked']
+        now = datetime.now()
+
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            if sent:
+                cursor.execute('''
+                    WITH touched AS (
+                        UPDATE users SET last_interaction = %s
+                        WHERE user_id = ANY(%s)
+                        RETURNING user_id
+                    )
+                    UPDATE user_stats SET
+                        messages_received = messages_received + 1,
+                        last_message_date = %s
+                    WHERE user_id IN (SELECT user_id FROM touched)
+                ''', (now, sent, now))
+            
+            if blocked:
+                cursor.execute('UPDATE users SET is_active = false WHERE user_id = ANY(%s)', (blocked,))
+            
+            execute_values(cursor, '''
+                INSERT INTO newsletter_sends (digest_id, user_id, delivery_status, error_message, sent_at)
+                VALUES %s
+                ON CONFLICT (digest_id, user_id) DO UPDATE SET
+                    delivery_status = EXCLUDED.delivery_status,
+                    error_message = EXCLUDED.error_message,
+                    sent_at = EXCLUDED.sent_at
+                WHERE newsletter_sends.delivery_status <> 'sent'
+            ''', [(digest_id, user_id, status, error, now) for user_id, status, error in deliveries],
+                page_size=BULK_PAGE_SIZE)
+            
+            if digest_id and sent:
+                cursor.execute('''
+                    UPDATE news_digests SET subscribers_sent = subscribers_sent + %s WHERE id = %s
+                ''', (len(sent), digest_id))
+            
+            conn.commit()
+        except Exception as e:
+            print(f"❌ Ошибка записи итогов рассылки: {e}")
+            conn.rollback()
+            # Вызывающий должен знать, что итоги не записаны: иначе рассылку закроют с потерями
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def get_digest(self, digest_id: int) -> Optional[Dict]:
+        """Получить запись дайджеста (состояние рассылки)"""
+        conn = self._get_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        try:
+            cursor.execute('''
+                SELECT id, digest_type, digest_date, posts_count, subscribers_sent, created_at, sent_at
+                FROM news_digests WHERE id = %s
+            ''', (digest_id,))
+            
+            row = cursor.fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"❌ Ошибка получения дайджеста {digest_id}: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def get_recipient_batch(self, after_user_id: int, limit: int, digest_id: int = None) -> List[int]:
+        """Следующая пачка активных пользователей по возрастанию user_id (keyset-пагинация).
+
+        Если указан digest_id, пропускаются пользователи, которым дайджест уже доставлен
+        или отправляется (claim_deliveries), и те, доставка которым не удалась MAX_DELIVERY_ATTEMPTS раз.
+        """
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            if digest_id:
+                cursor.execute('''
+                    SELECT u.user_id FROM users u
+                    WHERE u.is_active = true AND u.user_id > %s
+                      AND NOT EXISTS (
+                          SELECT 1 FROM newsletter_sends ns
+                          WHERE ns.digest_id = %s AND ns.user_id = u.user_id
+                            AND (ns.delivery_status IN ('sent', 'sending') OR ns.attempts >= %s)
+                      )
+                    ORDER BY u.user_id LIMIT %s
+                ''', (after_user_id, digest_id, MAX_DELIVERY_ATTEMPTS, limit))
+            else:
+                cursor.execute('''
+                    SELECT user_id FROM users
+                    WHERE is_active = true AND user_id > %s
+                    ORDER BY user_id LIMIT %s
+                ''', (after_user_id, limit))
+            return [row[0] for row in cursor.fetchall()]
+        except Exception as e:
+            print(f"❌ Ошибка получения пачки получателей: {e}")
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def get_unsent_digest(self, digest_type: str, digest_date: date) -> Optional[Dict]:
+        """Найти дайджест за дату, рассылка которого начата, но не завершена"""
+        conn = self._get_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        
+        try:
+            cursor.execute('''
+                SELECT id, summary, subscribers_sent FROM news_digests
+                WHERE digest_type = %s AND digest_date = %s AND sent_at IS NULL
+                ORDER BY created_at DESC LIMIT 1
+            ''', (digest_type, digest_date))
+            
+            row = cursor.fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"❌ Ошибка поиска незавершённой рассылки: {e}")
+            return None
+        finally:
+            cursor.close()
+            conn.close()
+    
+    def mark_digest_sent(self, digest_id: int):
+        """Отметить рассылку дайджеста завершённой"""
+        conn = self._get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('UPDATE news_digests SET sent_at = %s WHERE id = %s', (datetime.now(), digest_id))
+            conn.commit()
+        except Exception as e:
+            print(f"❌ Ошибка отметки рассылки дайджеста {digest_id}: {e}")
+            conn.rollback()
+        finally:
+            cursor.close()
+            conn.close()
+    
     def get_user_stats(self) -> Dict:
         """Получить общую статистику пользователей"""
         conn = self._get_connection()
         cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         try:
-            # Общее количество пользователей
-            cursor.execute('SELECT COUNT(*) as count FROM users WHERE is_active = true')
-            active_count = cursor.fetchone()['count']
+            # Счётчики поддерживаются триггером - чтение не зависит от размера таблицы
+            cursor.execute('SELECT name, value FROM user_counters')
+            counters = {row['name']: row['value'] for row in cursor.fetchall()}
             
-            cursor.execute('SELECT COUNT(*) as count FROM users')
-            total_count = cursor.fetchone()['count']
+            cursor.execute('''
+                SELECT subscribed, unsubscribed FROM user_daily_stats
+                WHERE day = (now() AT TIME ZONE 'utc')::date
+            ''')
+            today = cursor.fetchone() or {'subscribed': 0, 'unsubscribed': 0}
             
             # Последние активные пользователи
             cursor.execute('''
@@ -416,108 +947,71 @@ class PostgresDatabase:
             recent_users = cursor.fetchall()
             
             return {
-                'active_users': active_count,
-                'total_users': total_count,
+                'active_users': counters.get('active_users', 0),
+                'total_users': counters.get('total_users', 0),
+                'subscribed_today': today['subscribed'],
+                'unsubscribed_today': today['unsubscribed'],
                 'recent_users': recent_users
             }
         except Exception as e:
             print(f"❌ Ошибка получения статистики: {e}")
-            return {'active_users': 0, 'total_users': 0, 'recent_users': []}
+            return {'active_users': 0, 'total_users': 0, 'subscribed_today': 0,
+                    'unsubscribed_today': 0, 'recent_users': []}
         finally:
             cursor.close()
             conn.close()
     
-    def migrate_from_sqlite(self):
-        """Миграция данных из SQLite в PostgreSQL"""
-        print("🔄 Начинаю миграцию из SQLite в PostgreSQL...")
-        
-        sqlite_db = "users.db"
-        if not os.path.exists(sqlite_db):
-            print("❌ SQLite база данных не найдена")
-            return
+    def reconcile_user_counters(self) -> Dict:
+        """Пересчитать счётчики подписчиков по таблице users; возвращает найденное расхождение"""
+        conn = self._get_connection()
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
         
         try:
-            # Подключение к SQLite
-            sqlite_conn = sqlite3.connect(sqlite_db)
-            sqlite_conn.row_factory = sqlite3.Row
-            sqlite_cursor = sqlite_conn.cursor()
-            
-            # Миграция пользователей
-            sqlite_cursor.execute('SELECT * FROM users')
-            users = sqlite_cursor.fetchall()
-            
-            for user in users:
-                self.add_user(
-                    user['user_id'],
-                    user['username'],
-                    user['first_name'],
-                    user['last_name']
-                )
+            # Блокировка счётчиков ждёт текущие записи в users и держит новые до конца пересчёта
+            cursor.execute('SELECT name, value FROM user_counters FOR UPDATE')
+            stored = {row['name']: row['value'] for row in cursor.fetchall()}
             
-            print(f"✅ Мигрировано {len(users)} пользователей")
-            
-            # Миграция рекомендаций
-            sqlite_cursor.execute('SELECT * FROM channel_recommendations')
-            recommendations = sqlite_cursor.fetchall()
-            
-            for rec in recommendations:
-                self.add_channel_recommendation(rec['user_id'], rec['recommendation'])
-            
-            print(f"✅ Мигрировано {len(recommendations)} рекомендаций")
+            cursor.execute('''
+                SELECT COUNT(*) FILTER (WHERE is_active) AS active_users, COUNT(*) AS total_users
+                FROM users
+            ''')
+            actual = cursor.fetchone()
             
-            sqlite_conn.close()
+            drift = {}
+            for name in ('active_users', 'total_users'):
+                if stored.get(name) != actual[name]:
+                    drift[name] = actual[name] - (stored.get(name) or 0)
+                    cursor.execute('''
+                        INSERT INTO user_counters (name, value) VALUES (%s, %s)
+                        ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value
+                    ''', (name, actual[name]))
             
+            conn.commit()
+            if drift:
+                print(f"⚠️ Счётчики подписчиков исправлены: {drift}")
+            return drift
         except Exception as e:
-            print(f"❌ Ошибка миграции из SQLite: {e}")
-    
-    def migrate_from_json(self):
-        """Миграция данных из старых JSON файлов"""
-        print("🔄 Начинаю миграцию из JSON файлов...")
-        
-        # Миграция из subscribers.json
-        if os.path.exists("subscribers.json"):
-            try:
-                with open("subscribers.json", 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    subscribers = data.get('subscribers', [])
-                
-                for sub in subscribers:
-                    if isinstance(sub, dict):
-                        self.add_user(
-                            sub.get('user_id'),
-                            sub.get('username'),
-                            sub.get('first_name'),
-                            sub.get('last_name')
-                        )
-                    elif isinstance(sub, int):
-                        self.add_user(sub)
-                
-                print(f"✅ Мигрировано {len(subscribers)} пользователей из subscribers.json")
-            except Exception as e:
-                print(f"❌ Ошибка миграции subscribers.json: {e}")
-        
-        # Миграция каналов из channels.json
-        if os.path.exists("channels.json"):
-            try:
-                with open("channels.json", 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    channels = data.get('channels', [])
-                
-                for channel in channels:
-                    self.add_news_channel(channel)
-                
-                print(f"✅ Мигрировано {len(channels)} каналов из channels.json")
-            except Exception as e:
-                print(f"❌ Ошибка миграции channels.json: {e}")
+            print(f"❌ Ошибка сверки счётчиков: {e}")
+            conn.rollback()
+            return {}
+        finally:
+            cursor.close()
+            conn.close()
+
+def create_database() -> StorageBackend:
+    """Хранилище по DB_BACKEND: postgres (по умолчанию) или sqlite"""
+    if DB_BACKEND == 'sqlite':
+        from sqlite_database import SQLiteDatabase
+        return SQLiteDatabase()
+    if DB_BACKEND != 'postgres':
+        raise ValueError(f"❌ Неизвестный DB_BACKEND: {DB_BACKEND} (ожидается postgres или sqlite)")
+    return PostgresDatabase()
 
 # Глобальный экземпляр базы данных
-db = PostgresDatabase()
+db = create_database()
 
 if __name__ == "__main__":
-    # Миграция данных
-    db.migrate_from_sqlite()
-    db.migrate_from_json()
-    
+    # Перенос старых данных: python migrate.py
     stats = db.get_user_stats()
     print(f"\n📊 Статистика PostgreSQL:")
     print(f"   Активных пользователей: {stats['active_users']}")
@@ -0,0 +1,214 @@
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, List
+
+from storage import MAX_DELIVERY_ATTEMPTS, StorageBackend
+
+# Идентификаторы вне диапазона реальных пользователей и каналов Telegram; у каждого
+# прогона свой диапазон, чтобы повторный запуск на той же базе начинался с чистого листа
+BASE_ID = 9_000_000_000_000 + (time.time_ns() // 1000 % 10**9) * 10**5
+
+
+def open_backend(name: str, postgres_url: str = None, sqlite_path: str = None) -> StorageBackend:
+    """Создать хранилище для прогона, не трогая глобальный db из database.py"""
+    if name == 'sqlite':
+        from sqlite_database import SQLiteDatabase
+        return SQLiteDatabase(sqlite_path or os.path.join(tempfile.mkdtemp(), 'benchmark.db'))
+    os.environ['DATABASE_URL'] = postgres_url
+    os.environ['DB_BACKEND'] = 'postgres'
+    from database import PostgresDatabase
+    return PostgresDatabase()
+
+
+class ContractError(Exception):
+    """Хранилище ведёт себя не так, как ожидают боты"""
+
+
+def expect(actual, expected, what: str):
+    """Проверка поведения; в отличие от assert не отключается при python -O"""
+    if actual != expected:
+        raise ContractError(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+
+def check_contract(db: StorageBackend):
+    """Одинаковое поведение хранилищ на основных сценариях бота; расхождение - ContractError"""
+    user, other, flaky = BASE_ID + 1, BASE_ID + 2, BASE_ID + 5
+    channel = BASE_ID + 3
+    today = date.today()
+    now = datetime.now(timezone.utc)
+
+    expect(db.subscribe_user(user, 'bench'), 'new', "подписка нового пользователя")
+    expect(db.subscribe_user(user, 'bench'), 'already_subscribed', "повторная подписка")
+    db.remove_user(user)
+    expect(db.get_user_info(user)['is_active'], False, "отписка")
+    expect(db.subscribe_user(user, 'bench2'), 'reactivated', "подписка после отписки")
+    expect(db.get_user_info(user)['username'], 'bench2', "обновление username при подписке")
+    expect(db.subscribe_user(other), 'new', "подписка без username")
+    expect(db.subscribe_user(flaky), 'new', "подписка третьего пользователя")
+    expect(bool(db.record_interactions([(user, 3, datetime.now())])), True, "запись взаимодействий")
+    expect(user in db.get_active_users(), True, "пользователь среди активных")
+
+    db.sync_news_channels([{'id': channel, 'username': 'bench_channel', 'title': 'bench'}])
+    db.update_channel_watermarks({channel: 10})
+    db.update_channel_watermarks({channel: 5})
+    expect(db.get_channel_watermarks().get(channel), 10, "отметка канала не уменьшается")
+    expect(channel in db.get_channels_checked_since(now - timedelta(minutes=5)), True,
+           "канал среди недавно проверенных")
+
+    posts = [{'channel_id': channel, 'message_id': i, 'text': f'post {i}', 'date': now - timedelta(hours=i)}
+             for i in range(1, 4)]
+    expect(db.save_news_posts(posts), 3, "сохранение постов")
+    saved = db.get_news_posts([channel], now - timedelta(days=1), now, today)
+    expect([p['message_id'] for p in saved], [3, 2, 1], "посты по возрастанию даты")
+    db.mark_posts_in_digest([p['id'] for p in saved], today)
+    expect(len(db.get_news_posts([channel], now - timedelta(days=1), now, today)), 3,
+           "посты своего дайджеста остаются в выборке")
+    expect(db.get_news_posts([channel], now - timedelta(days=1), now, today + timedelta(days=1)), [],
+           "посты чужого дайджеста исключаются")
+    expect(db.save_news_posts([{'channel_id': channel, 'message_id': 99, 'text': 'old',
+                                'date': now - timedelta(days=400)}]), 0,
+           "посты старше срока хранения не сохраняются")
+    expect(isinstance(db.maintain_news_archive(retention_months=12)['compacted'], list), True,
+           "обслуживание архива постов")
+
+    key = f'bench-{time.time_ns()}'
+    digest_id = db.save_digest(key, 'summary', 'bench_check', today, 3)
+    expect(db.save_digest(key, 'summary 2', 'bench_check', today, 3), digest_id,
+           "повторное сохранение сводки с тем же ключом")
+    expect(db.get_cached_summary(key)['summary'], 'summary 2', "сводка из кэша")
+    expect(db.get_cached_completion(key), None, "кэш вызовов отделён от дайджестов")
+    db.save_cached_completion(key, 'partial', 'bench')
+    db.save_cached_completion(key, 'partial 2', 'bench')
+    expect(db.get_cached_completion(key), 'partial 2', "перезапись кэша вызовов")
+    expect(db.get_cached_summary(key)['summary'], 'summary 2', "кэш вызовов не трогает дайджест")
+    expect(db.prune_completion_cache(retention_days=0) >= 1, True, "очистка кэша вызовов")
+    expect(db.get_cached_completion(key), None, "кэш вызовов после очистки")
+    db.record_deliveries(digest_id, [(user, 'sent', None), (other, 'blocked', 'Forbidden: bot was blocked')])
+    db.record_deliveries(digest_id, [(user, 'failed', 'late retry')])
+    expect(db.get_digest(digest_id)['subscribers_sent'], 1, "счётчик доставленных")
+    expect(db.get_user_info(other)['is_active'], False, "деактивация заблокировавшего бота")
+    expect(user in db.get_recipient_batch(BASE_ID, 10, digest_id), False,
+           "получивший дайджест не попадает в продолжение рассылки")
+    expect(db.claim_deliveries(digest_id, [user, flaky]), [flaky], "занятие получателей")
+    # Занят, но итога нет (процесс упал во время отправки) - повторно не отправляем
+    expect(flaky in db.get_recipient_batch(BASE_ID, 10, digest_id), False,
+           "занятый без итога не попадает в продолжение рассылки")
+    expect(db.claim_deliveries(digest_id, [flaky]), [], "повторное занятие")
+    db.record_deliveries(digest_id, [(flaky, 'failed', 'timeout')])
+    for attempt in range(2, MAX_DELIVERY_ATTEMPTS + 1):
+        expect(flaky in db.get_recipient_batch(BASE_ID, 10, digest_id), True,
+               f"повтор после неудачи, попытка {attempt}")
+        expect(db.claim_deliveries(digest_id, [flaky]), [flaky], f"занятие для попытки {attempt}")
+        db.record_deliveries(digest_id, [(flaky, 'failed', 'timeout')])
+    expect(flaky in db.get_recipient_batch(BASE_ID, 10, digest_id), False,
+           "исчерпавший попытки не попадает в продолжение рассылки")
+    expect(db.claim_deliveries(digest_id, [flaky]), [], "занятие после исчерпания попыток")
+    unsent = db.get_unsent_digest('bench_check', today)
+    expect((unsent['id'], unsent['summary']), (digest_id, 'summary 2'), "незавершённая рассылка")
+    db.mark_digest_sent(digest_id)
+    expect(db.get_unsent_digest('bench_check', today), None, "завершённая рассылка")
+
+    expect(db.reconcile_user_counters(), {}, "счётчики подписчиков совпадают с таблицей")
+    stats = db.get_user_stats()
+    expect(stats['total_users'] >= 3 and stats['subscribed_today'] >= 3, True, "статистика подписчиков")
+
+
+def _timed(results: Dict[str, List[float]], name: str, func: Callable, *args):
+    began = time.perf_counter()
+    value = func(*args)
+    results.setdefault(name, []).append(time.perf_counter() - began)
+    return value
+
+
+def run_benchmark(db: StorageBackend, users: int, threads: int) -> Dict[str, List[float]]:
+    """Нагрузка, повторяющая работу бота: подписки, чтения, пакетные записи и рассылка"""
+    results: Dict[str, List[float]] = {}
+    ids = [BASE_ID + 1000 + i for i in range(users)]
+    channel = BASE_ID + 4
+    today = date.today()
+    now = datetime.now(timezone.utc)
+
+    for user_id in ids:
+        _timed(results, 'subscribe_user', db.subscribe_user, user_id, 'bench')
+    for user_id in ids:
+        _timed(results, 'get_user_info', db.get_user_info, user_id)
+    for i in range(0, users, 500):
+        _timed(results, 'record_interactions x500', db.record_interactions,
+               [(user_id, 2, datetime.now()) for user_id in ids[i:i + 500]])
+    for _ in range(100):
+        _timed(results, 'get_user_stats', db.get_user_stats)
+
+    after = BASE_ID
+    while True:
+        batch = _timed(results, 'get_recipient_batch x1000', db.get_recipient_batch, after, 1000)
+        if not batch:
+            break
+        after = batch[-1]
+
+    db.sync_news_channels([{'id': channel, 'username': 'bench_load', 'title': 'bench'}])
+    for i in range(0, 5000, 500):
+        _timed(results, 'save_news_posts x500', db.save_news_posts, [
+            {'channel_id': channel, 'message_id': n, 'text': f'post {n}', 'date': now - timedelta(seconds=n)}
+            for n in range(i, i + 500)
+        ])
+    for _ in range(20):
+        _timed(results, 'get_news_posts', db.get_news_posts, [channel], now - timedelta(days=1), now, today)
+
+    digest_id = db.save_digest(f'bench-load-{time.time_ns()}', 'summary', 'bench', today)
+    for i in range(0, users, 500):
+        _timed(results, 'record_deliveries x500', db.record_deliveries, digest_id,
+               [(user_id, 'sent', None) for user_id in ids[i:i + 500]])
+    db.mark_digest_sent(digest_id)
+
+    # Обработчики бота обращаются к базе из нескольких потоков одновременно
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda user_id: _timed(results, f'subscribe_user x{threads} потоков',
+                                             db.subscribe_user, user_id, 'bench'), ids))
+        list(pool.map(lambda user_id: _timed(results, f'get_user_info x{threads} потоков',
+                                             db.get_user_info, user_id), ids))
+    return results
+
+
+def print_report(backend: str, results: Dict[str, List[float]]):
+    print(f"\n📊 {backend}")
+    print(f"   {'операция':<36}{'вызовов':>8}{'всего, c':>10}{'оп/с':>10}{'p50, мс':>10}{'p95, мс':>10}")
+    for name, timings in results.items():
+        total = sum(timings)
+        ordered = sorted(timings)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        print(f"   {name:<36}{len(timings):>8}{total:>10.2f}{len(timings) / (total or 1e-9):>10.0f}"
+              f"{statistics.median(timings) * 1000:>10.2f}{p95 * 1000:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка и сравнение хранилищ PostgreSQL и SQLite")
+    parser.add_argument('--backend', choices=['sqlite', 'postgres', 'both'], default='sqlite')
+    parser.add_argument('--postgres-url', help="отдельная тестовая база: прогон оставляет в ней данные")
+    parser.add_argument('--sqlite-path', help="файл SQLite (по умолчанию временный)")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--check-only', action='store_true', help="только проверка поведения, без нагрузки")
+    args = parser.parse_args()
+
+    backends = ['sqlite', 'postgres'] if args.backend == 'both' else [args.backend]
+    if 'postgres' in backends and not args.postgres_url:
+        parser.error("для postgres укажите --postgres-url тестовой базы")
+
+    for name in backends:
+        db = open_backend(name, args.postgres_url, args.sqlite_path)
+        try:
+            check_contract(db)
+        except ContractError as e:
+            raise SystemExit(f"❌ {name}: {e}")
+        print(f"✅ {name}: проверка поведения пройдена")
+        if not args.check_only:
+            print_report(name, run_benchmark(db, args.users, args.threads))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable
+
+# Сколько секунд запись считается свежей
+CACHE_TTL = float(os.environ.get('DB_CACHE_TTL', '60'))
+# Сколько записей держим в памяти, самые давно использованные вытесняются
+CACHE_MAXSIZE = int(os.environ.get('DB_CACHE_MAXSIZE', '10000'))
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Потокобезопасный LRU-кэш с временем жизни записей и счётчиками попаданий"""
+
+    def __init__(self, maxsize: int = CACHE_MAXSIZE, ttl: float = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING:
+                value, expires = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.metrics['hits'] += 1
+                    return value
+                del self._data[key]
+            self.metrics['misses'] += 1
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.metrics['evictions'] += 1
+
+    def update(self, key: Hashable, **fields):
+        """Обновить поля закэшированного словаря на месте, не продлевая срок жизни"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                self._data[key] = (dict(item[0], **fields), item[1])
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self.metrics['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict:
+        """Метрики кэша: попадания, промахи, доля попаданий и размер"""
+        with self._lock:
+            m = dict(self.metrics)
+            m['size'] = len(self._data)
+        lookups = m['hits'] + m['misses']
+        m['hit_rate'] = m['hits'] / lookups if lookups else 0.0
+        return m
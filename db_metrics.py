@@ -0,0 +1,165 @@
+import functools
+import logging
+import signal
+import threading
+import time
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин гистограммы задержек, мс (последняя - всё, что дольше)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+_lock = threading.Lock()
+_methods: Dict[str, Dict] = {}
+# Стек вызовов текущего потока: к какому методу относить ожидание подключения и ошибки
+_local = threading.local()
+
+
+def _new_entry() -> Dict:
+    return {
+        'calls': 0, 'errors': 0, 'rows': 0,
+        'total': 0.0, 'max': 0.0,
+        'acquire_total': 0.0, 'acquire_max': 0.0,
+        'histogram': [0] * len(LATENCY_BUCKETS_MS),
+    }
+
+
+def _row_count(result) -> int:
+    """Сколько строк вернул метод: длина списка, 1 для записи, размер словаря id -> значение"""
+    if result is None or isinstance(result, bool):
+        return 0
+    if isinstance(result, (list, tuple, set)):
+        return len(result)
+    if isinstance(result, dict):
+        if result and all(isinstance(key, int) for key in result):
+            return len(result)
+        return 1 if result else 0
+    return 1
+
+
+def _stack() -> List[Dict]:
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def note_acquire(seconds: float):
+    """Учесть ожидание подключения для текущего метода базы"""
+    stack = _stack()
+    if stack:
+        stack[-1]['acquire'] += seconds
+
+
+def note_error():
+    """Отметить ошибку текущего метода, даже если он её перехватил и вернул пустой результат"""
+    stack = _stack()
+    if stack:
+        stack[-1]['failed'] = True
+
+
+def _record(name: str, elapsed: float, rows: int, call: Dict):
+    elapsed_ms = elapsed * 1000
+    with _lock:
+        entry = _methods.setdefault(name, _new_entry())
+        entry['calls'] += 1
+        entry['errors'] += int(call['failed'])
+        entry['rows'] += rows
+        entry['total'] += elapsed
+        entry['max'] = max(entry['max'], elapsed)
+        entry['acquire_total'] += call['acquire']
+        entry['acquire_max'] = max(entry['acquire_max'], call['acquire'])
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                entry['histogram'][i] += 1
+                break
+
+
+def instrument(name: str):
+    """Декоратор метода базы: число вызовов, гистограмма задержек, строки, ожидание подключения, ошибки"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            call = {'acquire': 0.0, 'failed': False}
+            stack = _stack()
+            stack.append(call)
+            began = time.perf_counter()
+            result = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            except BaseException:
+                call['failed'] = True
+                raise
+            finally:
+                stack.pop()
+                _record(name, time.perf_counter() - began, _row_count(result), call)
+        return wrapper
+    return decorator
+
+
+def instrumented(cls):
+    """Декоратор класса хранилища: оборачивает все его публичные методы"""
+    for attr, value in list(vars(cls).items()):
+        if not attr.startswith('_') and callable(value):
+            setattr(cls, attr, instrument(attr)(value))
+    return cls
+
+
+def _percentile(histogram: List[int], calls: int, fraction: float) -> float:
+    """Оценка перцентиля по гистограмме: верхняя граница корзины, мс"""
+    threshold = calls * fraction
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS_MS, histogram):
+        seen += count
+        if seen >= threshold:
+            return bound
+    return LATENCY_BUCKETS_MS[-1]
+
+
+def snapshot() -> Dict[str, Dict]:
+    """Метрики по методам: вызовы, ошибки, строки, задержки (среднее, p50/p95/p99, максимум)"""
+    with _lock:
+        methods = {name: dict(entry, histogram=list(entry['histogram'])) for name, entry in _methods.items()}
+    for entry in methods.values():
+        calls = entry['calls'] or 1
+        entry['avg_ms'] = entry['total'] / calls * 1000
+        entry['max_ms'] = entry['max'] * 1000
+        entry['acquire_avg_ms'] = entry['acquire_total'] / calls * 1000
+        entry['acquire_max_ms'] = entry['acquire_max'] * 1000
+        for label, fraction in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            entry[label] = _percentile(entry['histogram'], entry['calls'], fraction)
+        entry['histogram'] = dict(zip(LATENCY_BUCKETS_MS, entry['histogram']))
+    return methods
+
+
+def reset():
+    with _lock:
+        _methods.clear()
+
+
+def format_report(limit: int = None) -> str:
+    """Таблица методов по суммарному времени - самые горячие сверху"""
+    methods = sorted(snapshot().items(), key=lambda item: item[1]['total'], reverse=True)
+    if limit:
+        methods = methods[:limit]
+    lines = [f"{'метод':<30}{'вызовов':>9}{'ошибок':>8}{'строк':>9}{'всего, c':>10}"
+             f"{'ср, мс':>9}{'p95, мс':>9}{'макс, мс':>10}{'подкл, мс':>11}"]
+    for name, m in methods:
+        lines.append(
+            f"{name:<30}{m['calls']:>9}{m['errors']:>8}{m['rows']:>9}{m['total']:>10.2f}"
+            f"{m['avg_ms']:>9.1f}{m['p95_ms']:>9.0f}{m['max_ms']:>10.1f}{m['acquire_avg_ms']:>11.2f}"
+        )
+    return "\n".join(lines)
+
+
+def log_report(title: str = "Метрики базы данных"):
+    logger.info(f"[DB] {title}:\n{format_report()}")
+
+
+def install_dump_signal(signum: int = getattr(signal, 'SIGUSR1', None)):
+    """Печатать метрики по сигналу (kill -USR1 <pid>); вызывать из главного потока"""
+    if signum is None:
+        return
+    signal.signal(signum, lambda *_: log_report())
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+from typing import Dict
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INERROR
+from psycopg2.pool import ThreadedConnectionPool
+
+from db_metrics import note_error
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+# Сколько ждать свободное подключение, секунд
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '30'))
+# Подключения, простаивавшие дольше этого, проверяем запросом SELECT 1 при выдаче
+HEALTHCHECK_IDLE_SECONDS = 30.0
+
+
+class PoolTimeout(Exception):
+    """Не дождались свободного подключения в пуле"""
+
+
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул, а не закрывает"""
+
+    def __init__(self, pool: 'ConnectionPool', conn):
+        self._pool = pool
+        self._conn = conn
+        self._broken = False
+        self._released = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def _note_failed_transaction(self):
+        # Ошибочный запрос оставляет транзакцию в состоянии INERROR, даже если исключение перехвачено
+        if not self._conn.closed and self._conn.info.transaction_status == TRANSACTION_STATUS_INERROR:
+            note_error()
+
+    def rollback(self):
+        self._note_failed_transaction()
+        try:
+            self._conn.rollback()
+        except Exception:
+            # Откат не удался - подключение в пул не возвращаем
+            self._broken = True
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._note_failed_transaction()
+            self._pool.putconn(self._conn, broken=self._broken)
+
+
+class ConnectionPool:
+    """Пул подключений к PostgreSQL с ожиданием, проверкой здоровья и метриками"""
+
+    def __init__(self, dsn: str, minconn: int = DB_POOL_MIN, maxconn: int = DB_POOL_MAX,
+                 timeout: float = DB_POOL_TIMEOUT):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._pool = ThreadedConnectionPool(minconn, maxconn, dsn)
+        # ThreadedConnectionPool при исчерпании бросает ошибку - семафор даёт очередь ожидания
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self.metrics = {
+            'checkouts': 0, 'in_use': 0, 'timeouts': 0, 'health_checks': 0, 'discarded': 0,
+            'wait_total': 0.0, 'wait_max': 0.0, 'checkout_total': 0.0, 'checkout_max': 0.0,
+        }
+
+    def _healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < HEALTHCHECK_IDLE_SECONDS:
+            return True
+        with self._lock:
+            self.metrics['health_checks'] += 1
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self) -> PooledConnection:
+        began = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.metrics['timeouts'] += 1
+            raise PoolTimeout(f"нет свободного подключения за {self.timeout} c")
+        waited = time.monotonic() - began
+
+        try:
+            conn = self._pool.getconn()
+            while not self._healthy(conn):
+                self._discard(conn)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+        elapsed = time.monotonic() - began
+        with self._lock:
+            m = self.metrics
+            m['checkouts'] += 1
+            m['in_use'] += 1
+            m['wait_total'] += waited
+            m['wait_max'] = max(m['wait_max'], waited)
+            m['checkout_total'] += elapsed
+            m['checkout_max'] = max(m['checkout_max'], elapsed)
+        return PooledConnection(self, conn)
+
+    def _discard(self, conn):
+        with self._lock:
+            self.metrics['discarded'] += 1
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+    def putconn(self, conn, broken: bool = False):
+        try:
+            if not broken and not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                # Незавершённая транзакция не должна достаться следующему пользователю
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            if broken or conn.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            with self._lock:
+                self.metrics['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self) -> Dict:
+        """Метрики пула: число выдач, среднее и максимальное ожидание и время выдачи"""
+        with self._lock:
+            m = dict(self.metrics)
+        checkouts = m['checkouts'] or 1
+        m['wait_avg'] = m['wait_total'] / checkouts
+        m['checkout_avg'] = m['checkout_total'] / checkouts
+        m['max_size'] = self.maxconn
+        return m
+
+    def closeall(self):
+        self._pool.closeall()
@@ -0,0 +1,100 @@
+import hashlib
+import logging
+import os
+import random
+import re
+from typing import List, Dict
+
+logger = logging.getLogger(__name__)
+
+# Порог сходства Жаккара по шинглам, начиная с которого посты считаются одной новостью
+DUP_THRESHOLD = float(os.environ.get('DUP_THRESHOLD', '0.5'))
+SHINGLE_SIZE = 2
+LSH_BANDS = 16
+LSH_ROWS = 2
+NUM_PERM = LSH_BANDS * LSH_ROWS
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# Фиксированное зерно: кластеры (и ключ кэша сводки) не зависят от запуска
+_rng = random.Random(42)
+_PERMUTATIONS = [(_rng.randint(1, _MERSENNE_PRIME - 1), _rng.randint(0, _MERSENNE_PRIME - 1))
+                 for _ in range(NUM_PERM)]
+
+_URL_RE = re.compile(r'https?://\S+|t\.me/\S+')
+_WORD_RE = re.compile(r'\w+')
+
+
+def shingles(text: str) -> set:
+    """Множество словесных шинглов нормализованного текста"""
+    words = _WORD_RE.findall(_URL_RE.sub(' ', text.lower()))
+    if len(words) < SHINGLE_SIZE:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+
+
+def minhash(shingle_set: set) -> List[int]:
+    """MinHash-подпись множества шинглов"""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'big')
+              for s in shingle_set]
+    if not hashes:
+        return [_MAX_HASH] * NUM_PERM
+    return [min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def cluster_posts(posts: List[Dict], threshold: float = DUP_THRESHOLD) -> List[List[Dict]]:
+    """Сгруппировать почти одинаковые посты (MinHash + LSH, проверка кандидатов по Жаккару).
+
+    Возвращает кластеры в порядке первого поста каждого кластера.
+    """
+    shingle_sets = [shingles(p['content']) for p in posts]
+    parent = list(range(len(posts)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    buckets = {}
+    for i, sh in enumerate(shingle_sets):
+        if not sh:
+            continue
+        signature = minhash(sh)
+        for band in range(LSH_BANDS):
+            key = (band, tuple(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS]))
+            buckets.setdefault(key, []).append(i)
+
+    checked = set()
+    for members in buckets.values():
+        for x in range(len(members)):
+            for y in range(x + 1, len(members)):
+                i, j = members[x], members[y]
+                if (i, j) in checked or find(i) == find(j):
+                    continue
+                checked.add((i, j))
+                if jaccard(shingle_sets[i], shingle_sets[j]) >= threshold:
+                    parent[find(j)] = find(i)
+
+    clusters = {}
+    for i, post in enumerate(posts):
+        clusters.setdefault(find(i), []).append(post)
+    result = list(clusters.values())
+
+    if len(result) < len(posts):
+        logger.info(f"[INFO] Дедупликация: {len(posts)} постов -> {len(result)} новостей")
+    return result
+
+
+def format_cluster(cluster: List[Dict]) -> str:
+    """Выдержка кластера: самый полный текст и ссылки на все источники"""
+    representative = max(cluster, key=lambda p: len(p['content']))
+    links = [f"https://t.me/{p['username']}/{p['message_id']}" for p in cluster]
+    label = "Источник" if len(links) == 1 else "Источники"
+    return f"{representative['content']}\n{label}: {', '.join(links)}\n"
@@ -3,12 +3,15 @@ from telegram import Update
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 )
-import json
 import os
 from datetime import datetime, timedelta, timezone
-from database import db
+from async_database import adb
+from channel_registry import registry as channel_registry
+import db_metrics
 
 RECOMMEND_WAIT_INPUT = 1
+# Сколько апдейтов бот обрабатывает одновременно
+BOT_CONCURRENT_UPDATES = 32
 
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
@@ -37,105 +40,46 @@ def get_next_news_time():
         'formatted': next_run.strftime('%d.%m.%Y в %H:%M UTC')
     }
 
-def get_channels_list():
-    """Получить список каналов для агрегации"""
-    try:
-        with open("channels.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-            channels = data.get("channels", [])
-
-        if not channels:
-            return "📭 Список каналов временно пуст"
-
-        channel_names = []
-        for channel in channels:
-            if channel.get('username'):
-                channel_names.append(f"@{channel['username']}")
-            elif channel.get('title'):
-                channel_names.append(channel['title'])
-
-        return "\n".join([f"• {name}" for name in channel_names[:10]]) + \
-               (f"\n• и ещё {len(channel_names) - 10} каналов..." if len(channel_names) > 10 else "")
-    except Exception as e:
-        logger.error(f"Ошибка загрузки каналов: {e}")
-        return "📭 Ошибка загрузки списка каналов"
-
-def save_subscriber(user: Update.effective_user):
-    """Сохранить подписчика в базу данных с полной информацией"""
-    # Проверяем подключение к базе данных
+async def save_subscriber(user: Update.effective_user):
+    """Сохранить подписчика в базу данных одним запросом"""
+    logger.info(f"Собираем информацию о пользователе {user.id}: "
+               f"username=@{user.username}, name={user.first_name} {user.last_name}, "
+               f"lang={getattr(user, 'language_code', None)}, premium={getattr(user, 'is_premium', False)}")
+    
+    # Уже подтверждённый подписчик с прежними именем и username: взаимодействие уходит
+    # в буфер отложенной записи, иначе subscribe_user обновит профиль
+    if adb.is_known_active(user.id, user.username, user.first_name, user.last_name):
+        await adb.update_user_interaction(user.id)
+        return "already_subscribed"
+    
+    # Вставка/реактивация и учёт взаимодействия - один запрос, он же проверка доступности базы
     try:
-        test_stats = db.get_user_stats()
-        logger.info(f"База данных доступна: {test_stats['active_users']} активных пользователей")
+        result = await adb.subscribe_user(user.id, user.username, user.first_name, user.last_name)
     except Exception as e:
         logger.error(f"❌ Ошибка подключения к базе данных: {e}")
         return "error"
     
-    # Собираем максимально полную информацию о пользователе
-    user_data = {
-        'language_code': getattr(user, 'language_code', None),
-        'is_bot': getattr(user, 'is_bot', False),
-        'is_premium': getattr(user, 'is_premium', False),
-        'added_via_link': getattr(user, 'added_via_link', False),
-        'can_join_groups': getattr(user, 'can_join_groups', None),
-        'can_read_all_group_messages': getattr(user, 'can_read_all_group_messages', None),
-        'supports_inline_queries': getattr(user, 'supports_inline_queries', None),
-        'is_verified': getattr(user, 'is_verified', False),
-        'is_restricted': getattr(user, 'is_restricted', False),
-        'is_scam': getattr(user, 'is_scam', False),
-        'is_fake': getattr(user, 'is_fake', False),
-        'collected_at': datetime.now(timezone.utc).isoformat()
-    }
-    
-    # Логируем собранную информацию
-    logger.info(f"Собираем информацию о пользователе {user.id}: "
-               f"username=@{user.username}, name={user.first_name} {user.last_name}, "
-               f"lang={user_data['language_code']}, premium={user_data['is_premium']}, "
-               f"verified={user_data['is_verified']}")
-    
-    existing_user = db.get_user_info(user.id)
-    logger.info(f"save_subscriber: existing_user={existing_user}")
-    
-    # Если пользователь новый или был отписан - подписываем
-    if not existing_user or not existing_user.get('is_active', False):
-        logger.info(f"Попытка добавить пользователя {user.id} в базу данных...")
-        success = db.add_user(
-            user.id,
-            user.username,
-            user.first_name,
-            user.last_name,
-            user_data
-        )
-        logger.info(f"Результат db.add_user для {user.id}: {success}")
-        
-        if success:
-            action = "повторно подписан" if existing_user else "добавлен новый подписчик"
-            logger.info(f"{action}: {user.id} (@{user.username}) с полной информацией")
-            
-            # Проверяем что статус действительно обновился
-            updated_user = db.get_user_info(user.id)
-            logger.info(f"Проверка после обновления: is_active = {updated_user.get('is_active') if updated_user else 'None'}")
-            return "new_subscriber"  # Новый или повторно подписанный
-        else:
-            logger.error(f"❌ Ошибка добавления пользователя {user.id} в базу данных")
-            return "error"
-    else:
-        # Пользователь уже активен - просто обновляем информацию
-        db.update_user_interaction(user.id)
-        # Обновляем информацию пользователя на случай изменений
-        db.add_user(user.id, user.username, user.first_name, user.last_name, user_data)
+    if result is None:
+        logger.error(f"❌ Ошибка добавления пользователя {user.id} в базу данных")
+        return "error"
+    if result == "already_subscribed":
         return "already_subscribed"  # Уже подписан
+    
+    action = "повторно подписан" if result == "reactivated" else "добавлен новый подписчик"
+    logger.info(f"{action}: {user.id} (@{user.username})")
+    return "new_subscriber"  # Новый или повторно подписанный
 
-def remove_subscriber(user_id):
+async def remove_subscriber(user_id):
     """Удалить подписчика из базы данных"""
-    db.remove_user(user_id)
+    await adb.remove_user(user_id)
     logger.info(f"Пользователь {user_id} удалён из подписчиков.")
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    result = save_subscriber(user)
+    result = await save_subscriber(user)
 
     next_news = get_next_news_time()
-    channels_list = get_channels_list()
+    channels_list = channel_registry.preview
 
     if result == "new_subscriber":
         await update.message.reply_text(
@@ -168,10 +112,10 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    result = save_subscriber(user)
+    result = await save_subscriber(user)
 
     next_news = get_next_news_time()
-    channels_list = get_channels_list()
+    channels_list = channel_registry.preview
 
     if result == "new_subscriber":
         await update.message.reply_text(
@@ -189,7 +133,7 @@ async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    remove_subscriber(user.id)
+    await remove_subscriber(user.id)
     await update.message.reply_text("😢 Ты отписан от рассылки агрегации новостей про AI. Возвращайся, если что!")
 
 # --- Recommend Channel Conversation ---
@@ -207,7 +151,7 @@ async def recommend_channel_receive(update: Update, context: ContextTypes.DEFAUL
     text = update.message.text.strip()
 
     # Сохраняем в базу данных
-    db.add_channel_recommendation(user.id, text)
+    await adb.add_channel_recommendation(user.id, text)
 
     # Также сохраняем в текстовый файл для совместимости
     rec_info = (
@@ -226,26 +170,14 @@ async def recommend_channel_cancel(update: Update, context: ContextTypes.DEFAULT
     await update.message.reply_text("Рекомендация отменена.")
     return ConversationHandler.END
 
-# --- /channels: показать список каналов (читает channels.json) ---
+# --- /channels: показать список каналов (из памяти, файл перечитывается только при изменении) ---
 async def channels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        with open("channels.json", "r", encoding="utf-8") as f:
-            data = json.load(f)
-            channels = data.get("channels", [])
-        if not channels:
-            await update.message.reply_text("Список каналов пуст.")
-            return
-        msg = "Список каналов для агрегации:\n" + "\n".join(
-            f"@{c['username']}" if c.get('username') else c.get('title', '-') for c in channels
-        )
-        await update.message.reply_text(msg)
-    except Exception as e:
-        await update.message.reply_text(f"Не удалось получить список каналов: {e}")
+    await update.message.reply_text(channel_registry.full_list)
 
 # --- /status: статус подписки ---
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    user_info = db.get_user_info(user.id)
+    user_info = await adb.get_user_info(user.id)
     
     # Логируем для отладки
     logger.info(f"Проверка статуса пользователя {user.id}: user_info={user_info}")
@@ -254,7 +186,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Более строгая проверка: пользователь должен существовать И быть активным
     if user_info and user_info.get('is_active') == True:
-        stats = db.get_user_stats()
+        stats = await adb.get_user_stats()
         
         # Формируем расширенную информацию о пользователе
         premium_status = "💎 Premium" if user_info.get('is_premium') else "👤 Regular"
@@ -299,13 +231,14 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ У вас нет прав для просмотра статистики.")
         return
 
-    stats = db.get_user_stats()
+    stats = await adb.get_user_stats()
 
     message = f"""
 📊 **Статистика пользователей базы данных:**
 
 👥 Активных пользователей: {stats['active_users']}
 📋 Всего пользователей: {stats['total_users']}
+📈 За сегодня: +{stats['subscribed_today']} / −{stats['unsubscribed_today']}
 
 🕐 **Последние активные пользователи:**
 """
@@ -315,14 +248,46 @@ async def admin_stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         name = f"{first_name} {last_name}".strip()
         message += f"• @{username} ({name}) - {last_interaction}\n"
 
+    cache = adb.cache_stats()
+    message += (f"\n🗄 Кэш базы: попаданий {cache['hit_rate']:.0%} "
+                f"({cache['hits']}/{cache['hits'] + cache['misses']}), записей {cache['size']}\n")
+
+    # Самые затратные методы базы с момента запуска
+    hot = sorted(db_metrics.snapshot().items(), key=lambda item: item[1]['total'], reverse=True)[:5]
+    if hot:
+        message += "\n⏱ **Запросы к базе (по суммарному времени):**\n"
+        for name, m in hot:
+            message += (f"• {name}: {m['calls']} вызовов, ср. {m['avg_ms']:.1f} мс, "
+                        f"p95 ≤{m['p95_ms']:.0f} мс, ошибок {m['errors']}\n")
+
     await update.message.reply_text(message)
 
 
 
+async def on_startup(app):
+    await adb.start()
+    # Список каналов читается один раз при запуске, дальше - только после изменения файла
+    channel_registry.refresh(force=True)
+
+async def on_shutdown(app):
+    # Накопленные взаимодействия записываются до выхода, счётчики не теряются
+    await adb.close()
+
 def main():
     import config  # импортирует telegram_bot_token из твоего конфига
 
-    app = ApplicationBuilder().token(config.telegram_bot_token).build()
+    # kill -USR1 <pid> выводит в лог метрики запросов к базе
+    db_metrics.install_dump_signal()
+
+    # Апдейты обрабатываются параллельно: запросы к базе не блокируют друг друга
+    app = (
+        ApplicationBuilder()
+        .token(config.telegram_bot_token)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Основные команды
     app.add_handler(CommandHandler("start", start))
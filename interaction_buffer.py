@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Как часто сбрасываем накопленные взаимодействия в базу, секунд
+INTERACTION_FLUSH_INTERVAL = float(os.environ.get('INTERACTION_FLUSH_INTERVAL', '10'))
+# Сколько разных пользователей копим до внеочередного сброса
+INTERACTION_FLUSH_SIZE = int(os.environ.get('INTERACTION_FLUSH_SIZE', '1000'))
+
+
+class InteractionBuffer:
+    """Отложенная запись взаимодействий: повторные касания одного пользователя
+    склеиваются в памяти и уходят в базу одним пакетным запросом"""
+
+    def __init__(self, write: Callable[[List[Tuple[int, int, datetime]]], Awaitable[bool]],
+                 flush_interval: float = INTERACTION_FLUSH_INTERVAL,
+                 flush_size: int = INTERACTION_FLUSH_SIZE):
+        self._write = write
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        # user_id -> [число касаний, время последнего касания]
+        self._pending: Dict[int, list] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.metrics = {'touches': 0, 'flushes': 0, 'rows_written': 0, 'failed_flushes': 0}
+
+    async def touch(self, user_id: int, at: datetime = None):
+        at = at or datetime.now()
+        entry = self._pending.get(user_id)
+        if entry is None:
+            self._pending[user_id] = [1, at]
+        else:
+            entry[0] += 1
+            entry[1] = max(entry[1], at)
+        self.metrics['touches'] += 1
+        if len(self._pending) >= self.flush_size:
+            await self.flush()
+
+    def _merge_back(self, rows: List[Tuple[int, int, datetime]]):
+        """Вернуть неудачно записанную пачку в буфер, чтобы не потерять касания"""
+        for user_id, count, at in rows:
+            entry = self._pending.setdefault(user_id, [0, at])
+            entry[0] += count
+            entry[1] = max(entry[1], at)
+
+    async def flush(self):
+        async with self._flush_lock:
+            batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            rows = [(user_id, count, at) for user_id, (count, at) in batch.items()]
+            try:
+                ok = await self._write(rows)
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи взаимодействий: {e}")
+                ok = False
+            if ok:
+                self.metrics['flushes'] += 1
+                self.metrics['rows_written'] += len(rows)
+            else:
+                self.metrics['failed_flushes'] += 1
+                self._merge_back(rows)
+
+    async def _periodic_flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._periodic_flush())
+
+    async def close(self):
+        """Остановить таймер и записать всё накопленное"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self._pending:
+            logger.error(f"❌ При остановке не записаны взаимодействия {len(self._pending)} пользователей")
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from typing import List, Dict
+
+import openai
+from config import openai_api_key
+
+logger = logging.getLogger(__name__)
+
+# Адрес OpenAI-совместимого API (например, локальная заглушка llm_stub_server.py)
+LLM_BASE_URL = os.environ.get('OPENAI_BASE_URL')
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', '120'))
+LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '4'))
+# Сколько запросов к модели выполняется одновременно (на оба дайджеста)
+LLM_CONCURRENCY = int(os.environ.get('SUMMARY_CONCURRENCY', '4'))
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class AsyncLLMClient:
+    """Асинхронный клиент модели с общим соединением, ретраями и ограничением параллелизма"""
+
+    def __init__(self, api_key: str, base_url: str = None, timeout: float = LLM_TIMEOUT,
+                 max_retries: int = LLM_MAX_RETRIES, concurrency: int = LLM_CONCURRENCY):
+        # Ретраи делаем сами, чтобы добавить джиттер и учитывать Retry-After
+        self._client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=0)
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.stats = {'requests': 0, 'retries': 0, 'failures': 0, 'total_latency': 0.0}
+
+    @staticmethod
+    def _backoff(attempt: int, error: Exception) -> float:
+        """Экспоненциальная задержка с полным джиттером (или Retry-After от сервера)"""
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    async def complete(self, messages: List[Dict], model: str, max_tokens: int, temperature: float) -> str:
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._semaphore:
+                    began = time.monotonic()
+                    self.stats['requests'] += 1
+                    response = await self._client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature
+                    )
+                    self.stats['total_latency'] += time.monotonic() - began
+                return response.choices[0].message.content
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    self.stats['failures'] += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                self.stats['retries'] += 1
+                logger.warning(f"[WARN] Ошибка запроса к модели ({type(e).__name__}), повтор через {delay:.1f} c")
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        await self._client.close()
+
+
+_client = None
+
+def get_llm_client() -> AsyncLLMClient:
+    """Общий клиент модели на процесс"""
+    global _client
+    if _client is None:
+        _client = AsyncLLMClient(openai_api_key, base_url=LLM_BASE_URL)
+    return _client
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Нагрузочная проверка клиента модели')
+    parser.add_argument('--requests', type=int, default=20, help='Число запросов')
+    parser.add_argument('--model', default='gpt-4o-mini')
+    args = parser.parse_args()
+
+    async def run_load():
+        client = get_llm_client()
+        began = time.monotonic()
+        await asyncio.gather(*(
+            client.complete([{"role": "user", "content": f"ping {i}"}], args.model, 16, 0.0)
+            for i in range(args.requests)
+        ))
+        elapsed = time.monotonic() - began
+        print(f"✅ {args.requests} запросов за {elapsed:.2f} c ({args.requests / elapsed:.1f} req/s), "
+              f"статистика: {client.stats}")
+        await client.close()
+
+    asyncio.run(run_load())
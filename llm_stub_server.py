@@ -0,0 +1,55 @@
+"""Локальная заглушка OpenAI-совместимого API для офлайн-проверки суммаризации.
+
+Запуск:
+    python llm_stub_server.py --port 8089 --delay 2
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 python news_bot_part.py --once
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(self.delay)
+
+        prompt = request.get('messages', [{}])[-1].get('content', '')
+        body = json.dumps({
+            'id': 'stub-completion',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': f"[stub] сводка по {len(prompt)} символам"},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': len(prompt) // 3, 'completion_tokens': 8,
+                      'total_tokens': len(prompt) // 3 + 8},
+        }).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Заглушка OpenAI API')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--delay', type=float, default=0.0, help='Задержка ответа в секундах')
+    args = parser.parse_args()
+
+    StubHandler.delay = args.delay
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), StubHandler)
+    print(f"🤖 Заглушка LLM слушает http://127.0.0.1:{args.port}/v1")
+    server.serve_forever()
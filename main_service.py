@@ -8,6 +8,7 @@ from news_bot_part import run_continuous as news_service
 from sport_news_bot import run_sport_continuous as sport_news_service
 from get_users import main as user_bot
 from database import db
+from db_metrics import install_dump_signal
 
 # Настройка логирования
 logging.basicConfig(
@@ -21,9 +22,42 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Как часто сверяем счётчики подписчиков с таблицей users, часов
+COUNTERS_RECONCILE_HOURS = 6
+# Как часто обслуживаем архив постов (секции наперёд, свёртка старых месяцев), часов
+NEWS_ARCHIVE_MAINTENANCE_HOURS = 24
+
+async def reconcile_counters_loop():
+    """Периодически исправлять расхождение счётчиков подписчиков"""
+    while True:
+        try:
+            drift = await asyncio.to_thread(db.reconcile_user_counters)
+            if drift:
+                logger.warning(f"⚠️ Исправлено расхождение счётчиков подписчиков: {drift}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка сверки счётчиков: {e}")
+        await asyncio.sleep(COUNTERS_RECONCILE_HOURS * 3600)
+
+async def news_archive_loop():
+    """Периодически сворачивать посты старше срока хранения и чистить кэш ответов модели"""
+    while True:
+        try:
+            result = await asyncio.to_thread(db.maintain_news_archive)
+            if result['compacted']:
+                months = ', '.join(month.strftime('%Y-%m') for month in result['compacted'])
+                logger.info(f"🗜 Архив постов: свёрнуто {result['posts']} постов за {months}")
+            pruned = await asyncio.to_thread(db.prune_completion_cache)
+            if pruned:
+                logger.info(f"🗜 Кэш ответов модели: удалено {pruned} устаревших записей")
+        except Exception as e:
+            logger.error(f"❌ Ошибка обслуживания архива постов: {e}")
+        await asyncio.sleep(NEWS_ARCHIVE_MAINTENANCE_HOURS * 3600)
+
 async def main():
     """Главный сервис 24/7 который объединяет все боты"""
     logger.info("🚀 Запуск Main Service 24/7")
+    # kill -USR1 <pid> выводит в лог метрики запросов к базе
+    install_dump_signal()
     logger.info("📊 Проверка PostgreSQL подключения...")
 
     # Проверяем базу данных
@@ -69,6 +103,12 @@ async def main():
 
     user_bot_task = asyncio.create_task(run_user_bot_async())
     tasks.append(user_bot_task)
+
+    # 3. Сверка счётчиков подписчиков
+    tasks.append(asyncio.create_task(reconcile_counters_loop()))
+
+    # 4. Обслуживание архива постов
+    tasks.append(asyncio.create_task(news_archive_loop()))
     
     # Небольшая задержка для корректного запуска
     await asyncio.sleep(2)
@@ -78,7 +118,9 @@ async def main():
     logger.info("   - 📰 News Aggregator (рассылка в 09:00 UTC)")
     logger.info("   - 🏆 Sport News Aggregator для @avdovin (рассылка в 10:00 UTC)")
     logger.info("   - 👥 User Collection Bot (обработка команд)")
-    logger.info("   - 🗄️ PostgreSQL Database")
+    logger.info("   - 🗄️ PostgreSQL Database (метрики запросов: kill -USR1 <pid>)")
+    logger.info(f"   - 🔢 Сверка счётчиков подписчиков (каждые {COUNTERS_RECONCILE_HOURS} ч)")
+    logger.info(f"   - 🗜 Архив постов (каждые {NEWS_ARCHIVE_MAINTENANCE_HOURS} ч)")
 
     # Ожидаем завершения всех задач
     try:
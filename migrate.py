@@ -0,0 +1,356 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    from psycopg2.extras import execute_values
+except ImportError:
+    # Перенос пишет только в PostgreSQL; без psycopg2 доступен лишь шаг channels
+    execute_values = None
+
+from channel_registry import load_channels
+from database import db, BULK_PAGE_SIZE, PostgresDatabase
+from storage import DB_BACKEND
+
+# Сколько строк источника читаем и пишем за одну транзакцию
+MIGRATION_CHUNK_SIZE = int(os.environ.get('MIGRATION_CHUNK_SIZE', '5000'))
+
+SQLITE_PATH = "users.db"
+SUBSCRIBERS_PATH = "subscribers.json"
+CHANNELS_PATH = "channels.json"
+
+# Чтение пачки: (после какого ключа, сколько) -> [(ключ, значения для вставки)]
+Reader = Callable[[int, int], List[Tuple[int, tuple]]]
+
+
+class MigrationStep:
+    """Один переносимый источник: чтение пачками по возрастанию ключа и пакетная вставка"""
+
+    def __init__(self, name: str, read: Reader, count: Callable[[], int], insert_sql: str,
+                 template: str, present_sql: Optional[str] = None, companion_sql: Optional[str] = None):
+        self.name = name
+        self.read = read
+        self.count = count
+        self.insert_sql = insert_sql
+        self.template = template
+        # Запрос для сверки: сколько user_id из пачки (первое значение строки) есть в PostgreSQL
+        self.present_sql = present_sql
+        # Запрос с user_id пачки в той же транзакции, что и вставка (связанные строки других таблиц)
+        self.companion_sql = companion_sql
+
+
+USERS_INSERT = '''
+    INSERT INTO users (user_id, username, first_name, last_name, full_name,
+                       added_at, is_active, last_interaction)
+    VALUES %s
+    ON CONFLICT (user_id) DO NOTHING
+    RETURNING user_id
+'''
+USERS_TEMPLATE = '(%s, %s, %s, %s, %s, %s, %s, %s)'
+USERS_PRESENT = 'SELECT COUNT(*) FROM users WHERE user_id = ANY(%s)'
+# Строка user_stats, как у add_user: без неё record_deliveries и статистика не учитывают пользователя
+USERS_STATS = '''
+    INSERT INTO user_stats (user_id, messages_received, last_message_date)
+    SELECT user_id, 0, NULL FROM users WHERE user_id = ANY(%s)
+    ON CONFLICT (user_id) DO NOTHING
+'''
+
+
+def _user_values(user_id: int, username=None, first_name=None, last_name=None,
+                 added_at=None, is_active=True, last_interaction=None) -> tuple:
+    """Строка users в том же виде, что пишет add_user"""
+    now = datetime.now()
+    full_name = f"{first_name or ''} {last_name or ''}".strip()
+    return (user_id, username or "-", first_name or "-", last_name or "-", full_name,
+            added_at or now, bool(is_active), last_interaction or now)
+
+
+def sqlite_steps(path: str) -> List[MigrationStep]:
+    """Шаги переноса старой базы users.db: пользователи, статистика, рекомендации"""
+    conn = sqlite3.connect(path)
+    # Время для рекомендаций без даты: одно и то же при каждом запуске, иначе повторный
+    # перенос не совпал бы по естественному ключу и вставил дубли
+    undated = datetime.fromtimestamp(os.path.getmtime(path))
+
+    def count(sql):
+        return lambda: conn.execute(sql).fetchone()[0]
+
+    def read_users(after, limit):
+        rows = conn.execute('''
+            SELECT user_id, username, first_name, last_name, added_at, is_active, last_interaction
+            FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?
+        ''', (after, limit)).fetchall()
+        return [(row[0], _user_values(*row)) for row in rows]
+
+    def read_stats(after, limit):
+        # В старой базе у user_stats нет уникального ключа - строки одного пользователя складываем
+        rows = conn.execute('''
+            SELECT user_id, SUM(COALESCE(messages_received, 0)), MAX(last_message_date)
+            FROM user_stats WHERE user_id > ? GROUP BY user_id ORDER BY user_id LIMIT ?
+        ''', (after, limit)).fetchall()
+        return [(row[0], row) for row in rows]
+
+    def read_recommendations(after, limit):
+        rows = conn.execute('''
+            SELECT id, user_id, recommendation, created_at
+            FROM channel_recommendations WHERE id > ? ORDER BY id LIMIT ?
+        ''', (after, limit)).fetchall()
+        return [(row[0], (row[1], row[2], row[3] or undated)) for row in rows]
+
+    return [
+        MigrationStep(
+            'sqlite.users', read_users, count('SELECT COUNT(*) FROM users'),
+            USERS_INSERT, USERS_TEMPLATE, USERS_PRESENT, USERS_STATS,
+        ),
+        MigrationStep(
+            'sqlite.user_stats', read_stats, count('SELECT COUNT(DISTINCT user_id) FROM user_stats'),
+            '''
+                INSERT INTO user_stats (user_id, messages_received, last_message_date)
+                SELECT v.user_id, v.messages_received, v.last_message_date
+                FROM (VALUES %s) AS v (user_id, messages_received, last_message_date)
+                WHERE EXISTS (SELECT 1 FROM users u WHERE u.user_id = v.user_id)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    messages_received = EXCLUDED.messages_received,
+                    last_message_date = EXCLUDED.last_message_date
+                -- Заполняем только пустые строки, созданные шагом users; накопленное ботом не трогаем
+                WHERE user_stats.messages_received = 0
+                RETURNING user_id
+            ''',
+            '(%s::bigint, %s::integer, %s::timestamp)',
+            'SELECT COUNT(*) FROM user_stats WHERE user_id = ANY(%s)',
+        ),
+        MigrationStep(
+            'sqlite.channel_recommendations', read_recommendations,
+            count('SELECT COUNT(*) FROM channel_recommendations'),
+            '''
+                INSERT INTO channel_recommendations (user_id, recommendation, created_at)
+                SELECT v.user_id, v.recommendation, v.created_at
+                FROM (VALUES %s) AS v (user_id, recommendation, created_at)
+                WHERE EXISTS (SELECT 1 FROM users u WHERE u.user_id = v.user_id)
+                ON CONFLICT (user_id, md5(recommendation), created_at) DO NOTHING
+                RETURNING id
+            ''',
+            '(%s::bigint, %s::text, %s::timestamp)',
+        ),
+    ]
+
+
+def json_steps(path: str) -> List[MigrationStep]:
+    """Шаг переноса subscribers.json; ключ - позиция записи в файле"""
+    with open(path, 'r', encoding='utf-8') as f:
+        subscribers = json.load(f).get('subscribers', [])
+
+    def read(after, limit):
+        rows = []
+        for position, sub in enumerate(subscribers[after:after + limit], start=after + 1):
+            if isinstance(sub, dict) and sub.get('user_id'):
+                values = _user_values(sub['user_id'], sub.get('username'),
+                                      sub.get('first_name'), sub.get('last_name'))
+            elif isinstance(sub, int):
+                values = _user_values(sub)
+            else:
+                continue
+            rows.append((position, values))
+        # Пропущенные записи не должны обрывать чтение: ключ последней позиции пачки
+        if not rows and after + limit < len(subscribers):
+            rows.append((after + limit, None))
+        return rows
+
+    return [MigrationStep('json.subscribers', read, lambda: len(subscribers),
+                          USERS_INSERT, USERS_TEMPLATE, USERS_PRESENT, USERS_STATS)]
+
+
+class Migrator:
+    """Перенос пачками с контрольными точками в PostgreSQL: прерванный перенос продолжается"""
+
+    def __init__(self, database=db, chunk_size: int = MIGRATION_CHUNK_SIZE):
+        # Пакетная вставка, контрольные точки и сверка написаны на SQL PostgreSQL
+        if not isinstance(database, PostgresDatabase):
+            raise ValueError(f"❌ Перенос пачками поддерживается только для PostgreSQL, "
+                             f"а хранилище - {type(database).__name__}")
+        self.db = database
+        self.chunk_size = chunk_size
+
+    def _checkpoint(self, name: str, restart: bool) -> Dict:
+        conn = self.db._get_connection()
+        cursor = conn.cursor()
+        try:
+            if restart:
+                cursor.execute('DELETE FROM migration_checkpoints WHERE source = %s', (name,))
+            cursor.execute('''
+                INSERT INTO migration_checkpoints (source) VALUES (%s)
+                ON CONFLICT (source) DO NOTHING
+            ''', (name,))
+            cursor.execute('''
+                SELECT last_key, rows_read, rows_written, finished_at
+                FROM migration_checkpoints WHERE source = %s
+            ''', (name,))
+            last_key, rows_read, rows_written, finished_at = cursor.fetchone()
+            conn.commit()
+            return {'last_key': last_key, 'rows_read': rows_read,
+                    'rows_written': rows_written, 'finished_at': finished_at}
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _write_chunk(self, step: MigrationStep, chunk: List[Tuple[int, tuple]]) -> int:
+        """Записать пачку и сдвинуть контрольную точку в одной транзакции"""
+        rows = [values for _, values in chunk if values is not None]
+        conn = self.db._get_connection()
+        cursor = conn.cursor()
+        try:
+            written = 0
+            if rows:
+                inserted = execute_values(cursor, step.insert_sql, rows, template=step.template,
+                                          page_size=BULK_PAGE_SIZE, fetch=True)
+                written = len(inserted)
+                if step.companion_sql:
+                    cursor.execute(step.companion_sql, ([values[0] for values in rows],))
+            cursor.execute('''
+                UPDATE migration_checkpoints SET
+                    last_key = %s,
+                    rows_read = rows_read + %s,
+                    rows_written = rows_written + %s,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE source = %s
+            ''', (chunk[-1][0], len(rows), written, step.name))
+            conn.commit()
+            return written
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _finish(self, name: str):
+        conn = self.db._get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('''
+                UPDATE migration_checkpoints SET finished_at = CURRENT_TIMESTAMP WHERE source = %s
+            ''', (name,))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _count_present(self, step: MigrationStep) -> Optional[int]:
+        """Сколько строк источника есть в PostgreSQL - для итоговой сверки"""
+        if not step.present_sql:
+            return None
+        present = 0
+        after = 0
+        conn = self.db._get_connection()
+        cursor = conn.cursor()
+        try:
+            while True:
+                chunk = step.read(after, self.chunk_size)
+                if not chunk:
+                    break
+                ids = [values[0] for _, values in chunk if values is not None]
+                if ids:
+                    cursor.execute(step.present_sql, (ids,))
+                    present += cursor.fetchone()[0]
+                after = chunk[-1][0]
+            conn.rollback()
+            return present
+        finally:
+            cursor.close()
+            conn.close()
+
+    def run_step(self, step: MigrationStep, restart: bool = False) -> Dict:
+        total = step.count()
+        checkpoint = self._checkpoint(step.name, restart)
+        if checkpoint['finished_at'] and not restart:
+            print(f"⏭️ {step.name}: уже перенесено {checkpoint['finished_at']} (--restart для повтора)")
+        else:
+            after = checkpoint['last_key']
+            if after:
+                print(f"🔄 {step.name}: продолжаем после ключа {after} "
+                      f"({checkpoint['rows_read']} из {total} уже прочитано)")
+            else:
+                print(f"🔄 {step.name}: переносим {total} строк")
+
+            began = time.monotonic()
+            read = written = 0
+            while True:
+                chunk = step.read(after, self.chunk_size)
+                if not chunk:
+                    break
+                written += self._write_chunk(step, chunk)
+                read += sum(1 for _, values in chunk if values is not None)
+                after = chunk[-1][0]
+                elapsed = time.monotonic() - began
+                print(f"   {step.name}: {checkpoint['rows_read'] + read}/{total} строк, "
+                      f"{read / (elapsed or 1e-9):.0f} строк/с")
+            self._finish(step.name)
+
+            elapsed = time.monotonic() - began
+            print(f"✅ {step.name}: прочитано {read}, вставлено {written} "
+                  f"(остальные уже были в базе или без пользователя) за {elapsed:.1f} c, "
+                  f"{read / (elapsed or 1e-9):.0f} строк/с")
+            checkpoint = self._checkpoint(step.name, restart=False)
+
+        present = self._count_present(step)
+        report = {'source': step.name, 'source_rows': total, 'rows_read': checkpoint['rows_read'],
+                  'rows_written': checkpoint['rows_written'], 'present': present}
+        if present is None:
+            print(f"📊 Сверка {step.name}: в источнике {total}, вставлено {checkpoint['rows_written']}")
+        else:
+            mark = "✅" if present == total else "⚠️"
+            print(f"📊 Сверка {step.name}: в источнике {total}, в PostgreSQL {present} {mark}")
+        return report
+
+    def run(self, steps: List[MigrationStep], restart: bool = False) -> List[Dict]:
+        return [self.run_step(step, restart) for step in steps]
+
+
+def migrate_channels(path: str = CHANNELS_PATH):
+    """Каналы из channels.json: их мало, одна пакетная вставка без контрольных точек"""
+    channels = load_channels(path)
+    db.sync_news_channels(channels)
+    print(f"✅ Мигрировано {len(channels)} каналов из {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Перенос старых данных в PostgreSQL пачками с продолжением")
+    parser.add_argument('source', choices=['sqlite', 'json', 'channels', 'all'], nargs='?', default='all')
+    parser.add_argument('--sqlite-path', default=SQLITE_PATH)
+    parser.add_argument('--json-path', default=SUBSCRIBERS_PATH)
+    parser.add_argument('--channels-path', default=CHANNELS_PATH)
+    parser.add_argument('--chunk-size', type=int, default=MIGRATION_CHUNK_SIZE)
+    parser.add_argument('--restart', action='store_true', help="начать заново, игнорируя контрольные точки")
+    args = parser.parse_args()
+
+    migrator = None
+    if args.source != 'channels':
+        # Каналы переносятся методами хранилища, остальное - только в PostgreSQL
+        if not isinstance(db, PostgresDatabase):
+            raise SystemExit(f"❌ Перенос users.db и subscribers.json поддерживается только для PostgreSQL "
+                             f"(DB_BACKEND={DB_BACKEND}). Задайте DB_BACKEND=postgres и DATABASE_URL "
+                             f"или перенесите только каналы: python migrate.py channels")
+        migrator = Migrator(chunk_size=args.chunk_size)
+    if args.source in ('sqlite', 'all'):
+        if os.path.exists(args.sqlite_path):
+            migrator.run(sqlite_steps(args.sqlite_path), args.restart)
+        else:
+            print(f"❌ SQLite база данных не найдена: {args.sqlite_path}")
+    if args.source in ('json', 'all'):
+        if os.path.exists(args.json_path):
+            migrator.run(json_steps(args.json_path), args.restart)
+        else:
+            print(f"❌ Файл не найден: {args.json_path}")
+    if args.source in ('channels', 'all'):
+        if os.path.exists(args.channels_path):
+            migrate_channels(args.channels_path)
+        else:
+            print(f"❌ Файл не найден: {args.channels_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,21 @@
 from telethon import TelegramClient
 from telegram import Bot
-import openai
-from config import api_id, api_hash, telegram_bot_token, openai_api_key, FOLDER_NAME
+from config import api_id, api_hash, telegram_bot_token, FOLDER_NAME
 import asyncio
 from datetime import datetime, timedelta, timezone
 import json
 import os
 import logging
 
-from get_channels import get_channels_fullinfo_from_folder, load_channels_from_json
+from get_channels import get_channels_fullinfo_from_folder
+from channel_registry import CHANNELS_FILE, load_channels
+from news_fetcher import ingest_channels, load_digest_posts
+from dedup import cluster_posts
+from prompt_packer import pack_clusters, channel_weights
+from summarizer import summarize, BATCH_TOKEN_BUDGET
+from broadcast import Broadcaster, DeliveryRecorder, stream_recipients
 from database import db
+import db_metrics
 
 # Настройка логирования
 logging.basicConfig(
@@ -22,100 +28,81 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def load_subscribers():
-    """Загрузить список активных подписчиков из PostgreSQL"""
-    try:
-        return db.get_active_users()
-    except Exception as e:
-        logger.error(f"[ERROR] Ошибка загрузки подписчиков из PostgreSQL: {e}")
-        return []
-        logger.error(f"[ERROR] Ошибка чтения {SUBSCRIBERS_FILE}: {e}")
-        return []
-
-# Миграция больше не нужна - данные в PostgreSQL
-
 def get_yesterday_range():
     today = datetime.now(timezone.utc).date()
     start = datetime.combine(today - timedelta(days=1), datetime.min.time(), tzinfo=timezone.utc)
     end = datetime.combine(today, datetime.min.time(), tzinfo=timezone.utc)
     return start, end
 
-def summarize_news(news_list):
-    text = "\n\n".join(news_list)
-    # Ограничиваем входной текст до ~15000 токенов (примерно 60000 символов)
-    if len(text) > 60000:
-        text = text[:60000] + "\n[...текст обрезан для соответствия лимитам...]"
-    
-    client_ai = openai.OpenAI(api_key=openai_api_key)
-    response = client_ai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "Сделай краткую сводку новостей за сутки по этим выдержкам, обязательно указывай источники. Если несколько новостей про одно и то же - кластеризуй в один пункт. Подробнее освещай всё про AI."},
-            {"role": "user", "content": text}
-        ],
-        max_tokens=6000,
-        temperature=0.7
-    )
-    return response.choices[0].message.content
+NEWS_SYSTEM_PROMPT = "Сделай краткую сводку новостей за сутки по этим выдержкам, обязательно указывай источники. Если несколько новостей про одно и то же - кластеризуй в один пункт. Подробнее освещай всё про AI."
+
+async def summarize_news(clusters, weights=None, digest_date=None):
+    packed = pack_clusters(clusters, weights or {}, BATCH_TOKEN_BUDGET)
+    digest = await summarize(packed['batches'], NEWS_SYSTEM_PROMPT, 'news', digest_date)
+    # Не вошедшие в бюджет посты останутся для следующего дайджеста
+    digest['post_ids'] = [p['id'] for c in packed['selected'] for p in c]
+    return digest
 
 async def get_news(client, channels):
-    all_news = []
+    """Дочитать новые посты каналов в news_posts и вернуть посты за вчера из базы"""
     start, end = get_yesterday_range()
     print(f"[DEBUG] Диапазон фильтра: {start} ... {end}")
-    for channel_info in channels:
-        username = channel_info.get("username")
-        if not username:
-            continue
-        async for message in client.iter_messages(username):
-            msg_date = message.date
-            if msg_date.tzinfo is None:
-                msg_date = msg_date.replace(tzinfo=timezone.utc)
-            msg_date_norm = msg_date.replace(microsecond=0)
-            if msg_date_norm < start:
-                break
-            if start <= msg_date_norm < end and message.text:
-                all_news.append(f"{message.text}\nИсточник: https://t.me/{username}/{message.id}\n")
-                print(f"[DEBUG] {username} | id={message.id} | дата={msg_date_norm} - добавлено")
-    return all_news
-
-async def send_news(summary):
-    # Получаем только активных пользователей
-    subscribers = db.get_active_users()
-    if not subscribers:
-        logger.warning("[WARN] Нет активных подписчиков для рассылки.")
-        return
+    await ingest_channels(client, channels, start, end)
+    return await asyncio.to_thread(load_digest_posts, channels, end, start.date())
+
+async def send_news(summary, digest_id=None):
+    if digest_id:
+        digest = await asyncio.to_thread(db.get_digest, digest_id)
+        if digest and digest['sent_at']:
+            logger.info(f"[INFO] Дайджест {digest_id} уже разослан {digest['sent_at']}, пропускаю")
+            return
+        if digest and digest['subscribers_sent']:
+            # Повторный запуск продолжает рассылку: только активные пользователи без доставки
+            logger.info(f"[INFO] Продолжаю рассылку дайджеста {digest_id}: "
+                        f"уже доставлено {digest['subscribers_sent']}")
 
     bot = Bot(token=telegram_bot_token)
-    successful_sends = 0
-    failed_subscribers = []
-
-    logger.info(f"[INFO] Начинаю рассылку для {len(subscribers)} активных подписчиков")
-
-    for user_id in subscribers:
-        try:
-            result = await bot.send_message(chat_id=user_id, text=summary)
-            logger.info(f"[SUCCESS] Сообщение отправлено пользователю {user_id}, message_id={result.message_id}")
-            # Обновляем статистику взаимодействия
-            db.update_user_interaction(user_id)
-            successful_sends += 1
-        except Exception as e:
-            error_msg = str(e)
-            logger.error(f"[FAILED] Не удалось отправить сообщение пользователю {user_id}: {error_msg}")
-            failed_subscribers.append(user_id)
 
-            # Деактивируем пользователя только при определенных ошибках
-            if "Chat not found" in error_msg or "Forbidden: bot was blocked" in error_msg:
-                db.remove_user(user_id)
-                logger.info(f"[INFO] Пользователь {user_id} деактивирован из-за недоступности чата")
+    logger.info("[INFO] Начинаю рассылку активным подписчикам")
 
-    logger.info(f"[INFO] Рассылка завершена: успешно={successful_sends}, неудачно={len(failed_subscribers)}")
+    # Подписчики читаются из базы пачками по мере отправки и занимаются в журнале доставки до отправки;
+    # статистика взаимодействий, деактивации и итоги доставки пишутся пачками.
+    # Если итоги не удалось записать, исключение выходит отсюда и рассылка остаётся открытой
+    async with DeliveryRecorder(db, digest_id) as recorder:
+        stats = await Broadcaster(bot).run(stream_recipients(db, digest_id), summary,
+                                           on_result=recorder.record, before_send=recorder.claim)
+    db_metrics.log_report("Метрики базы данных после рассылки")
 
-    if failed_subscribers:
-        logger.warning(f"[INFO] Проблемы с отправкой {len(failed_subscribers)} пользователям")
+    total = stats['sent'] + stats['failed'] + stats['blocked']
+    if not total:
+        logger.warning("[WARN] Нет активных подписчиков для рассылки.")
+    failed = stats['failed'] + stats['blocked']
+    if failed:
+        logger.warning(f"[INFO] Проблемы с отправкой {failed} пользователям")
+
+    if digest_id:
+        # Временные ошибки повторит продолжение рассылки в run_continuous - дайджест не закрываем,
+        # пока есть получатели без доставки, не исчерпавшие MAX_DELIVERY_ATTEMPTS попыток
+        remaining = await asyncio.to_thread(db.get_recipient_batch, 0, 1, digest_id)
+        if remaining:
+            raise RuntimeError(f"Рассылка дайджеста {digest_id} не завершена: "
+                               f"{stats['failed'] + stats['errors']} получателей без доставки, продолжу позже")
+        await asyncio.to_thread(db.mark_digest_sent, digest_id)
 
 SESSION_FILE = 'sessions/news_session'
+# Сколько раз подряд продолжаем прерванную рассылку, не дожидаясь следующего дня
+MAX_RESUME_ATTEMPTS = 3
 
 async def main():
+    # Незавершённую рассылку продолжаем с сохранённой сводкой под тем же digest_id: повторный сбор
+    # постов мог бы дать другой набор, новую сводку и второй дайджест тем, кто уже получил первый
+    digest_date = get_yesterday_range()[0].date()
+    unsent = await asyncio.to_thread(db.get_unsent_digest, 'news', digest_date)
+    if unsent:
+        logger.info(f"🔁 Продолжаю рассылку дайджеста {unsent['id']} за {digest_date} без повторной сводки")
+        await send_news(unsent['summary'], unsent['id'])
+        return
+
     # Проверяем наличие файла сессии
     if not os.path.exists(f"{SESSION_FILE}.session"):
         print(f"❌ Файл сессии {SESSION_FILE}.session не найден!")
@@ -146,7 +133,7 @@ async def main():
         await get_channels_fullinfo_from_folder(client, FOLDER_NAME)
 
         # Шаг 2: Загрузить полную инфу о каналах для рассылки
-        channels = load_channels_from_json()
+        channels = load_channels(CHANNELS_FILE)
         print(f"[LOG] Каналы для агрегации ({len(channels)} шт.): {[ch.get('username','?') for ch in channels]}")
 
         if not channels:
@@ -154,48 +141,67 @@ async def main():
             return
 
         # Шаг 3: Собрать новости
-        news = await get_news(client, channels)
-        print(f"[LOG] Количество найденных новостей за вчера: {len(news)}")
-        if not news:
+        posts = await get_news(client, channels)
+        print(f"[LOG] Количество найденных новостей за вчера: {len(posts)}")
+        if not posts:
             print("[LOG] Нет новостей за вчера. Прерываю рассылку.")
             return
 
         # Шаг 4: Суммаризация и рассылка
-        summary = summarize_news(news)
-        await send_news(summary)
+        # Один пункт на кластер перепостов с ссылками на все источники
+        clusters = cluster_posts(posts)
+        digest = await summarize_news(clusters, channel_weights(channels), digest_date)
+        await asyncio.to_thread(db.mark_posts_in_digest, digest['post_ids'], digest_date)
+        await send_news(digest['summary'], digest['id'])
 
 async def run_continuous():
     """Непрерывная работа службы новостей с расписанием"""
     logger.info("🔄 Служба агрегации новостей запущена")
     logger.info("📅 Рассылка запланирована на 09:00 UTC каждый день")
 
+    # Процесс мог упасть посреди рассылки - продолжаем её сразу после старта
+    resume_pending = await asyncio.to_thread(
+        db.get_unsent_digest, 'news', get_yesterday_range()[0].date()
+    ) is not None
+    resume_attempts = 0
     while True:
         try:
-            # Вычисляем время до следующей рассылки (09:00 UTC)
-            now = datetime.now(timezone.utc)
-            next_run = now.replace(hour=9, minute=0, second=0, microsecond=0)
-
-            # Если время уже прошло сегодня, планируем на завтра
-            if now >= next_run:
-                next_run += timedelta(days=1)
-
-            wait_time = (next_run - now).total_seconds()
-            wait_hours = wait_time / 3600
-
-            logger.info(f"⏰ Следующая рассылка: {next_run}")
-            logger.info(f"⏱️ Ожидание: {wait_hours:.1f} часов")
-
-            # Ждем до назначенного времени
-            await asyncio.sleep(wait_time)
-
-            # Запускаем рассылку
-            logger.info("📰 Время рассылки! Запускаю агрегацию новостей...")
+            if resume_pending:
+                # main() найдёт незавершённый дайджест и дошлёт его сохранённую сводку
+                # только тем, кому она не доставлена
+                logger.info("🔁 Возобновляю прерванную рассылку...")
+            else:
+                # Вычисляем время до следующей рассылки (09:00 UTC)
+                now = datetime.now(timezone.utc)
+                next_run = now.replace(hour=9, minute=0, second=0, microsecond=0)
+
+                # Если время уже прошло сегодня, планируем на завтра
+                if now >= next_run:
+                    next_run += timedelta(days=1)
+
+                wait_time = (next_run - now).total_seconds()
+                wait_hours = wait_time / 3600
+
+                logger.info(f"⏰ Следующая рассылка: {next_run}")
+                logger.info(f"⏱️ Ожидание: {wait_hours:.1f} часов")
+
+                # Ждем до назначенного времени
+                await asyncio.sleep(wait_time)
+
+                # Запускаем рассылку
+                logger.info("📰 Время рассылки! Запускаю агрегацию новостей...")
+                # Новый день - снова разрешаем продолжения, даже если вчера они кончились
+                resume_attempts = 0
+            resume_pending = False
             await main()
+            resume_attempts = 0
 
         except Exception as e:
             logger.error(f"❌ Ошибка в службе новостей: {e}")
             # Ждем 1 час перед повторной попыткой
             await asyncio.sleep(3600)
+            resume_attempts += 1
+            resume_pending = resume_attempts <= MAX_RESUME_ATTEMPTS
 
 if __name__ == "__main__":
     import argparse
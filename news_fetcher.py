@@ -0,0 +1,227 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import timedelta, timezone
+from typing import List, Dict, Tuple
+
+from telethon.errors import FloodWaitError
+
+from database import db
+
+logger = logging.getLogger(__name__)
+
+# Сколько каналов читаем одновременно через один Telethon клиент
+FETCH_CONCURRENCY = int(os.environ.get('FETCH_CONCURRENCY', '8'))
+# Сколько раз повторяем чтение канала после FloodWait
+MAX_FLOOD_RETRIES = 5
+# На сколько дней назад догоняем пропущенные посты каналов с отметкой чтения
+MAX_CATCHUP_DAYS = int(os.environ.get('MAX_CATCHUP_DAYS', '7'))
+
+
+class AdaptiveLimiter:
+    """Ограничитель параллелизма, который снижает нагрузку при FloodWait"""
+
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = self.max_concurrency
+        self.active = 0
+        self._successes = 0
+        self._paused_until = 0.0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        async with self._cond:
+            while True:
+                pause = self._paused_until - loop.time()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.active < self.limit:
+                    self.active += 1
+                    return
+                await self._cond.wait()
+
+    async def release(self):
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    async def on_success(self):
+        """Аддитивное увеличение лимита после серии успешных запросов"""
+        async with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    async def on_flood_wait(self, seconds: int):
+        """Мультипликативное снижение лимита и общая пауза на время FloodWait"""
+        loop = asyncio.get_running_loop()
+        async with self._cond:
+            self.limit = max(self.min_concurrency, self.limit // 2)
+            self._successes = 0
+            self._paused_until = max(self._paused_until, loop.time() + seconds)
+            self._cond.notify_all()
+
+
+async def _fetch_channel(client, channel_info, start, end, limiter, label, min_id=0):
+    """Прочитать сообщения одного канала за интервал [start, end).
+
+    Если известен последний обработанный message_id (min_id), читаем только более
+    новые сообщения, а нижнюю границу по дате расширяем до MAX_CATCHUP_DAYS,
+    чтобы догнать дни, когда сервис не запускался.
+    """
+    username = channel_info.get("username")
+    posts = []
+    stats = {'username': username, 'channel_id': channel_info.get('id'), 'posts': 0,
+             'requests': 0, 'flood_waits': 0, 'flood_wait_seconds': 0, 'elapsed': 0.0,
+             'watermark': None, 'error': None}
+    if min_id:
+        start = min(start, end - timedelta(days=MAX_CATCHUP_DAYS))
+    offset_id = 0
+    watermark = 0
+
+    for attempt in range(MAX_FLOOD_RETRIES + 1):
+        await limiter.acquire()
+        began = time.monotonic()
+        try:
+            stats['requests'] += 1
+            async for message in client.iter_messages(username, offset_id=offset_id, min_id=min_id):
+                # При повторе после FloodWait продолжаем с последнего прочитанного id
+                offset_id = message.id
+                msg_date = message.date
+                if msg_date.tzinfo is None:
+                    msg_date = msg_date.replace(tzinfo=timezone.utc)
+                msg_date_norm = msg_date.replace(microsecond=0)
+                if msg_date_norm < start:
+                    break
+                if msg_date_norm >= end:
+                    # Сообщения после конца интервала обработаем в следующий запуск
+                    continue
+                watermark = max(watermark, message.id)
+                if message.text:
+                    posts.append({
+                        'channel_id': channel_info.get('id'),
+                        'username': username,
+                        'message_id': message.id,
+                        'text': message.text,
+                        'date': msg_date_norm,
+                        'views': message.views,
+                        'forwards': message.forwards,
+                    })
+                    print(f"[DEBUG] {label}{username} | id={message.id} | дата={msg_date_norm} - добавлено")
+            await limiter.on_success()
+            # Отметку двигаем только после полного прочтения канала
+            stats['watermark'] = watermark or None
+            break
+        except FloodWaitError as e:
+            stats['flood_waits'] += 1
+            stats['flood_wait_seconds'] += e.seconds
+            logger.warning(f"[WARN] FloodWait {e.seconds} c на канале {username} (попытка {attempt + 1})")
+            await limiter.on_flood_wait(e.seconds)
+        except Exception as e:
+            stats['error'] = str(e)
+            logger.error(f"[ERROR] Не удалось прочитать канал {username}: {e}")
+            break
+        finally:
+            stats['elapsed'] += time.monotonic() - began
+            await limiter.release()
+    else:
+        stats['error'] = "превышено число повторов после FloodWait"
+        logger.error(f"[ERROR] Канал {username} пропущен: превышено число повторов после FloodWait")
+
+    stats['posts'] = len(posts)
+    return posts, stats
+
+
+async def fetch_channels(client, channels, start, end, concurrency: int = None, label: str = "",
+                         watermarks: Dict[int, int] = None) -> Tuple[List[Dict], List[Dict]]:
+    """Параллельно прочитать сообщения всех каналов через один Telethon клиент.
+
+    Возвращает список постов (в порядке каналов) и статистику по каждому каналу.
+    """
+    limiter = AdaptiveLimiter(concurrency or FETCH_CONCURRENCY)
+    channels = [ch for ch in channels if ch.get("username")]
+    watermarks = watermarks or {}
+
+    # FloodWait обрабатываем сами, чтобы снижать параллелизм, а не спать внутри клиента
+    flood_sleep_threshold = client.flood_sleep_threshold
+    client.flood_sleep_threshold = 0
+    began = time.monotonic()
+    try:
+        results = await asyncio.gather(
+            *(_fetch_channel(client, ch, start, end, limiter, label, watermarks.get(ch.get('id'), 0))
+              for ch in channels)
+        )
+    finally:
+        client.flood_sleep_threshold = flood_sleep_threshold
+    elapsed = time.monotonic() - began
+
+    all_posts = []
+    all_stats = []
+    for posts, stats in results:
+        all_posts.extend(posts)
+        all_stats.append(stats)
+
+    log_fetch_stats(all_stats, elapsed, limiter)
+    return all_posts, all_stats
+
+
+def log_fetch_stats(all_stats: List[Dict], elapsed: float, limiter: AdaptiveLimiter):
+    """Записать в лог сводку по времени чтения каналов"""
+    if not all_stats:
+        return
+    slowest = sorted(all_stats, key=lambda s: s['elapsed'], reverse=True)
+    flood_waits = sum(s['flood_waits'] for s in all_stats)
+    errors = [s['username'] for s in all_stats if s['error']]
+    logger.info(
+        f"[INFO] Прочитано {len(all_stats)} каналов за {elapsed:.1f} c "
+        f"(самый медленный: {slowest[0]['username']} {slowest[0]['elapsed']:.1f} c, "
+        f"FloodWait: {flood_waits}, итоговый параллелизм: {limiter.limit}/{limiter.max_concurrency})"
+    )
+    for s in slowest[:5]:
+        logger.info(f"[INFO]   {s['username']}: {s['elapsed']:.2f} c, постов={s['posts']}, "
+                    f"запросов={s['requests']}, FloodWait={s['flood_waits']}")
+    if errors:
+        logger.warning(f"[WARN] Каналы с ошибками чтения: {errors}")
+
+
+async def ingest_channels(client, channels, start, end, label: str = "") -> int:
+    """Инкрементально прочитать каналы и сохранить новые посты в news_posts.
+
+    Каналы, полностью прочитанные после конца интервала, в Telegram повторно не запрашиваются.
+    """
+    await asyncio.to_thread(db.sync_news_channels, channels)
+    fresh = set(await asyncio.to_thread(db.get_channels_checked_since, end))
+    pending = [ch for ch in channels if ch.get('id') not in fresh]
+    if len(pending) < len(channels):
+        logger.info(f"[INFO] Пропускаю {len(channels) - len(pending)} уже прочитанных каналов")
+    if not pending:
+        return 0
+
+    watermarks = await asyncio.to_thread(db.get_channel_watermarks)
+    posts, stats = await fetch_channels(client, pending, start, end, label=label, watermarks=watermarks)
+    saved = await asyncio.to_thread(db.save_news_posts, posts)
+    if saved is None:
+        # Отметки не двигаем: несохранённые посты прочитаем заново при следующем запуске
+        logger.error(f"[ERROR] Не удалось сохранить {len(posts)} постов, отметки чтения каналов не сдвинуты")
+        return 0
+    logger.info(f"[INFO] Сохранено постов в news_posts: {saved}")
+    # Отметки двигаем только после сохранения постов
+    await asyncio.to_thread(db.update_channel_watermarks, {
+        s['channel_id']: s['watermark'] for s in stats if s['channel_id'] and not s['error']
+    })
+    return saved
+
+
+def load_digest_posts(channels, end, digest_date) -> List[Dict]:
+    """Посты каналов для дайджеста из news_posts, включая пропущенные дни"""
+    channel_ids = [ch.get('id') for ch in channels if ch.get('id')]
+    return db.get_news_posts(channel_ids, end - timedelta(days=MAX_CATCHUP_DAYS), end, digest_date)
@@ -0,0 +1,142 @@
+import logging
+import math
+import os
+from typing import List, Dict
+
+from dedup import format_cluster
+
+logger = logging.getLogger(__name__)
+
+# Общий бюджет входных токенов на один дайджест (все пачки map-шага вместе)
+SUMMARY_INPUT_TOKEN_BUDGET = int(os.environ.get('SUMMARY_INPUT_TOKENS', '200000'))
+# Период полураспада веса поста по давности, в часах
+RECENCY_HALF_LIFE_HOURS = 24.0
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    # tiktoken не установлен или нет файла словаря - считаем по символам
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Число токенов текста (tiktoken, иначе оценка: кириллица - около 2.5 символов на токен)"""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return int(len(text) / 2.5) + 1
+
+
+def split_by_tokens(items: List[str], budget: int) -> List[List[str]]:
+    """Разбить выдержки на пачки, каждая из которых укладывается в бюджет токенов"""
+    batches = []
+    current = []
+    current_tokens = 0
+    for item in items:
+        tokens = count_tokens(item)
+        if current and current_tokens + tokens > budget:
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def channel_weights(channels: List[Dict]) -> Dict[int, float]:
+    """Вес каналов из реестра (по умолчанию 1.0)"""
+    return {ch['id']: float(ch.get('weight', 1.0)) for ch in channels if ch.get('id')}
+
+
+def score_cluster(cluster: List[Dict], reference_time, weights: Dict[int, float]) -> float:
+    """Ценность новости: свежесть, вес каналов, охваты и число каналов, где она вышла"""
+    newest = max(p['post_date'] for p in cluster)
+    age_hours = max(0.0, (reference_time - newest).total_seconds() / 3600)
+    recency = 0.5 ** (age_hours / RECENCY_HALF_LIFE_HOURS)
+    weight = max(weights.get(p['channel_id'], 1.0) for p in cluster)
+    engagement = sum((p.get('views') or 0) + 10 * (p.get('forwards') or 0) for p in cluster)
+    return recency * weight * (1 + math.log1p(engagement) / 10) * (1 + 0.5 * (len(cluster) - 1))
+
+
+def truncate_cluster(cluster: List[Dict], budget: int) -> str:
+    """Выдержка кластера, урезанная под бюджет: основной текст и ссылки на самые популярные источники.
+
+    Если и один основной пост не помещается, его текст обрезается.
+    """
+    representative = max(cluster, key=lambda p: len(p['content']))
+    others = sorted((p for p in cluster if p is not representative),
+                    key=lambda p: (p.get('views') or 0) + 10 * (p.get('forwards') or 0), reverse=True)
+    kept = [representative]
+    text = format_cluster(kept)
+    for post in others:
+        candidate = format_cluster(kept + [post])
+        if count_tokens(candidate) > budget:
+            break
+        kept.append(post)
+        text = candidate
+
+    content = representative['content']
+    tokens = count_tokens(text)
+    while tokens > budget and content:
+        content = content[:int(len(content) * budget / tokens * 0.9)]
+        text = format_cluster([dict(representative, content=content + '…')])
+        tokens = count_tokens(text)
+    return text
+
+
+def pack_clusters(clusters: List[List[Dict]], weights: Dict[int, float], batch_budget: int,
+                  total_budget: int = SUMMARY_INPUT_TOKEN_BUDGET) -> Dict:
+    """Заполнить пачки самыми ценными новостями в пределах бюджета токенов.
+
+    Кластер больше пачки не выбрасывается, а урезается (truncate_cluster).
+    Возвращает {'batches': [[выдержка, ...], ...], 'selected': [кластер, ...],
+    'truncated': [кластер, ...], 'dropped': [кластер, ...], 'tokens': число токенов во всех пачках}.
+    """
+    if not clusters:
+        return {'batches': [], 'selected': [], 'truncated': [], 'dropped': [], 'tokens': 0}
+
+    reference_time = max(p['post_date'] for c in clusters for p in c)
+    ranked = sorted(clusters, key=lambda c: score_cluster(c, reference_time, weights), reverse=True)
+
+    batches = []
+    selected = []
+    truncated = []
+    dropped = []
+    current = []
+    current_tokens = 0
+    total_tokens = 0
+    for cluster in ranked:
+        text = format_cluster(cluster)
+        tokens = count_tokens(text)
+        oversized = tokens > batch_budget
+        if oversized:
+            text = truncate_cluster(cluster, batch_budget)
+            tokens = count_tokens(text)
+        if total_tokens + tokens > total_budget:
+            dropped.append(cluster)
+            continue
+        if current and current_tokens + tokens > batch_budget:
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(text)
+        current_tokens += tokens
+        total_tokens += tokens
+        selected.append(cluster)
+        if oversized:
+            truncated.append(cluster)
+    if current:
+        batches.append(current)
+
+    if truncated:
+        logger.warning(f"[WARN] Урезано {len(truncated)} новостей, не помещавшихся в пачку ({batch_budget} токенов)")
+    if dropped:
+        dropped_tokens = sum(count_tokens(format_cluster(c)) for c in dropped)
+        links = [f"https://t.me/{c[0]['username']}/{c[0]['message_id']}" for c in dropped]
+        logger.warning(f"[WARN] Не вошло в бюджет {len(dropped)} новостей (~{dropped_tokens} токенов): "
+                       f"{links[:10]}{' ...' if len(links) > 10 else ''}")
+    logger.info(f"[INFO] Упаковано {len(selected)} новостей в {len(batches)} пачек, ~{total_tokens} токенов")
+    return {'batches': batches, 'selected': selected, 'truncated': truncated, 'dropped': dropped,
+            'tokens': total_tokens}
@@ -0,0 +1,384 @@
+from typing import List, Tuple
+
+# Ключ advisory-блокировки: процессы, стартовавшие одновременно, применяют миграции по очереди
+SCHEMA_LOCK_KEY = 720_240_001
+
+# Версионированные миграции схемы: (версия, описание, операторы). Применённые версии
+# записываются в schema_migrations; новые изменения схемы добавляются сюда новой версией.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, 'базовые таблицы и индексы', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username VARCHAR(255),
+            first_name VARCHAR(255),
+            last_name VARCHAR(255),
+            full_name VARCHAR(511),
+            language_code VARCHAR(10),
+            is_bot BOOLEAN DEFAULT false,
+            is_premium BOOLEAN DEFAULT false,
+            added_via_link BOOLEAN DEFAULT false,
+            can_join_groups BOOLEAN,
+            can_read_all_group_messages BOOLEAN,
+            supports_inline_queries BOOLEAN,
+            is_verified BOOLEAN DEFAULT false,
+            is_restricted BOOLEAN DEFAULT false,
+            is_scam BOOLEAN DEFAULT false,
+            is_fake BOOLEAN DEFAULT false,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT true,
+            last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_data JSONB
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            messages_received INTEGER DEFAULT 0,
+            last_message_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            commands_used JSONB DEFAULT '{}',
+            UNIQUE(user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS channel_recommendations (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            recommendation TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status VARCHAR(50) DEFAULT 'pending',
+            admin_notes TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS news_channels (
+            id SERIAL PRIMARY KEY,
+            channel_id BIGINT UNIQUE,
+            username VARCHAR(255),
+            title VARCHAR(500),
+            description TEXT,
+            participants_count INTEGER,
+            is_active BOOLEAN DEFAULT true,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_checked TIMESTAMP,
+            channel_data JSONB
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS news_posts (
+            id SERIAL PRIMARY KEY,
+            channel_id BIGINT REFERENCES news_channels(channel_id),
+            message_id BIGINT,
+            content TEXT,
+            post_date TIMESTAMP,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            included_in_digest BOOLEAN DEFAULT false,
+            digest_date DATE,
+            UNIQUE(channel_id, message_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS news_digests (
+            id SERIAL PRIMARY KEY,
+            digest_date DATE UNIQUE,
+            content TEXT,
+            summary TEXT,
+            posts_count INTEGER DEFAULT 0,
+            subscribers_sent INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS newsletter_sends (
+            id SERIAL PRIMARY KEY,
+            digest_id INTEGER REFERENCES news_digests(id),
+            user_id BIGINT REFERENCES users(user_id),
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivery_status VARCHAR(50) DEFAULT 'sent',
+            error_message TEXT
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_users_active ON users(is_active)',
+        'CREATE INDEX IF NOT EXISTS idx_users_last_interaction ON users(last_interaction)',
+        'CREATE INDEX IF NOT EXISTS idx_channel_recommendations_created ON channel_recommendations(created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_news_posts_date ON news_posts(post_date)',
+        'CREATE INDEX IF NOT EXISTS idx_news_posts_digest ON news_posts(digest_date)',
+    ]),
+    (2, 'инкрементальное чтение каналов и охваты постов', [
+        'ALTER TABLE news_channels ADD COLUMN IF NOT EXISTS last_message_id BIGINT',
+        'ALTER TABLE news_posts ADD COLUMN IF NOT EXISTS views INTEGER',
+        'ALTER TABLE news_posts ADD COLUMN IF NOT EXISTS forwards INTEGER',
+    ]),
+    (3, 'news_digests как кэш сводок', [
+        'ALTER TABLE news_digests DROP CONSTRAINT IF EXISTS news_digests_digest_date_key',
+        "ALTER TABLE news_digests ADD COLUMN IF NOT EXISTS digest_type VARCHAR(50) DEFAULT 'news'",
+        'ALTER TABLE news_digests ADD COLUMN IF NOT EXISTS cache_key VARCHAR(64)',
+        'ALTER TABLE news_digests ADD COLUMN IF NOT EXISTS model VARCHAR(100)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_news_digests_cache_key ON news_digests(cache_key)',
+    ]),
+    (4, 'идемпотентная рассылка и выборка получателей', [
+        'CREATE INDEX IF NOT EXISTS idx_users_active_user_id ON users(is_active, user_id)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_newsletter_sends_digest_user ON newsletter_sends(digest_id, user_id)',
+    ]),
+    (5, 'счётчики подписчиков', [
+        '''
+        CREATE TABLE IF NOT EXISTS user_counters (
+            name VARCHAR(50) PRIMARY KEY,
+            value BIGINT NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_daily_stats (
+            day DATE PRIMARY KEY,
+            subscribed INTEGER NOT NULL DEFAULT 0,
+            unsubscribed INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        INSERT INTO user_counters (name, value)
+        SELECT 'active_users', COUNT(*) FILTER (WHERE is_active) FROM users
+        UNION ALL
+        SELECT 'total_users', COUNT(*) FROM users
+        ON CONFLICT (name) DO NOTHING
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION maintain_user_counters() RETURNS trigger AS $$
+        DECLARE
+            total_delta BIGINT := 0;
+            subscribed BIGINT := 0;
+            unsubscribed BIGINT := 0;
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT COUNT(*), COUNT(*) FILTER (WHERE COALESCE(is_active, false))
+                INTO total_delta, subscribed FROM new_rows;
+            ELSIF TG_OP = 'DELETE' THEN
+                SELECT -COUNT(*), COUNT(*) FILTER (WHERE COALESCE(is_active, false))
+                INTO total_delta, unsubscribed FROM old_rows;
+            ELSE
+                SELECT
+                    COUNT(*) FILTER (WHERE COALESCE(n.is_active, false) AND NOT COALESCE(o.is_active, false)),
+                    COUNT(*) FILTER (WHERE COALESCE(o.is_active, false) AND NOT COALESCE(n.is_active, false))
+                INTO subscribed, unsubscribed
+                FROM old_rows o JOIN new_rows n USING (user_id);
+            END IF;
+
+            IF total_delta <> 0 THEN
+                UPDATE user_counters SET value = value + total_delta WHERE name = 'total_users';
+            END IF;
+            IF subscribed <> unsubscribed THEN
+                UPDATE user_counters SET value = value + subscribed - unsubscribed
+                WHERE name = 'active_users';
+            END IF;
+            IF subscribed > 0 OR unsubscribed > 0 THEN
+                INSERT INTO user_daily_stats (day, subscribed, unsubscribed)
+                VALUES ((now() AT TIME ZONE 'utc')::date, subscribed, unsubscribed)
+                ON CONFLICT (day) DO UPDATE SET
+                    subscribed = user_daily_stats.subscribed + EXCLUDED.subscribed,
+                    unsubscribed = user_daily_stats.unsubscribed + EXCLUDED.unsubscribed;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        'DROP TRIGGER IF EXISTS trg_users_counters ON users',
+        'DROP TRIGGER IF EXISTS trg_users_counters_insert ON users',
+        'DROP TRIGGER IF EXISTS trg_users_counters_update ON users',
+        'DROP TRIGGER IF EXISTS trg_users_counters_delete ON users',
+        '''
+        CREATE TRIGGER trg_users_counters_insert AFTER INSERT ON users
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION maintain_user_counters()
+        ''',
+        '''
+        CREATE TRIGGER trg_users_counters_update AFTER UPDATE ON users
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION maintain_user_counters()
+        ''',
+        '''
+        CREATE TRIGGER trg_users_counters_delete AFTER DELETE ON users
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION maintain_user_counters()
+        ''',
+    ]),
+    (6, 'контрольные точки переноса старых данных', [
+        '''
+        CREATE TABLE IF NOT EXISTS migration_checkpoints (
+            source VARCHAR(100) PRIMARY KEY,
+            last_key BIGINT NOT NULL DEFAULT 0,
+            rows_read BIGINT NOT NULL DEFAULT 0,
+            rows_written BIGINT NOT NULL DEFAULT 0,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (7, 'news_posts по месяцам и сводки за удалённые месяцы', [
+        # Ключ секционирования входит во все уникальные ключи: дата поста в Telegram не меняется,
+        # поэтому (channel_id, message_id, post_date) по-прежнему определяет пост однозначно
+        'ALTER TABLE news_posts RENAME TO news_posts_unpartitioned',
+        'ALTER SEQUENCE news_posts_id_seq OWNED BY NONE',
+        'DROP INDEX IF EXISTS idx_news_posts_date',
+        'DROP INDEX IF EXISTS idx_news_posts_digest',
+        '''
+        CREATE TABLE news_posts (
+            id BIGINT NOT NULL DEFAULT nextval('news_posts_id_seq'),
+            channel_id BIGINT REFERENCES news_channels(channel_id),
+            message_id BIGINT,
+            content TEXT,
+            post_date TIMESTAMP NOT NULL,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            included_in_digest BOOLEAN DEFAULT false,
+            digest_date DATE,
+            views INTEGER,
+            forwards INTEGER,
+            CONSTRAINT news_posts_id_date_pkey PRIMARY KEY (id, post_date),
+            CONSTRAINT news_posts_channel_message_key UNIQUE (channel_id, message_id, post_date)
+        ) PARTITION BY RANGE (post_date)
+        ''',
+        '''
+        CREATE OR REPLACE FUNCTION create_news_posts_partition(month DATE) RETURNS TEXT AS $$
+        DECLARE
+            first_day DATE := date_trunc('month', month)::date;
+            partition_name TEXT := 'news_posts_' || to_char(first_day, 'YYYY_MM');
+        BEGIN
+            -- Существующую секцию не трогаем: CREATE ... PARTITION OF блокирует родительскую таблицу
+            IF to_regclass(partition_name) IS NULL THEN
+                EXECUTE format('CREATE TABLE %I PARTITION OF news_posts FOR VALUES FROM (%L) TO (%L)',
+                               partition_name, first_day, (first_day + INTERVAL '1 month')::date);
+            END IF;
+            RETURN partition_name;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        '''
+        SELECT create_news_posts_partition(month::date)
+        FROM news_posts_unpartitioned,
+             LATERAL (SELECT date_trunc('month', COALESCE(post_date, processed_at, CURRENT_TIMESTAMP))) m(month)
+        GROUP BY month
+        UNION ALL
+        SELECT create_news_posts_partition(month::date)
+        FROM generate_series(date_trunc('month', CURRENT_TIMESTAMP),
+                             date_trunc('month', CURRENT_TIMESTAMP) + INTERVAL '1 month',
+                             INTERVAL '1 month') month
+        ''',
+        # Выборка «посты каналов за окно» идёт по индексу, фильтр по дайджесту - без чтения строк
+        '''
+        CREATE INDEX IF NOT EXISTS idx_news_posts_channel_date
+        ON news_posts (channel_id, post_date) INCLUDE (digest_date)
+        ''',
+        '''
+        INSERT INTO news_posts (id, channel_id, message_id, content, post_date, processed_at,
+                                included_in_digest, digest_date, views, forwards)
+        SELECT id, channel_id, message_id, content, COALESCE(post_date, processed_at, CURRENT_TIMESTAMP),
+               processed_at, included_in_digest, digest_date, views, forwards
+        FROM news_posts_unpartitioned
+        ''',
+        'DROP TABLE news_posts_unpartitioned',
+        'ALTER SEQUENCE news_posts_id_seq OWNED BY news_posts.id',
+        '''
+        CREATE TABLE IF NOT EXISTS news_posts_monthly (
+            month DATE NOT NULL,
+            channel_id BIGINT NOT NULL,
+            posts INTEGER NOT NULL DEFAULT 0,
+            digest_posts INTEGER NOT NULL DEFAULT 0,
+            views BIGINT NOT NULL DEFAULT 0,
+            forwards BIGINT NOT NULL DEFAULT 0,
+            compacted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (month, channel_id)
+        )
+        ''',
+    ]),
+    (8, 'кэш отдельных вызовов модели вне news_digests', [
+        '''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key VARCHAR(64) PRIMARY KEY,
+            response TEXT NOT NULL,
+            model VARCHAR(100),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache(created_at)',
+        # Промежуточные сводки, раньше сохранявшиеся дайджестами типа 'partial'
+        '''
+        INSERT INTO llm_cache (cache_key, response, model, created_at)
+        SELECT cache_key, summary, model, created_at FROM news_digests
+        WHERE digest_type = 'partial' AND cache_key IS NOT NULL AND summary IS NOT NULL
+        ON CONFLICT (cache_key) DO NOTHING
+        ''',
+        '''
+        DELETE FROM news_digests d
+        WHERE d.digest_type = 'partial'
+          AND NOT EXISTS (SELECT 1 FROM newsletter_sends ns WHERE ns.digest_id = d.id)
+        ''',
+    ]),
+    (9, 'число попыток доставки дайджеста', [
+        'ALTER TABLE newsletter_sends ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 1',
+    ]),
+    (10, 'естественный ключ рекомендаций для повторного переноса', [
+        # Дубли, вставленные повторным переносом (--restart или сбой до контрольной точки)
+        '''
+        DELETE FROM channel_recommendations a
+        USING channel_recommendations b
+        WHERE a.id > b.id
+          AND a.user_id = b.user_id
+          AND a.recommendation = b.recommendation
+          AND a.created_at = b.created_at
+        ''',
+        # md5 вместо самого текста: длинная рекомендация не упирается в размер строки индекса
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_channel_recommendations_natural
+        ON channel_recommendations(user_id, md5(recommendation), created_at)
+        ''',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cursor) -> int:
+    """Версия схемы базы (0 - таблицы версий ещё нет)"""
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations')
+    return cursor.fetchone()[0]
+
+
+def ensure_schema(conn) -> int:
+    """Применить недостающие миграции; на актуальной схеме - один SELECT без DDL и блокировок"""
+    cursor = conn.cursor()
+    try:
+        version = current_version(cursor)
+        if version >= LATEST_VERSION:
+            conn.rollback()
+            return version
+
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_KEY,))
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255),
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Пока ждали блокировку, миграции мог применить другой процесс
+        version = current_version(cursor)
+        for migration_version, name, statements in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+                           (migration_version, name))
+            print(f"✅ Применена миграция схемы {migration_version}: {name}")
+            version = migration_version
+        conn.commit()
+        return version
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
@@ -1,15 +1,19 @@
 
 from telethon import TelegramClient
 from telegram import Bot
-import openai
-from config import api_id, api_hash, telegram_bot_token, openai_api_key
+from config import api_id, api_hash, telegram_bot_token
 import asyncio
 from datetime import datetime, timedelta, timezone
-import json
 import os
 import logging
 
-from get_channels import get_channels_fullinfo_from_folder, load_channels_from_json
+from get_channels import get_channels_fullinfo_from_folder
+from channel_registry import load_channels
+from news_fetcher import ingest_channels, load_digest_posts
+from dedup import cluster_posts
+from prompt_packer import pack_clusters, channel_weights
+from database import db
+from summarizer import summarize, BATCH_TOKEN_BUDGET
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,9 +34,7 @@ SPORT_CHANNELS_FILE = "sport_channels.json"
 def load_sport_channels():
     """Загрузить список каналов для спортивных новостей"""
     if os.path.exists(SPORT_CHANNELS_FILE):
-        with open(SPORT_CHANNELS_FILE, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            return data.get('channels', [])
+        return load_channels(SPORT_CHANNELS_FILE)
     return []
 
 def get_yesterday_range():
@@ -41,50 +43,22 @@ def get_yesterday_range():
     end = datetime.combine(today, datetime.min.time(), tzinfo=timezone.utc)
     return start, end
 
-def summarize_sport_news(news_list):
+SPORT_SYSTEM_PROMPT = "Сделай краткую сводку спортивных новостей за сутки по этим выдержкам, обязательно указывай источники. Если несколько новостей про одно и то же событие - кластеризуй в один пункт. Группируй новости по видам спорта. Подробнее освещай важные спортивные события, результаты матчей, трансферы и турниры."
+
+async def summarize_sport_news(clusters, weights=None, digest_date=None):
     """Суммаризация спортивных новостей с фокусом на спорт"""
-    text = "\n\n".join(news_list)
-    # Ограничиваем входной текст до ~15000 токенов (примерно 60000 символов)
-    if len(text) > 60000:
-        text = text[:60000] + "\n[...текст обрезан для соответствия лимитам...]"
-    
-    client_ai = openai.OpenAI(api_key=openai_api_key)
-    response = client_ai.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "Сделай краткую сводку спортивных новостей за сутки по этим выдержкам, обязательно указывай источники. Если несколько новостей про одно и то же событие - кластеризуй в один пункт. Группируй новости по видам спорта. Подробнее освещай важные спортивные события, результаты матчей, трансферы и турниры."},
-            {"role": "user", "content": text}
-        ],
-        max_tokens=6000,
-        temperature=0.7
-    )
-    return response.choices[0].message.content
+    packed = pack_clusters(clusters, weights or {}, BATCH_TOKEN_BUDGET)
+    digest = await summarize(packed['batches'], SPORT_SYSTEM_PROMPT, 'sport', digest_date)
+    digest['post_ids'] = [p['id'] for c in packed['selected'] for p in c]
+    return digest
 
 async def get_sport_news(client, channels):
     """Получение спортивных новостей за вчера"""
-    all_news = []
     start, end = get_yesterday_range()
     print(f"[DEBUG] Диапазон фильтра спортивных новостей: {start} ... {end}")
     
-    for channel_info in channels:
-        username = channel_info.get("username")
-        if not username:
-            continue
-            
-        async for message in client.iter_messages(username):
-            msg_date = message.date
-            if msg_date.tzinfo is None:
-                msg_date = msg_date.replace(tzinfo=timezone.utc)
-            msg_date_norm = msg_date.replace(microsecond=0)
-            
-            if msg_date_norm < start:
-                break
-                
-            if start <= msg_date_norm < end and message.text:
-                all_news.append(f"{message.text}\nИсточник: https://t.me/{username}/{message.id}\n")
-                print(f"[DEBUG] SPORT {username} | id={message.id} | дата={msg_date_norm} - добавлено")
-    
-    return all_news
+    await ingest_channels(client, channels, start, end, label="SPORT ")
+    return await asyncio.to_thread(load_digest_posts, channels, end, start.date())
 
 async def send_sport_news(summary, user_id):
     """Отправка спортивных новостей конкретному пользователю"""
@@ -162,16 +136,20 @@ async def main_sport():
             return
 
         # Шаг 3: Собрать спортивные новости
-        news = await get_sport_news(client, channels)
-        print(f"[LOG] Количество найденных спортивных новостей за вчера: {len(news)}")
+        posts = await get_sport_news(client, channels)
+        print(f"[LOG] Количество найденных спортивных новостей за вчера: {len(posts)}")
         
-        if not news:
+        if not posts:
             print("[LOG] Нет спортивных новостей за вчера. Прерываю рассылку.")
             return
 
         # Шаг 4: Суммаризация и отправка
-        summary = summarize_sport_news(news)
-        success = await send_sport_news(summary, SPORT_USER_ID)
+        digest_date = get_yesterday_range()[0].date()
+        # Один пункт на кластер перепостов с ссылками на все источники
+        clusters = cluster_posts(posts)
+        digest = await summarize_sport_news(clusters, channel_weights(channels), digest_date)
+        await asyncio.to_thread(db.mark_posts_in_digest, digest['post_ids'], digest_date)
+        success = await send_sport_news(digest['summary'], SPORT_USER_ID)
         
         if success:
             print("[LOG] ✅ Спортивная рассылка успешно отправлена!")
@@ -0,0 +1,918 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from db_metrics import instrumented, note_error
+from storage import (LLM_CACHE_RETENTION_DAYS, MAX_DELIVERY_ATTEMPTS, NEWS_POSTS_RETENTION_MONTHS, StorageBackend,
+                     month_start, utc_naive)
+
+# Файл встроенной базы (не путать со старой users.db - у неё другая схема)
+SQLITE_DB_PATH = os.environ.get('SQLITE_DB_PATH', 'news_bot.db')
+# Потоков AsyncDatabase: в WAL читатели не блокируют друг друга, писатель один
+SQLITE_THREADS = int(os.environ.get('SQLITE_THREADS', '4'))
+# Сколько ждать снятия блокировки записи другим потоком или процессом, секунд
+SQLITE_BUSY_TIMEOUT = float(os.environ.get('SQLITE_BUSY_TIMEOUT', '30'))
+# Кэш страниц на подключение, КБ, и окно mmap, байт
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', '65536'))
+SQLITE_MMAP_BYTES = int(os.environ.get('SQLITE_MMAP_BYTES', str(256 * 1024 * 1024)))
+
+# Время хранится ISO-строками в UTC без зоны, как в TIMESTAMP PostgreSQL
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(' '))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter('TIMESTAMP', lambda raw: datetime.fromisoformat(raw.decode()))
+sqlite3.register_converter('DATE', lambda raw: date.fromisoformat(raw.decode()))
+sqlite3.register_converter('BOOLEAN', lambda raw: bool(int(raw)))
+
+# Миграции схемы SQLite: версия хранится в PRAGMA user_version
+SQLITE_MIGRATIONS = [
+    (1, 'начальная схема', '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            full_name TEXT,
+            language_code TEXT,
+            is_bot BOOLEAN DEFAULT 0,
+            is_premium BOOLEAN DEFAULT 0,
+            added_via_link BOOLEAN DEFAULT 0,
+            can_join_groups BOOLEAN,
+            can_read_all_group_messages BOOLEAN,
+            supports_inline_queries BOOLEAN,
+            is_verified BOOLEAN DEFAULT 0,
+            is_restricted BOOLEAN DEFAULT 0,
+            is_scam BOOLEAN DEFAULT 0,
+            is_fake BOOLEAN DEFAULT 0,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            is_active BOOLEAN DEFAULT 1,
+            last_interaction TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            user_data TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS user_stats (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE REFERENCES users(user_id),
+            messages_received INTEGER DEFAULT 0,
+            last_message_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            commands_used TEXT DEFAULT '{}'
+        );
+
+        CREATE TABLE IF NOT EXISTS channel_recommendations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER REFERENCES users(user_id),
+            recommendation TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'pending',
+            admin_notes TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS news_channels (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER UNIQUE,
+            username TEXT,
+            title TEXT,
+            description TEXT,
+            participants_count INTEGER,
+            is_active BOOLEAN DEFAULT 1,
+            added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_checked TIMESTAMP,
+            channel_data TEXT,
+            last_message_id INTEGER
+        );
+
+        CREATE TABLE IF NOT EXISTS news_posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel_id INTEGER REFERENCES news_channels(channel_id),
+            message_id INTEGER,
+            content TEXT,
+            post_date TIMESTAMP,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            included_in_digest BOOLEAN DEFAULT 0,
+            digest_date DATE,
+            views INTEGER,
+            forwards INTEGER,
+            UNIQUE(channel_id, message_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS news_digests (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            digest_date DATE,
+            content TEXT,
+            summary TEXT,
+            posts_count INTEGER DEFAULT 0,
+            subscribers_sent INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP,
+            digest_type TEXT DEFAULT 'news',
+            cache_key TEXT UNIQUE,
+            model TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS newsletter_sends (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            digest_id INTEGER REFERENCES news_digests(id),
+            user_id INTEGER REFERENCES users(user_id),
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            delivery_status TEXT DEFAULT 'sent',
+            error_message TEXT,
+            UNIQUE(digest_id, user_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS user_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        );
+
+        CREATE TABLE IF NOT EXISTS user_daily_stats (
+            day DATE PRIMARY KEY,
+            subscribed INTEGER NOT NULL DEFAULT 0,
+            unsubscribed INTEGER NOT NULL DEFAULT 0
+        );
+
+        INSERT OR IGNORE INTO user_counters (name, value)
+        SELECT 'active_users', COUNT(*) FILTER (WHERE is_active) FROM users
+        UNION ALL
+        SELECT 'total_users', COUNT(*) FROM users;
+
+        -- Построчные триггеры в SQLite дёшевы: всё происходит в процессе, без версий строк
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE user_counters SET value = value + 1 WHERE name = 'total_users';
+            UPDATE user_counters SET value = value + 1 WHERE name = 'active_users' AND NEW.is_active;
+            INSERT INTO user_daily_stats (day, subscribed) SELECT date('now'), 1 WHERE NEW.is_active
+            ON CONFLICT (day) DO UPDATE SET subscribed = subscribed + 1;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_update AFTER UPDATE OF is_active ON users
+        WHEN COALESCE(OLD.is_active, 0) <> COALESCE(NEW.is_active, 0)
+        BEGIN
+            UPDATE user_counters SET value = value + CASE WHEN NEW.is_active THEN 1 ELSE -1 END
+            WHERE name = 'active_users';
+            INSERT INTO user_daily_stats (day, subscribed, unsubscribed)
+            VALUES (date('now'), CASE WHEN NEW.is_active THEN 1 ELSE 0 END,
+                    CASE WHEN NEW.is_active THEN 0 ELSE 1 END)
+            ON CONFLICT (day) DO UPDATE SET
+                subscribed = subscribed + excluded.subscribed,
+                unsubscribed = unsubscribed + excluded.unsubscribed;
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS trg_users_counters_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE user_counters SET value = value - 1 WHERE name = 'total_users';
+            UPDATE user_counters SET value = value - 1 WHERE name = 'active_users' AND OLD.is_active;
+            INSERT INTO user_daily_stats (day, unsubscribed) SELECT date('now'), 1 WHERE OLD.is_active
+            ON CONFLICT (day) DO UPDATE SET unsubscribed = unsubscribed + 1;
+        END;
+
+        CREATE INDEX IF NOT EXISTS idx_users_active_user_id ON users(is_active, user_id);
+        CREATE INDEX IF NOT EXISTS idx_users_last_interaction ON users(last_interaction);
+        CREATE INDEX IF NOT EXISTS idx_channel_recommendations_created ON channel_recommendations(created_at);
+        CREATE INDEX IF NOT EXISTS idx_news_posts_date ON news_posts(post_date);
+        CREATE INDEX IF NOT EXISTS idx_news_posts_digest ON news_posts(digest_date);
+        CREATE INDEX IF NOT EXISTS idx_news_digests_type_date ON news_digests(digest_type, digest_date);
+    '''),
+    (2, 'архив постов и сводки за свёрнутые месяцы', '''
+        -- digest_date в конце ключа: выборка постов канала за окно не читает строки таблицы ради фильтра
+        CREATE INDEX IF NOT EXISTS idx_news_posts_channel_date ON news_posts(channel_id, post_date, digest_date);
+        DROP INDEX IF EXISTS idx_news_posts_digest;
+
+        CREATE TABLE IF NOT EXISTS news_posts_monthly (
+            month DATE NOT NULL,
+            channel_id INTEGER NOT NULL,
+            posts INTEGER NOT NULL DEFAULT 0,
+            digest_posts INTEGER NOT NULL DEFAULT 0,
+            views INTEGER NOT NULL DEFAULT 0,
+            forwards INTEGER NOT NULL DEFAULT 0,
+            compacted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (month, channel_id)
+        );
+    '''),
+    (3, 'кэш отдельных вызовов модели вне news_digests', '''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            cache_key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            model TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_llm_cache_created ON llm_cache(created_at);
+
+        INSERT INTO llm_cache (cache_key, response, model, created_at)
+        SELECT cache_key, summary, model, created_at FROM news_digests
+        WHERE digest_type = 'partial' AND cache_key IS NOT NULL AND summary IS NOT NULL
+        ON CONFLICT (cache_key) DO NOTHING;
+
+        DELETE FROM news_digests
+        WHERE digest_type = 'partial'
+          AND NOT EXISTS (SELECT 1 FROM newsletter_sends ns WHERE ns.digest_id = news_digests.id);
+    '''),
+    (4, 'число попыток доставки дайджеста', '''
+        ALTER TABLE newsletter_sends ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1;
+    '''),
+]
+
+
+def _ids(values) -> str:
+    """Список id параметром запроса: WHERE x IN (SELECT value FROM json_each(?))"""
+    return json.dumps([int(v) for v in values])
+
+
+class _Connection(sqlite3.Connection):
+    """Подключение, отмечающее ошибки запросов в метриках (методы базы их перехватывают)"""
+
+    def execute(self, *args):
+        try:
+            return super().execute(*args)
+        except sqlite3.Error:
+            note_error()
+            raise
+
+    def executemany(self, *args):
+        try:
+            return super().executemany(*args)
+        except sqlite3.Error:
+            note_error()
+            raise
+
+
+@instrumented
+class SQLiteDatabase(StorageBackend):
+    """Встроенное хранилище в файле SQLite (WAL): запросы без сетевых обращений.
+
+    Подходит для развёртывания на одном узле. У каждого потока своё подключение;
+    записи идут в транзакциях BEGIN IMMEDIATE, чтение не блокируется записью.
+    """
+
+    concurrency = SQLITE_THREADS
+
+    def __init__(self, path: str = SQLITE_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                               detect_types=sqlite3.PARSE_DECLTYPES, factory=_Connection)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode = WAL')
+        # В WAL synchronous=NORMAL не теряет целостность, fsync только на контрольных точках
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_KB}')
+        conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_BYTES}')
+        return conn
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """Подключение текущего потока (создаётся при первом обращении)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+        if not self._schema_ready:
+            self._ensure_schema(conn)
+        return conn
+
+    def _ensure_schema(self, conn: sqlite3.Connection):
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version < SQLITE_MIGRATIONS[-1][0]:
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    # Перечитываем под блокировкой: миграции мог применить другой процесс
+                    version = conn.execute('PRAGMA user_version').fetchone()[0]
+                    for migration_version, name, script in SQLITE_MIGRATIONS:
+                        if migration_version <= version:
+                            continue
+                        for statement in _split_script(script):
+                            conn.execute(statement)
+                        conn.execute(f'PRAGMA user_version = {migration_version}')
+                        print(f"✅ Применена миграция схемы SQLite {migration_version}: {name}")
+                    conn.execute('COMMIT')
+                except BaseException:
+                    conn.execute('ROLLBACK')
+                    raise
+            self._schema_ready = True
+
+    @contextmanager
+    def _write(self):
+        """Транзакция записи: блокировка берётся сразу, чтобы не упереться в SQLITE_BUSY при повышении"""
+        conn = self._get_connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def init_database(self):
+        """Открыть базу и привести схему к последней версии"""
+        self._get_connection()
+
+    def close(self):
+        """Закрыть подключение текущего потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    # --- Пользователи ---
+
+    def add_user(self, user_id: int, username: str = None, first_name: str = None,
+                 last_name: str = None, user_data: dict = None) -> bool:
+        """Добавить пользователя в базу"""
+        try:
+            now = datetime.now()
+            with self._write() as conn:
+                conn.execute('''
+                    INSERT INTO users (user_id, username, first_name, last_name,
+                                       added_at, is_active, last_interaction)
+                    VALUES (?, ?, ?, ?, ?, 1, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        last_name = excluded.last_name,
+                        is_active = 1,
+                        last_interaction = excluded.last_interaction
+                ''', (user_id, username or "-", first_name or "-", last_name or "-", now, now))
+                conn.execute('''
+                    INSERT INTO user_stats (user_id, messages_received, last_message_date)
+                    VALUES (?, 0, ?)
+                    ON CONFLICT (user_id) DO NOTHING
+                ''', (user_id, now))
+            return True
+        except Exception as e:
+            print(f"❌ Ошибка добавления пользователя {user_id}: {e}")
+            return False
+
+    def subscribe_user(self, user_id: int, username: str = None, first_name: str = None,
+                       last_name: str = None) -> Optional[str]:
+        """Подписать пользователя: 'new', 'reactivated' или 'already_subscribed'; None при ошибке"""
+        try:
+            now = datetime.now()
+            with self._write() as conn:
+                row = conn.execute('SELECT is_active FROM users WHERE user_id = ?', (user_id,)).fetchone()
+                was_active = bool(row and row['is_active'])
+                conn.execute('''
+                    INSERT INTO users (user_id, username, first_name, last_name,
+                                       added_at, is_active, last_interaction)
+                    VALUES (?, ?, ?, ?, ?, 1, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = excluded.username,
+                        first_name = excluded.first_name,
+                        last_name = excluded.last_name,
+                        is_active = 1,
+                        last_interaction = excluded.last_interaction
+                ''', (user_id, username or "-", first_name or "-", last_name or "-", now, now))
+                conn.execute('''
+                    INSERT INTO user_stats (user_id, messages_received, last_message_date)
+                    VALUES (?, 0, ?)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        messages_received = messages_received + ?,
+                        last_message_date = CASE WHEN ? THEN excluded.last_message_date
+                                                 ELSE last_message_date END
+                ''', (user_id, now, int(was_active), was_active))
+            if row is None:
+                return 'new'
+            return 'already_subscribed' if was_active else 'reactivated'
+        except Exception as e:
+            print(f"❌ Ошибка подписки пользователя {user_id}: {e}")
+            return None
+
+    def remove_user(self, user_id: int):
+        """Удалить пользователя (деактивировать)"""
+        try:
+            with self._write() as conn:
+                conn.execute('UPDATE users SET is_active = 0 WHERE user_id = ?', (user_id,))
+        except Exception as e:
+            print(f"❌ Ошибка удаления пользователя {user_id}: {e}")
+
+    def get_active_users(self) -> List[int]:
+        """Получить список активных пользователей"""
+        try:
+            rows = self._get_connection().execute('SELECT user_id FROM users WHERE is_active = 1')
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"❌ Ошибка получения активных пользователей: {e}")
+            return []
+
+    def get_user_info(self, user_id: int) -> Optional[Dict]:
+        """Получить полную информацию о пользователе"""
+        try:
+            row = self._get_connection().execute('''
+                SELECT user_id, username, first_name, last_name,
+                       added_at, is_active, last_interaction
+                FROM users WHERE user_id = ?
+            ''', (user_id,)).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"❌ Ошибка получения информации о пользователе {user_id}: {e}")
+            return None
+
+    def update_user_interaction(self, user_id: int):
+        """Обновить время последнего взаимодействия"""
+        self.record_interactions([(user_id, 1, datetime.now())])
+
+    def record_interactions(self, interactions: List[tuple]) -> bool:
+        """Записать накопленные взаимодействия [(user_id, число, время последнего)]"""
+        if not interactions:
+            return True
+        try:
+            with self._write() as conn:
+                conn.executemany('''
+                    UPDATE users SET last_interaction = MAX(COALESCE(last_interaction, :at), :at)
+                    WHERE user_id = :user_id
+                ''', [{'user_id': u, 'at': at} for u, _, at in interactions])
+                conn.executemany('''
+                    INSERT INTO user_stats (user_id, messages_received, last_message_date)
+                    SELECT :user_id, :touches, :at
+                    WHERE EXISTS (SELECT 1 FROM users WHERE user_id = :user_id)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        messages_received = messages_received + excluded.messages_received,
+                        last_message_date = MAX(COALESCE(last_message_date, excluded.last_message_date),
+                                                excluded.last_message_date)
+                ''', [{'user_id': u, 'touches': n, 'at': at} for u, n, at in interactions])
+            return True
+        except Exception as e:
+            print(f"❌ Ошибка записи взаимодействий ({len(interactions)} пользователей): {e}")
+            return False
+
+    def get_user_stats(self) -> Dict:
+        """Получить общую статистику пользователей"""
+        try:
+            conn = self._get_connection()
+            counters = {row['name']: row['value'] for row in conn.execute('SELECT name, value FROM user_counters')}
+            today = conn.execute('''
+                SELECT subscribed, unsubscribed FROM user_daily_stats WHERE day = date('now')
+            ''').fetchone()
+            recent_users = [dict(row) for row in conn.execute('''
+                SELECT username, first_name, last_name, last_interaction
+                FROM users WHERE is_active = 1
+                ORDER BY last_interaction DESC LIMIT 5
+            ''')]
+            return {
+                'active_users': counters.get('active_users', 0),
+                'total_users': counters.get('total_users', 0),
+                'subscribed_today': today['subscribed'] if today else 0,
+                'unsubscribed_today': today['unsubscribed'] if today else 0,
+                'recent_users': recent_users
+            }
+        except Exception as e:
+            print(f"❌ Ошибка получения статистики: {e}")
+            return {'active_users': 0, 'total_users': 0, 'subscribed_today': 0,
+                    'unsubscribed_today': 0, 'recent_users': []}
+
+    def reconcile_user_counters(self) -> Dict:
+        """Пересчитать счётчики подписчиков по таблице users; возвращает найденное расхождение"""
+        try:
+            with self._write() as conn:
+                stored = {row['name']: row['value'] for row in conn.execute('SELECT name, value FROM user_counters')}
+                actual = conn.execute('''
+                    SELECT COUNT(*) FILTER (WHERE is_active) AS active_users, COUNT(*) AS total_users
+                    FROM users
+                ''').fetchone()
+                drift = {}
+                for name in ('active_users', 'total_users'):
+                    if stored.get(name) != actual[name]:
+                        drift[name] = actual[name] - (stored.get(name) or 0)
+                        conn.execute('''
+                            INSERT INTO user_counters (name, value) VALUES (?, ?)
+                            ON CONFLICT (name) DO UPDATE SET value = excluded.value
+                        ''', (name, actual[name]))
+            if drift:
+                print(f"⚠️ Счётчики подписчиков исправлены: {drift}")
+            return drift
+        except Exception as e:
+            print(f"❌ Ошибка сверки счётчиков: {e}")
+            return {}
+
+    # --- Рекомендации каналов ---
+
+    def add_channel_recommendation(self, user_id: int, recommendation: str):
+        """Добавить рекомендацию канала"""
+        try:
+            with self._write() as conn:
+                conn.execute('''
+                    INSERT INTO channel_recommendations (user_id, recommendation, created_at)
+                    VALUES (?, ?, ?)
+                ''', (user_id, recommendation, datetime.now()))
+        except Exception as e:
+            print(f"❌ Ошибка добавления рекомендации: {e}")
+
+    def get_channel_recommendations(self) -> List[Dict]:
+        """Получить все рекомендации каналов"""
+        try:
+            rows = self._get_connection().execute('''
+                SELECT cr.id, cr.user_id, cr.recommendation, cr.created_at, cr.status, cr.admin_notes,
+                       u.username, u.first_name, u.last_name
+                FROM channel_recommendations cr
+                LEFT JOIN users u ON cr.user_id = u.user_id
+                ORDER BY cr.created_at DESC
+            ''')
+            return [dict(row) for row in rows]
+        except Exception as e:
+            print(f"❌ Ошибка получения рекомендаций: {e}")
+            return []
+
+    # --- Каналы и посты ---
+
+    def add_news_channel(self, channel_data: Dict):
+        """Добавить канал для агрегации новостей"""
+        try:
+            with self._write() as conn:
+                conn.execute('''
+                    INSERT INTO news_channels
+                    (channel_id, username, title, description, participants_count, channel_data)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (channel_id) DO UPDATE SET
+                        username = excluded.username,
+                        title = excluded.title,
+                        description = excluded.description,
+                        participants_count = excluded.participants_count,
+                        channel_data = excluded.channel_data,
+                        last_checked = ?
+                ''', (
+                    channel_data.get('id'),
+                    channel_data.get('username'),
+                    channel_data.get('title'),
+                    channel_data.get('description'),
+                    channel_data.get('participants_count'),
+                    json.dumps(channel_data, default=str),
+                    datetime.now(),
+                ))
+        except Exception as e:
+            print(f"❌ Ошибка добавления канала: {e}")
+
+    def sync_news_channels(self, channels: List[Dict]):
+        """Зарегистрировать каналы из папки одной транзакцией (без сброса отметок чтения)"""
+        rows = [
+            (ch.get('id'), ch.get('username'), ch.get('title'), json.dumps(ch, default=str))
+            for ch in channels if ch.get('id')
+        ]
+        if not rows:
+            return
+        try:
+            with self._write() as conn:
+                conn.executemany('''
+                    INSERT INTO news_channels (channel_id, username, title, channel_data)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (channel_id) DO UPDATE SET
+                        username = excluded.username,
+                        title = excluded.title,
+                        channel_data = excluded.channel_data
+                ''', rows)
+        except Exception as e:
+            print(f"❌ Ошибка синхронизации каналов: {e}")
+
+    def get_channel_watermarks(self) -> Dict[int, int]:
+        """Получить последний обработанный message_id для каждого канала"""
+        try:
+            rows = self._get_connection().execute('''
+                SELECT channel_id, last_message_id FROM news_channels
+                WHERE last_message_id IS NOT NULL
+            ''')
+            return {row[0]: row[1] for row in rows}
+        except Exception as e:
+            print(f"❌ Ошибка получения отметок чтения каналов: {e}")
+            return {}
+
+    def update_channel_watermarks(self, watermarks: Dict[int, Optional[int]]):
+        """Сохранить последний обработанный message_id каналов (отметка только растёт)"""
+        if not watermarks:
+            return
+        now = utc_naive(datetime.now(timezone.utc))
+        try:
+            with self._write() as conn:
+                conn.executemany('''
+                    UPDATE news_channels SET
+                        last_message_id = MAX(COALESCE(last_message_id, :id), COALESCE(:id, last_message_id)),
+                        last_checked = :now
+                    WHERE channel_id = :channel_id
+                ''', [{'channel_id': c, 'id': m, 'now': now} for c, m in watermarks.items()])
+        except Exception as e:
+            print(f"❌ Ошибка сохранения отметок чтения каналов: {e}")
+
+    def get_channels_checked_since(self, since: datetime) -> List[int]:
+        """Каналы, которые уже были полностью прочитаны после указанного момента"""
+        try:
+            rows = self._get_connection().execute('''
+                SELECT channel_id FROM news_channels WHERE last_checked >= ?
+            ''', (utc_naive(since),))
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"❌ Ошибка получения прочитанных каналов: {e}")
+            return []
+
+    def save_news_posts(self, posts: List[Dict]) -> Optional[int]:
+        """Сохранить посты одной транзакцией (повторное сохранение обновляет текст)"""
+        # Посты старше срока хранения уже свёрнуты в сводки
+        cutoff = month_start(datetime.now(timezone.utc).date(), -NEWS_POSTS_RETENTION_MONTHS)
+        rows = [
+            (p['channel_id'], p['message_id'], p['text'], utc_naive(p['date']),
+             p.get('views'), p.get('forwards'))
+            for p in posts if p.get('channel_id') and utc_naive(p['date']).date() >= cutoff
+        ]
+        if not rows:
+            return 0
+        try:
+            with self._write() as conn:
+                conn.executemany('''
+                    INSERT INTO news_posts (channel_id, message_id, content, post_date, views, forwards)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (channel_id, message_id) DO UPDATE SET
+                        content = excluded.content,
+                        views = excluded.views,
+                        forwards = excluded.forwards
+                ''', rows)
+            return len(rows)
+        except Exception as e:
+            print(f"❌ Ошибка сохранения постов: {e}")
+            return None
+
+    def get_news_posts(self, channel_ids: List[int], start: datetime, end: datetime,
+                       digest_date: date) -> List[Dict]:
+        """Получить посты каналов за интервал, ещё не вошедшие в другой дайджест"""
+        try:
+            rows = self._get_connection().execute('''
+                SELECT p.id, p.channel_id, c.username, p.message_id, p.content, p.post_date,
+                       p.views, p.forwards
+                FROM news_posts p
+                JOIN news_channels c ON c.channel_id = p.channel_id
+                WHERE p.channel_id IN (SELECT value FROM json_each(?))
+                  AND p.post_date >= ? AND p.post_date < ?
+                  AND (p.digest_date IS NULL OR p.digest_date = ?)
+                ORDER BY p.post_date
+            ''', (_ids(channel_ids), utc_naive(start), utc_naive(end), digest_date))
+            return [dict(row) for row in rows]
+        except Exception as e:
+            print(f"❌ Ошибка получения постов: {e}")
+            return []
+
+    def mark_posts_in_digest(self, post_ids: List[int], digest_date: date):
+        """Отметить посты как вошедшие в дайджест"""
+        if not post_ids:
+            return
+        try:
+            with self._write() as conn:
+                conn.execute('''
+                    UPDATE news_posts SET included_in_digest = 1, digest_date = ?
+                    WHERE id IN (SELECT value FROM json_each(?))
+                ''', (digest_date, _ids(post_ids)))
+        except Exception as e:
+            print(f"❌ Ошибка отметки постов дайджеста: {e}")
+
+    def maintain_news_archive(self, retention_months: int = NEWS_POSTS_RETENTION_MONTHS) -> Dict:
+        """Свернуть посты старше срока хранения в помесячные сводки и удалить их"""
+        cutoff = month_start(datetime.now(timezone.utc).date(), -retention_months)
+        result = {'compacted': [], 'posts': 0}
+        try:
+            with self._write() as conn:
+                rows = conn.execute('''
+                    SELECT substr(post_date, 1, 7) || '-01' AS month, COUNT(*) AS posts
+                    FROM news_posts WHERE post_date < ?
+                    GROUP BY month ORDER BY month
+                ''', (cutoff,)).fetchall()
+                conn.execute('''
+                    INSERT INTO news_posts_monthly (month, channel_id, posts, digest_posts, views, forwards)
+                    SELECT substr(post_date, 1, 7) || '-01', channel_id, COUNT(*),
+                           SUM(COALESCE(included_in_digest, 0)), COALESCE(SUM(views), 0), COALESCE(SUM(forwards), 0)
+                    FROM news_posts WHERE post_date < ? AND channel_id IS NOT NULL
+                    GROUP BY 1, channel_id
+                    ON CONFLICT (month, channel_id) DO UPDATE SET
+                        posts = posts + excluded.posts,
+                        digest_posts = digest_posts + excluded.digest_posts,
+                        views = views + excluded.views,
+                        forwards = forwards + excluded.forwards,
+                        compacted_at = CURRENT_TIMESTAMP
+                ''', (cutoff,))
+                conn.execute('DELETE FROM news_posts WHERE post_date < ?', (cutoff,))
+            result['compacted'] = [date.fromisoformat(row['month']) for row in rows]
+            result['posts'] = sum(row['posts'] for row in rows)
+            return result
+        except Exception as e:
+            print(f"❌ Ошибка обслуживания архива постов: {e}")
+            return result
+
+    # --- Дайджесты и рассылки ---
+
+    def get_cached_summary(self, cache_key: str) -> Optional[Dict]:
+        """Найти готовую сводку по ключу кэша"""
+        try:
+            row = self._get_connection().execute('''
+                SELECT id, summary, digest_type, digest_date, posts_count
+                FROM news_digests WHERE cache_key = ?
+            ''', (cache_key,)).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"❌ Ошибка чтения кэша сводок: {e}")
+            return None
+
+    def get_cached_completion(self, cache_key: str) -> Optional[str]:
+        """Найти ответ модели на отдельный вызов (промежуточную сводку)"""
+        try:
+            row = self._get_connection().execute(
+                'SELECT response FROM llm_cache WHERE cache_key = ?', (cache_key,)
+            ).fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            print(f"❌ Ошибка чтения кэша ответов модели: {e}")
+            return None
+
+    def save_cached_completion(self, cache_key: str, response: str, model: str = None):
+        """Сохранить ответ модели на отдельный вызов"""
+        try:
+            with self._write() as conn:
+                conn.execute('''
+                    INSERT INTO llm_cache (cache_key, response, model, created_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        response = excluded.response,
+                        created_at = excluded.created_at
+                ''', (cache_key, response, model, datetime.now()))
+        except Exception as e:
+            print(f"❌ Ошибка сохранения ответа модели в кэш: {e}")
+
+    def prune_completion_cache(self, retention_days: int = LLM_CACHE_RETENTION_DAYS) -> int:
+        """Удалить ответы модели старше срока хранения"""
+        try:
+            with self._write() as conn:
+                return conn.execute('DELETE FROM llm_cache WHERE created_at < ?',
+                                    (datetime.now() - timedelta(days=retention_days),)).rowcount
+        except Exception as e:
+            print(f"❌ Ошибка очистки кэша ответов модели: {e}")
+            return 0
+
+    def save_digest(self, cache_key: str, summary: str, digest_type: str, digest_date: date = None,
+                    posts_count: int = 0, model: str = None) -> Optional[int]:
+        """Сохранить сводку в news_digests, вернуть id записи"""
+        try:
+            with self._write() as conn:
+                row = conn.execute('''
+                    INSERT INTO news_digests (cache_key, summary, digest_type, digest_date,
+                                              posts_count, model, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (cache_key) DO UPDATE SET
+                        summary = excluded.summary
+                    RETURNING id
+                ''', (cache_key, summary, digest_type, digest_date, posts_count, model,
+                      datetime.now())).fetchone()
+            return row[0]
+        except Exception as e:
+            print(f"❌ Ошибка сохранения сводки: {e}")
+            return None
+
+    def claim_deliveries(self, digest_id: int, user_ids: List[int]) -> List[int]:
+        """Занять получателей дайджеста перед отправкой (статус 'sending', попытка засчитывается);
+        вернуть тех, кого можно отправлять"""
+        if not user_ids:
+            return []
+
+        try:
+            with self._write() as conn:
+                rows = conn.execute('''
+                    INSERT INTO newsletter_sends (digest_id, user_id, delivery_status, sent_at)
+                    SELECT ?, value, 'sending', ? FROM json_each(?) WHERE true
+                    ON CONFLICT (digest_id, user_id) DO UPDATE SET
+                        delivery_status = 'sending',
+                        error_message = NULL,
+                        sent_at = excluded.sent_at,
+                        attempts = newsletter_sends.attempts + 1
+                    WHERE newsletter_sends.delivery_status NOT IN ('sent', 'sending')
+                      AND newsletter_sends.attempts < ?
+                    RETURNING user_id
+                ''', (digest_id, datetime.now(), _ids(user_ids), MAX_DELIVERY_ATTEMPTS)).fetchall()
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"❌ Ошибка резервирования получателей дайджеста {digest_id}: {e}")
+            raise
+
+    def record_deliveries(self, digest_id: Optional[int], deliveries: List[tuple]):
+        """Записать итоги пачки отправок (user_id, status, error_message) одной транзакцией"""
+        if not deliveries:
+            return
+
+        sent = [user_id for user_id, status, _ in deliveries if status == 'sent']
+        blocked = [user_id for user_id, status, _ in deliveries if status == 'blocked']
+        now = datetime.now()
+
+        try:
+            with self._write() as conn:
+                if sent:
+                    conn.execute('''
+                        UPDATE users SET last_interaction = ?
+                        WHERE user_id IN (SELECT value FROM json_each(?))
+                    ''', (now, _ids(sent)))
+                    conn.execute('''
+                        UPDATE user_stats SET
+                            messages_received = messages_received + 1,
+                            last_message_date = ?
+                        WHERE user_id IN (SELECT value FROM json_each(?))
+                    ''', (now, _ids(sent)))
+
+                if blocked:
+                    conn.execute('''
+                        UPDATE users SET is_active = 0
+                        WHERE user_id IN (SELECT value FROM json_each(?))
+                    ''', (_ids(blocked),))
+
+                conn.executemany('''
+                    INSERT INTO newsletter_sends (digest_id, user_id, delivery_status, error_message, sent_at)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (digest_id, user_id) DO UPDATE SET
+                        delivery_status = excluded.delivery_status,
+                        error_message = excluded.error_message,
+                        sent_at = excluded.sent_at
+                    WHERE newsletter_sends.delivery_status <> 'sent'
+                ''', [(digest_id, user_id, status, error, now) for user_id, status, error in deliveries])
+
+                if digest_id and sent:
+                    conn.execute('''
+                        UPDATE news_digests SET subscribers_sent = subscribers_sent + ? WHERE id = ?
+                    ''', (len(sent), digest_id))
+        except Exception as e:
+            print(f"❌ Ошибка записи итогов рассылки: {e}")
+            raise
+
+    def get_digest(self, digest_id: int) -> Optional[Dict]:
+        """Получить запись дайджеста (состояние рассылки)"""
+        try:
+            row = self._get_connection().execute('''
+                SELECT id, digest_type, digest_date, posts_count, subscribers_sent, created_at, sent_at
+                FROM news_digests WHERE id = ?
+            ''', (digest_id,)).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"❌ Ошибка получения дайджеста {digest_id}: {e}")
+            return None
+
+    def get_recipient_batch(self, after_user_id: int, limit: int, digest_id: int = None) -> List[int]:
+        """Следующая пачка активных пользователей по возрастанию user_id (keyset-пагинация)
+
+        Если указан digest_id, пропускаются получившие дайджест, занятые под отправку (claim_deliveries)
+        и исчерпавшие MAX_DELIVERY_ATTEMPTS попыток.
+        """
+        try:
+            conn = self._get_connection()
+            if digest_id:
+                rows = conn.execute('''
+                    SELECT u.user_id FROM users u
+                    WHERE u.is_active = 1 AND u.user_id > ?
+                      AND NOT EXISTS (
+                          SELECT 1 FROM newsletter_sends ns
+                          WHERE ns.digest_id = ? AND ns.user_id = u.user_id
+                            AND (ns.delivery_status IN ('sent', 'sending') OR ns.attempts >= ?)
+                      )
+                    ORDER BY u.user_id LIMIT ?
+                ''', (after_user_id, digest_id, MAX_DELIVERY_ATTEMPTS, limit))
+            else:
+                rows = conn.execute('''
+                    SELECT user_id FROM users
+                    WHERE is_active = 1 AND user_id > ?
+                    ORDER BY user_id LIMIT ?
+                ''', (after_user_id, limit))
+            return [row[0] for row in rows]
+        except Exception as e:
+            print(f"❌ Ошибка получения пачки получателей: {e}")
+            raise
+
+    def get_unsent_digest(self, digest_type: str, digest_date: date) -> Optional[Dict]:
+        """Найти дайджест за дату, рассылка которого начата, но не завершена"""
+        try:
+            row = self._get_connection().execute('''
+                SELECT id, summary, subscribers_sent FROM news_digests
+                WHERE digest_type = ? AND digest_date = ? AND sent_at IS NULL
+                ORDER BY created_at DESC LIMIT 1
+            ''', (digest_type, digest_date)).fetchone()
+            return dict(row) if row else None
+        except Exception as e:
+            print(f"❌ Ошибка поиска незавершённой рассылки: {e}")
+            return None
+
+    def mark_digest_sent(self, digest_id: int):
+        """Отметить рассылку дайджеста завершённой"""
+        try:
+            with self._write() as conn:
+                conn.execute('UPDATE news_digests SET sent_at = ? WHERE id = ?', (datetime.now(), digest_id))
+        except Exception as e:
+            print(f"❌ Ошибка отметки рассылки дайджеста {digest_id}: {e}")
+
+
+def _split_script(script: str) -> List[str]:
+    """Разбить скрипт миграции на операторы (тела триггеров не режутся по ';')"""
+    statements, current = [], ''
+    for line in script.splitlines(keepends=True):
+        if line.strip().startswith('--'):
+            continue
+        current += line
+        if sqlite3.complete_statement(current):
+            statements.append(current.strip())
+            current = ''
+    if current.strip():
+        statements.append(current.strip())
+    return statements
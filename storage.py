@@ -0,0 +1,180 @@
+import os
+from abc import ABC, abstractmethod
+from datetime import date, datetime, timezone
+from typing import Dict, List, Optional
+
+# Какое хранилище использовать: postgres (DATABASE_URL) или sqlite (встроенная база в файле)
+DB_BACKEND = os.environ.get('DB_BACKEND', 'postgres')
+# Сколько месяцев постов хранить целиком; более старые сворачиваются в помесячные сводки
+NEWS_POSTS_RETENTION_MONTHS = int(os.environ.get('NEWS_POSTS_RETENTION_MONTHS', '12'))
+# Сколько дней храним ответы модели на отдельные вызовы (промежуточные сводки)
+LLM_CACHE_RETENTION_DAYS = int(os.environ.get('LLM_CACHE_RETENTION_DAYS', '7'))
+# Сколько раз пробуем доставить дайджест одному получателю, прежде чем оставить статус 'failed'
+MAX_DELIVERY_ATTEMPTS = int(os.environ.get('MAX_DELIVERY_ATTEMPTS', '3'))
+
+
+def utc_naive(value: datetime) -> datetime:
+    """Привести время к наивному UTC для колонок TIMESTAMP"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def month_start(value: date, shift: int = 0) -> date:
+    """Первое число месяца, сдвинутого на shift месяцев"""
+    months = value.year * 12 + value.month - 1 + shift
+    return date(months // 12, months % 12 + 1, 1)
+
+
+class StorageBackend(ABC):
+    """Интерфейс хранилища бота: пользователи, каналы, посты, дайджесты и рассылки.
+
+    Реализации: PostgresDatabase (database.py) и SQLiteDatabase (sqlite_database.py).
+    Методы чтения при ошибке возвращают пустой результат, методы записи - логируют и
+    откатывают транзакцию, как в исходной PostgreSQL-реализации.
+    """
+
+    # Сколько потоков имеет смысл одновременно нагружать базу (размер пула AsyncDatabase)
+    concurrency: int = 1
+
+    @abstractmethod
+    def init_database(self):
+        """Подключиться и привести схему к последней версии"""
+
+    # --- Пользователи ---
+
+    @abstractmethod
+    def add_user(self, user_id: int, username: str = None, first_name: str = None,
+                 last_name: str = None, user_data: dict = None) -> bool:
+        """Добавить или реактивировать пользователя"""
+
+    @abstractmethod
+    def subscribe_user(self, user_id: int, username: str = None, first_name: str = None,
+                       last_name: str = None) -> Optional[str]:
+        """Подписать пользователя: 'new', 'reactivated', 'already_subscribed' или None при ошибке"""
+
+    @abstractmethod
+    def remove_user(self, user_id: int):
+        """Деактивировать пользователя"""
+
+    @abstractmethod
+    def get_active_users(self) -> List[int]:
+        """Список активных пользователей"""
+
+    @abstractmethod
+    def get_user_info(self, user_id: int) -> Optional[Dict]:
+        """Запись пользователя или None"""
+
+    @abstractmethod
+    def update_user_interaction(self, user_id: int):
+        """Учесть одно взаимодействие пользователя"""
+
+    @abstractmethod
+    def record_interactions(self, interactions: List[tuple]) -> bool:
+        """Записать накопленные взаимодействия [(user_id, число, время последнего)]"""
+
+    @abstractmethod
+    def get_user_stats(self) -> Dict:
+        """Счётчики подписчиков, изменения за сегодня и последние активные пользователи"""
+
+    @abstractmethod
+    def reconcile_user_counters(self) -> Dict:
+        """Пересчитать счётчики подписчиков, вернуть найденное расхождение"""
+
+    # --- Рекомендации каналов ---
+
+    @abstractmethod
+    def add_channel_recommendation(self, user_id: int, recommendation: str):
+        """Сохранить рекомендацию канала"""
+
+    @abstractmethod
+    def get_channel_recommendations(self) -> List[Dict]:
+        """Все рекомендации, новые первыми"""
+
+    # --- Каналы и посты ---
+
+    @abstractmethod
+    def add_news_channel(self, channel_data: Dict):
+        """Добавить или обновить канал"""
+
+    @abstractmethod
+    def sync_news_channels(self, channels: List[Dict]):
+        """Зарегистрировать каналы пачкой, не трогая отметки чтения"""
+
+    @abstractmethod
+    def get_channel_watermarks(self) -> Dict[int, int]:
+        """Последний обработанный message_id по каналам"""
+
+    @abstractmethod
+    def update_channel_watermarks(self, watermarks: Dict[int, Optional[int]]):
+        """Сдвинуть отметки чтения каналов (только вперёд)"""
+
+    @abstractmethod
+    def get_channels_checked_since(self, since: datetime) -> List[int]:
+        """Каналы, полностью прочитанные после указанного момента"""
+
+    @abstractmethod
+    def save_news_posts(self, posts: List[Dict]) -> Optional[int]:
+        """Сохранить посты, вернуть число записанных (None - запись не удалась)"""
+
+    @abstractmethod
+    def get_news_posts(self, channel_ids: List[int], start: datetime, end: datetime,
+                       digest_date: date) -> List[Dict]:
+        """Посты каналов за интервал, ещё не вошедшие в другой дайджест"""
+
+    @abstractmethod
+    def mark_posts_in_digest(self, post_ids: List[int], digest_date: date):
+        """Отметить посты как вошедшие в дайджест"""
+
+    @abstractmethod
+    def maintain_news_archive(self, retention_months: int = NEWS_POSTS_RETENTION_MONTHS) -> Dict:
+        """Свернуть посты старше срока хранения в помесячные сводки, вернуть свёрнутые месяцы"""
+
+    # --- Дайджесты и рассылки ---
+
+    @abstractmethod
+    def get_cached_summary(self, cache_key: str) -> Optional[Dict]:
+        """Готовая сводка по ключу кэша"""
+
+    @abstractmethod
+    def get_cached_completion(self, cache_key: str) -> Optional[str]:
+        """Ответ модели на отдельный вызов из кэша"""
+
+    @abstractmethod
+    def save_cached_completion(self, cache_key: str, response: str, model: str = None):
+        """Сохранить ответ модели на отдельный вызов"""
+
+    @abstractmethod
+    def prune_completion_cache(self, retention_days: int = LLM_CACHE_RETENTION_DAYS) -> int:
+        """Удалить ответы модели старше срока хранения, вернуть число удалённых"""
+
+    @abstractmethod
+    def save_digest(self, cache_key: str, summary: str, digest_type: str, digest_date: date = None,
+                    posts_count: int = 0, model: str = None) -> Optional[int]:
+        """Сохранить сводку, вернуть id записи"""
+
+    @abstractmethod
+    def claim_deliveries(self, digest_id: int, user_ids: List[int]) -> List[int]:
+        """Занять получателей перед отправкой (статус 'sending', попытка засчитывается);
+        вернуть тех, кого можно отправлять. При ошибке - исключение"""
+
+    @abstractmethod
+    def record_deliveries(self, digest_id: Optional[int], deliveries: List[tuple]):
+        """Записать итоги пачки отправок [(user_id, status, error_message)]; при ошибке - исключение"""
+
+    @abstractmethod
+    def get_digest(self, digest_id: int) -> Optional[Dict]:
+        """Запись дайджеста (состояние рассылки)"""
+
+    @abstractmethod
+    def get_recipient_batch(self, after_user_id: int, limit: int, digest_id: int = None) -> List[int]:
+        """Следующая пачка активных получателей по возрастанию user_id; с digest_id - ещё не получивших
+        дайджест и не исчерпавших MAX_DELIVERY_ATTEMPTS попыток"""
+
+    @abstractmethod
+    def get_unsent_digest(self, digest_type: str, digest_date: date) -> Optional[Dict]:
+        """Дайджест за дату с начатой, но не завершённой рассылкой: {'id', 'summary', 'subscribers_sent'}"""
+
+    @abstractmethod
+    def mark_digest_sent(self, digest_id: int):
+        """Отметить рассылку дайджеста завершённой"""
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+from datetime import date
+from typing import List, Dict
+
+from llm_client import get_llm_client
+from prompt_packer import split_by_tokens
+from database import db
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MODEL = "gpt-4o-mini"
+# Бюджет входа одного запроса (пачки постов) в токенах
+BATCH_TOKEN_BUDGET = int(os.environ.get('SUMMARY_BATCH_TOKENS', '12000'))
+PARTIAL_MAX_TOKENS = 1500
+FINAL_MAX_TOKENS = 6000
+
+# Уровень map-reduce должен хотя бы вдвое сокращать число пачек, иначе сведение не сходится
+if BATCH_TOKEN_BUDGET <= 2 * PARTIAL_MAX_TOKENS:
+    raise ValueError(f"❌ SUMMARY_BATCH_TOKENS={BATCH_TOKEN_BUDGET} слишком мал: "
+                     f"нужно больше {2 * PARTIAL_MAX_TOKENS} (две промежуточные сводки)")
+
+MAP_PROMPT = (
+    "Сделай сжатую промежуточную сводку новостей по этим выдержкам. "
+    "Сохрани все факты, цифры и ссылки на источники. "
+    "Если несколько новостей про одно и то же - объедини в один пункт."
+)
+
+
+def normalize_text(text: str) -> str:
+    """Нормализация выдержки для ключа кэша: пробелы не влияют на результат"""
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def make_cache_key(items: List[str], **params) -> str:
+    """Ключ кэша: хэш набора выдержек (без учёта порядка) и параметров запроса"""
+    payload = json.dumps({
+        'items': sorted(normalize_text(item) for item in items),
+        'params': params,
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+async def _complete(system_prompt: str, text: str, max_tokens: int, temperature: float,
+                    cache: bool = True) -> str:
+    """Запрос к модели с кэшем llm_cache на уровне отдельного вызова"""
+    cache_key = make_cache_key([text], system_prompt=system_prompt, model=SUMMARY_MODEL,
+                               max_tokens=max_tokens, temperature=temperature)
+    if cache:
+        cached = await asyncio.to_thread(db.get_cached_completion, cache_key)
+        if cached:
+            return cached
+
+    summary = await get_llm_client().complete(
+        [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": text}
+        ],
+        model=SUMMARY_MODEL,
+        max_tokens=max_tokens,
+        temperature=temperature
+    )
+    if cache:
+        await asyncio.to_thread(db.save_cached_completion, cache_key, summary, SUMMARY_MODEL)
+    return summary
+
+
+async def _map(batches: List[List[str]]) -> List[str]:
+    """Параллельно сжать каждую пачку в промежуточную сводку (параллелизм ограничивает клиент)"""
+    return await asyncio.gather(*(
+        _complete(MAP_PROMPT, "\n\n".join(batch), PARTIAL_MAX_TOKENS, 0.3) for batch in batches
+    ))
+
+
+async def _map_reduce(batches: List[List[str]], system_prompt: str) -> str:
+    """Map-reduce суммаризация: сжатие пачек, затем слияние промежуточных сводок"""
+    level = 0
+    while len(batches) > 1:
+        level += 1
+        logger.info(f"[INFO] Суммаризация, уровень {level}: {sum(map(len, batches))} выдержек в {len(batches)} пачках")
+        items = await _map(batches)
+        reduced = split_by_tokens(items, BATCH_TOKEN_BUDGET)
+        if len(reduced) >= len(batches):
+            # Промежуточные сводки не сжимаются - дальнейшие уровни только тратили бы запросы к модели
+            raise RuntimeError(f"Суммаризация не сходится: уровень {level} дал {len(reduced)} пачек "
+                               f"из {len(batches)}")
+        batches = reduced
+    items = batches[0] if batches else []
+    # Итоговую сводку кэширует вызывающий как дайджест - отдельная запись в llm_cache не нужна
+    return await _complete(system_prompt, "\n\n".join(items), FINAL_MAX_TOKENS, 0.7, cache=False)
+
+
+async def summarize(batches: List[List[str]], system_prompt: str, digest_type: str = 'news',
+                    digest_date: date = None) -> Dict:
+    """Сводка по пачкам выдержек; повторный запуск на тех же постах берёт её из news_digests.
+
+    Возвращает запись дайджеста: {'id', 'summary', 'cached'}.
+    """
+    news_list = [item for batch in batches for item in batch]
+    cache_key = make_cache_key(news_list, system_prompt=system_prompt, model=SUMMARY_MODEL,
+                               map_prompt=MAP_PROMPT, batch_budget=BATCH_TOKEN_BUDGET,
+                               partial_max_tokens=PARTIAL_MAX_TOKENS, final_max_tokens=FINAL_MAX_TOKENS)
+    cached = await asyncio.to_thread(db.get_cached_summary, cache_key)
+    if cached:
+        logger.info(f"[INFO] Сводка {digest_type} взята из кэша (дайджест id={cached['id']})")
+        return {'id': cached['id'], 'summary': cached['summary'], 'cached': True}
+
+    summary = await _map_reduce(batches, system_prompt)
+    digest_id = await asyncio.to_thread(
+        db.save_digest, cache_key, summary, digest_type, digest_date, len(news_list), SUMMARY_MODEL
+    )
+    return {'id': digest_id, 'summary': summary, 'cached': False}